@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+asyncio API for the Paulstretch engines.
+
+The renders run in a thread pool, so the event loop is never blocked:
+
+    render = start_render("in.wav", "out.wav", method="stereo", stretch=8.0)
+    async for percentage in render.progress_updates():
+        print(percentage)
+    await render
+
+    await stretch("in.wav", "out.wav", stretch=8.0)
+
+    async for block in stretch_blocks("in.wav", stretch=8.0):
+        consume(block)   # float arrays, channels x samples
+
+Cancelling the task which awaits a render (or closing the block generator)
+stops the engine at its next hop.
+"""
+import asyncio
+import numpy as np
+
+import paulstretch_methods
+from paulstretch_context import RenderContext, RenderCancelled
+
+
+def _load(method, input_filename):
+    loaded = paulstretch_methods.load_wav(method, input_filename)
+    if loaded is None:
+        raise IOError("Error loading wav: %s" % input_filename)
+    return loaded
+
+
+def _check_options(options, reserved, caller):
+    # RenderContext options which the caller sets itself would be duplicate keywords
+    for name in reserved:
+        if name in options:
+            raise ValueError("%s is set by %s, it can't be one of the options" % (name, caller))
+
+
+class AsyncRender:
+    """A render running in an executor thread, created by start_render()"""
+    def __init__(self, input_filename, output_filename, method, stretch, window_size, onset, executor, options):
+        _check_options(options, ("progress", "input_filename"), "start_render")
+        self.loop = asyncio.get_running_loop()
+        self.percentage = 0
+        self._updates = asyncio.Queue()
+        self.context = RenderContext(progress=self._on_progress, input_filename=input_filename, **options)
+        self._args = (input_filename, output_filename, method, stretch, window_size, onset)
+        self.future = self.loop.run_in_executor(executor, self._run)
+        self.future.add_done_callback(lambda f: self._updates.put_nowait(None))
+
+    def _run(self):
+        input_filename, output_filename, method, stretch, window_size, onset = self._args
+        samplerate, smp = _load(method, input_filename)
+        paulstretch_methods.run(method, samplerate, smp, stretch, window_size, output_filename, onset, self.context)
+
+    def _on_progress(self, percentage):
+        # called by the engine in the render thread at every hop
+        if percentage != self.percentage:
+            self.percentage = percentage
+            self.loop.call_soon_threadsafe(self._updates.put_nowait, percentage)
+
+    async def progress_updates(self):
+        """Async iterator of the progress percentages, ends with the render"""
+        while True:
+            percentage = await self._updates.get()
+            if percentage is None:
+                return
+            yield percentage
+
+    def cancel(self):
+        """Ask the render thread to stop"""
+        self.context.cancel()
+
+    async def wait(self):
+        try:
+            await asyncio.shield(self.future)
+        except asyncio.CancelledError:
+            # the awaiting task was cancelled: stop the thread and wait for it, so the
+            # engine has closed the output file (with the frames rendered so far, a
+            # normalized render stays empty) before the cancellation goes on
+            self.cancel()
+            try:
+                await self.future
+            except RenderCancelled:
+                pass
+            raise
+
+    def __await__(self):
+        return self.wait().__await__()
+
+
+def start_render(input_filename, output_filename, method="stereo", stretch=8.0, window_size=0.25, onset=10.0,
+                 executor=None, **options):
+    """Start a render in the executor (the loop's default thread pool if None) and return an AsyncRender
+
+    Must be called from a coroutine. Extra options (seed, silence_threshold)
+    are passed to the engine.
+    """
+    return AsyncRender(input_filename, output_filename, method, stretch, window_size, onset, executor, options)
+
+
+async def stretch(input_filename, output_filename, method="stereo", stretch=8.0, window_size=0.25, onset=10.0,
+                  executor=None, **options):
+    """Render a file without blocking the event loop"""
+    await start_render(input_filename, output_filename, method, stretch, window_size, onset, executor, **options)
+
+
+async def stretch_blocks(input_filename, method="stereo", stretch=8.0, window_size=0.25, onset=10.0,
+                         executor=None, block_frames=65536, max_pending=4, **options):
+    """Async generator of the output, in blocks of about block_frames samples
+
+    Each block is a float array (channels x samples, 1D for mono) in -1..1.
+    At most max_pending blocks are buffered, the render thread waits when
+    the consumer is slower.
+    """
+    _check_options(options, ("progress", "output_callback", "input_filename"), "stretch_blocks")
+    loop = asyncio.get_running_loop()
+    blocks = asyncio.Queue(max_pending)
+    pending = []
+
+    def put(block):
+        asyncio.run_coroutine_threadsafe(blocks.put(block), loop).result()
+
+    def on_output(output):
+        pending.append(output.copy())
+        if sum(b.shape[-1] for b in pending) >= block_frames:
+            put(np.concatenate(pending, axis=-1))
+            del pending[:]
+
+    context = RenderContext(progress=lambda percentage: None, output_callback=on_output, input_filename=input_filename, **options)
+
+    def run():
+        samplerate, smp = _load(method, input_filename)
+        paulstretch_methods.run(method, samplerate, smp, stretch, window_size, None, onset, context)
+        if pending:
+            put(np.concatenate(pending, axis=-1))
+
+    future = loop.run_in_executor(executor, run)
+    future.add_done_callback(lambda f: loop.create_task(blocks.put(None)))
+    try:
+        while True:
+            block = await blocks.get()
+            if block is None:
+                break
+            yield block
+        await future
+    finally:
+        if not future.done():
+            # the consumer stopped early: stop the render thread, unblocking it if it waits for room
+            context.cancel()
+            while not future.done():
+                while not blocks.empty():
+                    blocks.get_nowait()
+                await asyncio.sleep(0.01)
+            try:
+                future.result()
+            except RenderCancelled:
+                pass
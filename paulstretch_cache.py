@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Content addressed cache of rendered outputs.
+
+With a fixed seed a render is a pure function of the input bytes, the
+method, its parameters and the engine version, so an identical request can
+be served by copying (or hard linking) a previous output instead of
+rendering it again. The cache is bounded in size and evicts the least
+recently used outputs first.
+
+usage: paulstretch_cache.py render [options] input_wav output_wav
+       paulstretch_cache.py stats
+       paulstretch_cache.py clear
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import inspect
+import hashlib
+import threading
+import tempfile
+import contextlib
+from optparse import OptionParser
+
+import paulstretch_methods
+from paulstretch_context import RenderContext
+
+# Bump whenever a change to the engines alters the output for a given seed
+ENGINE_VERSION = "20141220-2"
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "paulstretch")
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# the RenderContext options which change the output (the seed is a key field of its own)
+OUTPUT_OPTIONS = ("output_format", "dither", "silence_threshold", "normalize")
+
+
+def hash_file(filename, block_size=1024 * 1024):
+    """sha256 of the file contents"""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def render_key(input_filename, method, stretch, windowsize_seconds, onset_level, seed, **options):
+    """Key of a render: hash of the input bytes and of everything that affects the output
+
+    Only the OUTPUT_OPTIONS of the RenderContext options are used, with
+    their defaults when they are not given; the others (callbacks, where
+    the progress or the manifest goes...) don't change the output.
+    """
+    defaults = inspect.signature(RenderContext).parameters
+    options = dict((k, options.get(k, defaults[k].default)) for k in OUTPUT_OPTIONS)
+    params = {
+        "input": hash_file(input_filename),
+        "method": method,
+        "stretch": float(stretch),
+        "window_size": float(windowsize_seconds),
+        "onset": float(onset_level) if method == "newmethod" else None,
+        "seed": seed,
+        "engine": ENGINE_VERSION,
+        "options": options,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    A directory of rendered outputs named by their key, plus a json index
+    with the size and last use time of each entry and the hit statistics.
+    Several processes can share the directory: the index is read, changed
+    and replaced under a lock file.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, link=False):
+        self.directory = directory or os.environ.get("PAULSTRETCH_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        self.link = link
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_filename = os.path.join(self.directory, "index.json")
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock works between processes, the threads of this one also wait on self.lock
+        with self.lock, open(self.index_filename + ".lock", "w") as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            yield
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".wav")
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"entries": {}, "hits": 0, "misses": 0}
+
+    def _save_index(self, index):
+        # write and rename, so a crash never leaves a truncated index
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, self.index_filename)
+
+    def _export(self, src, dst):
+        # a hard linked output shares its data with the cache entry, so it must
+        # not be modified in place (the engines truncate an existing output file)
+        if os.path.exists(dst):
+            os.remove(dst)
+        if self.link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                # different filesystem or no hard link support
+                pass
+        shutil.copyfile(src, dst)
+
+    def lookup(self, key, output_filename, count=True):
+        """Put the cached output at output_filename, return False on a miss"""
+        with self._locked():
+            index = self._load_index()
+            entry = index["entries"].get(key)
+            if entry is None or not os.path.exists(self._path(key)):
+                index["entries"].pop(key, None)
+                if count:
+                    index["misses"] += 1
+                self._save_index(index)
+                return False
+            self._export(self._path(key), output_filename)
+            entry["last_used"] = time.time()
+            if count:
+                index["hits"] += 1
+            self._save_index(index)
+            return True
+
+    def temp_filename(self):
+        """A new file in the cache directory to render into before store()"""
+        fd, filename = tempfile.mkstemp(dir=self.directory, suffix=".wav.tmp")
+        os.close(fd)
+        return filename
+
+    def store(self, key, filename):
+        """Move a rendered file (from temp_filename) into the cache and evict old entries if needed"""
+        with self._locked():
+            index = self._load_index()
+            os.replace(filename, self._path(key))
+            index["entries"][key] = {"size": os.path.getsize(self._path(key)), "last_used": time.time()}
+            self._evict(index, keep=key)
+            self._save_index(index)
+
+    def _evict(self, index, keep=None):
+        # the entry just stored is kept even when it is over the limit by
+        # itself, it is still to be exported; it goes at the next store
+        entries = index["entries"]
+        total = sum(e["size"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            total -= entries.pop(key)["size"]
+
+    def stats(self):
+        """Hit rate and space used"""
+        with self._locked():
+            index = self._load_index()
+        lookups = index["hits"] + index["misses"]
+        return {
+            "entries": len(index["entries"]),
+            "bytes": sum(e["size"] for e in index["entries"].values()),
+            "max_bytes": self.max_bytes,
+            "hits": index["hits"],
+            "misses": index["misses"],
+            "hit_rate": float(index["hits"]) / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        """Remove all the cached outputs and reset the statistics"""
+        with self._locked():
+            index = self._load_index()
+            for key in index["entries"]:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._save_index({"entries": {}, "hits": 0, "misses": 0})
+
+
+def cached_paulstretch(input_filename, output_filename, method, stretch, windowsize_seconds,
+                       onset_level=10.0, seed=None, cache=None, **options):
+    """Render input_filename to output_filename through the cache
+
+    Returns True when the output came from the cache. Renders without a
+    seed are not reproducible, so they always run and are never stored.
+    The options are RenderContext options; the render makes its context
+    itself, from them and input_filename.
+    """
+    if "context" in options:
+        # run() would render with it and ignore the options the key is made of
+        raise ValueError("A cached render makes its own context, give its options instead")
+    if seed is None:
+        samplerate, smp = paulstretch_methods.load_wav(method, input_filename)
+        paulstretch_methods.run(method, samplerate, smp, stretch, windowsize_seconds, output_filename, onset_level,
+                                input_filename=input_filename, **options)
+        return False
+
+    if cache is None:
+        cache = RenderCache()
+    key = render_key(input_filename, method, stretch, windowsize_seconds, onset_level, seed, **options)
+    if cache.lookup(key, output_filename):
+        return True
+
+    samplerate, smp = paulstretch_methods.load_wav(method, input_filename)
+    render_filename = cache.temp_filename()
+    try:
+        paulstretch_methods.run(method, samplerate, smp, stretch, windowsize_seconds, render_filename, onset_level,
+                                seed=seed, input_filename=input_filename, **options)
+        cache.store(key, render_filename)
+    finally:
+        if os.path.exists(render_filename):
+            os.remove(render_filename)
+    if not cache.lookup(key, output_filename, count=False):
+        # another process cleared the cache in between
+        raise IOError("The rendered output of %s was removed from the cache before it was copied" % input_filename)
+    return False
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog render [options] input_wav output_wav\n       %prog stats|clear [options]")
+    parser.add_option("-m", "--method", dest="method",help="processing method (mono, stereo, newmethod)",default="stereo")
+    parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (newmethod only)",type="float",default=10.0)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases (required for caching)",type="int",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("-c", "--cache_dir", dest="cache_dir",help="cache directory",default=None)
+    parser.add_option("-M", "--max_size", dest="max_size",help="cache size limit (MB)",type="float",default=DEFAULT_MAX_BYTES/(1024.0*1024.0))
+    parser.add_option("-l", "--link", dest="link",help="hard link the cached outputs instead of copying them (don't edit the outputs in place then)",action="store_true",default=False)
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1 or args[0] not in ("render", "stats", "clear"):
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    cache = RenderCache(options.cache_dir, int(options.max_size*1024*1024), options.link)
+
+    if args[0] == "stats":
+        stats = cache.stats()
+        print ("entries   = %d" % stats["entries"])
+        print ("space     = %.1f MB of %.1f MB" % (stats["bytes"]/(1024.0*1024.0), stats["max_bytes"]/(1024.0*1024.0)))
+        print ("hits      = %d" % stats["hits"])
+        print ("misses    = %d" % stats["misses"])
+        print ("hit rate  = %.1f %%" % (100.0*stats["hit_rate"]))
+    elif args[0] == "clear":
+        cache.clear()
+        print ("cache cleared")
+    else:
+        if (len(args)<3) or (options.method not in paulstretch_methods.METHODS) or (options.stretch<=0.0) or (options.window_size<=0.001):
+            print ("Error in command line parameters. Run this program with --help for help.")
+            sys.exit(1)
+        if options.seed is None:
+            print ("No seed given, the render is not reproducible and won't be cached")
+        hit = cached_paulstretch(args[1], args[2], options.method, options.stretch, options.window_size,
+                                 options.onset, options.seed, cache, output_format=options.format)
+        print ("cache hit" if hit else "rendered")
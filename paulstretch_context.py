@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Per-render state of the Paulstretch engines.
+
+Everything a render needs besides its input and parameters (the random
+generator of the phases, where the progress goes, the output file format,
+the output tap, the options and what the render records) lives in a RenderContext, so that
+several renders can run at the same time in the threads of one process.
+Use one context per render.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import numpy
+
+from paulstretch_wavwriter import WavWriter, RawWriter, NormalizingWriter
+
+
+def log_spectrum(freqs, nbins):
+    """Peak levels (dB) of a magnitude spectrum (bins, or channels x bins) in nbins log spaced bands
+
+    The DC bin is left out; the magnitudes are scaled by the number of bins,
+    so the levels don't depend on the window size.
+    """
+    if freqs.ndim > 1:
+        freqs = freqs.mean(axis=0)
+    n = len(freqs)
+    nbins = min(nbins, n - 1)
+    # at least one FFT bin per band in the low frequencies: edges - k is non decreasing
+    steps = numpy.arange(nbins + 1)
+    edges = steps + numpy.maximum.accumulate(numpy.geomspace(1, n, nbins + 1).round().astype(int) - steps)
+    bands = numpy.maximum.reduceat(freqs, edges[:-1])
+    return (20.0 * numpy.log10(bands / (n - 1) + 1e-9)).astype(numpy.float32)
+
+
+class RenderCancelled(Exception):
+    """Raised inside the engine when its context has been cancelled"""
+    pass
+
+
+class RenderContext:
+    """
+    seed             -- seed of the random phases (None: not reproducible)
+    progress         -- function called with the percentage; when None the
+                        progress is written to stream like the scripts do
+    output_callback  -- function called with every output block (clamped floats)
+    silence_threshold-- RMS level (linear) below which frames are skipped
+    plot_onsets      -- the new method keeps its onset curve in self.onsets
+    stream           -- where the progress goes without a callback (default: sys.stdout)
+    output_format    -- format of the output file (see paulstretch_wavwriter.FORMATS)
+    dither           -- add TPDF dither when writing integer formats
+    output_stream    -- where the raw output goes when the output file name is "-"
+                        (default: sys.stdout)
+    checkpoint_interval -- seconds between the checkpoints of the render state
+                        (None: no checkpoints)
+    resume           -- continue from the checkpoint of the output file if there is one
+    normalize        -- scale the output file to this peak level (linear) in a second
+                        pass, instead of clamping the loud parts (None: off)
+    spectrum_callback-- function called with the log binned magnitude spectrum of the
+                        output (spectrum_bins floats, dB) at most spectrum_rate times
+                        per second, made from the spectra the engine computes anyway
+    manifest         -- write a json manifest of the run to this file when the render
+                        is complete (see paulstretch_manifest; None: off)
+    metrics          -- add the run to this Prometheus textfile collector file
+                        (default: $PAULSTRETCH_METRICS, None: off)
+    input_filename   -- the input file, for the manifest (bytes read)
+    """
+    def __init__(self, seed=None, progress=None, output_callback=None, silence_threshold=0.0,
+                 plot_onsets=False, stream=None, output_format="pcm16", dither=False, output_stream=None,
+                 checkpoint_interval=None, resume=False, normalize=None, spectrum_callback=None,
+                 spectrum_bins=64, spectrum_rate=20.0, manifest=None, metrics=None, input_filename=None):
+        self.seed = seed
+        self.rng = numpy.random.default_rng(seed)
+        self.progress_callback = progress
+        self.output_callback = output_callback
+        self.silence_threshold = silence_threshold
+        self.plot_onsets = plot_onsets
+        self.stream = stream
+        self.output_format = output_format
+        self.dither = dither
+        self.output_stream = output_stream
+        if normalize is not None and (checkpoint_interval is not None or resume):
+            raise ValueError("Normalized renders can't use checkpoints")
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.normalize = normalize
+        self.checkpoint_filename = None
+        self._checkpoint_info = None
+        self._resume_info = None
+        self._last_checkpoint = 0.0
+        self.spectrum_callback = spectrum_callback
+        self.spectrum_bins = spectrum_bins
+        self.spectrum_interval = 1.0 / spectrum_rate
+        self._last_spectrum = 0.0
+        self.onsets = []
+        self.manifest = manifest
+        self.metrics = metrics if metrics is not None else os.environ.get("PAULSTRETCH_METRICS") or None
+        self.input_filename = input_filename
+        self.frames_processed = 0
+        self._run_params = None
+        self._run_started = None
+        self._run_output = (None, 1)
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Stop the render at its next hop (it raises RenderCancelled)"""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report_progress(self, percentage):
+        if self.cancel_event.is_set():
+            raise RenderCancelled()
+        if self.progress_callback is not None:
+            self.progress_callback(percentage)
+            return
+        stream = self.stream if self.stream is not None else sys.stdout
+        if percentage >= 100:
+            stream.write("100 %\n")
+        else:
+            stream.write("%d %% \r" % percentage)
+        stream.flush()
+
+    def report_spectrum(self, freqs):
+        """Tap of the magnitude spectrum (bins, or channels x bins) of an output frame"""
+        if self.spectrum_callback is None:
+            return
+        now = time.monotonic()
+        if now - self._last_spectrum < self.spectrum_interval:
+            return
+        self._last_spectrum = now
+        self.spectrum_callback(log_spectrum(freqs, self.spectrum_bins))
+
+    def open_output(self, filename, samplerate, nchannels, expected_frames=None):
+        """Open the output file of the render in the context's format, "-" writes raw PCM to output_stream"""
+        self._run_output = (filename, nchannels)
+        # the dither noise has its own generator, so it doesn't shift the random phases
+        dither_seed = None if self.seed is None else [self.seed, 1]
+        if filename == "-":
+            stream = self.output_stream if self.output_stream is not None else sys.stdout.buffer
+            outfile = RawWriter(stream, self.output_format, self.dither, dither_seed)
+        elif self._resume_info is None:
+            outfile = WavWriter(filename, samplerate, nchannels, self.output_format, self.dither, dither_seed, expected_frames)
+        else:
+            outfile = WavWriter(filename, samplerate, nchannels, self.output_format, self.dither, dither_seed, expected_frames,
+                                resume_data_size=self._resume_info["data_size"])
+            if outfile.encoder.rng is not None:
+                outfile.encoder.rng.bit_generator.state = self._resume_info["dither"]
+        if self.normalize is not None:
+            # the scratch file goes next to the output, where the space for it is expected
+            scratch_dir = None if filename == "-" else os.path.dirname(os.path.abspath(filename))
+            outfile = NormalizingWriter(outfile, nchannels, self.normalize, scratch_dir)
+        return outfile
+
+    def resume_state(self, outfilename, params, samples=None):
+        """Set up the checkpoints of a render to outfilename; return the saved state when resuming
+
+        params identify the render (engine, parameters, input size); a
+        checkpoint made with other params, context options or input is an
+        error. The input is identified by a hash of samples (the engine's
+        input, before it changes it) or else by the size and time of
+        input_filename. The state is a dict of the values given to
+        save_checkpoint(). The engines call this first, it also starts the
+        record of the run.
+        """
+        self.start_run(params)
+        if outfilename is None or outfilename == "-":
+            return None
+        self.checkpoint_filename = outfilename + ".checkpoint"
+        if self.checkpoint_interval is None and not self.resume:
+            # no checkpoint is saved nor read, don't hash the input for nothing
+            return None
+        params = dict(params, seed=self.seed, output_format=self.output_format, dither=self.dither,
+                      silence_threshold=self.silence_threshold, normalize=self.normalize, input=self._input_identity(samples))
+        self._checkpoint_info = {"params": params}
+        self._last_checkpoint = time.monotonic()
+        if not self.resume or not os.path.exists(self.checkpoint_filename):
+            return None
+        with numpy.load(self.checkpoint_filename) as data:
+            state = {key: data[key] for key in data.files}
+        info = json.loads(str(state.pop("_info")))
+        if info["params"] != params:
+            raise ValueError("The checkpoint of %s was made with other parameters" % outfilename)
+        self.rng.bit_generator.state = info["rng"]
+        self._resume_info = info
+        return state
+
+    def start_run(self, params, outfilename=None, nchannels=1):
+        """Start the record of a run (see render_complete) for the renders without checkpoints
+
+        params are the engine name, samplerate, nsamples, windowsize_seconds
+        and the parameters of the render; outfilename is the output of a
+        render which doesn't open it with open_output().
+        """
+        self._run_params = params
+        self._run_started = (time.time(), time.perf_counter(), time.thread_time())
+        self.frames_processed = 0
+        if outfilename is not None:
+            self._run_output = (outfilename, nchannels)
+
+    def _input_identity(self, samples):
+        if samples is not None:
+            return hashlib.sha256(numpy.ascontiguousarray(samples).tobytes()).hexdigest()
+        if self.input_filename is not None and os.path.isfile(self.input_filename):
+            stat = os.stat(self.input_filename)
+            return [stat.st_size, stat.st_mtime_ns]
+        return None
+
+    def checkpoint_due(self):
+        return (self.checkpoint_interval is not None and self.checkpoint_filename is not None
+                and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval)
+
+    def save_checkpoint(self, outfile, **state):
+        """Flush outfile and save the render state atomically next to it"""
+        outfile.flush()
+        info = dict(self._checkpoint_info, data_size=outfile.data_size, rng=self.rng.bit_generator.state,
+                    dither=outfile.encoder.rng.bit_generator.state if outfile.encoder.rng is not None else None)
+        temp_filename = self.checkpoint_filename + ".tmp"
+        with open(temp_filename, "wb") as f:
+            numpy.savez(f, _info=json.dumps(info), **state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.checkpoint_filename)
+        self._last_checkpoint = time.monotonic()
+
+    @property
+    def resumed(self):
+        return self._resume_info is not None
+
+    def render_complete(self, cpu_seconds=None):
+        """Called by the engines at the end of a render: writes the manifest and the metrics of the run
+
+        cpu_seconds replaces the CPU time of the calling thread since the
+        start of the run, for a render which ran in several threads.
+        """
+        if (self.manifest is None and self.metrics is None) or self._run_params is None:
+            return
+        import paulstretch_manifest
+        output_filename, nchannels = self._run_output
+        record = paulstretch_manifest.run_record(self, self._run_params, self._run_started, output_filename, nchannels,
+                                                 cpu_seconds)
+        if self.manifest is not None:
+            paulstretch_manifest.write_manifest(self.manifest, record)
+        if self.metrics is not None:
+            paulstretch_manifest.update_metrics(self.metrics, record)
+
+    def remove_checkpoint(self):
+        """Called when the render is complete"""
+        if self.checkpoint_filename is not None and os.path.exists(self.checkpoint_filename):
+            os.remove(self.checkpoint_filename)
+
+    def write_output(self, output):
+        self.frames_processed += output.shape[-1]
+        # the engines only clamp what goes to the output file, and only when the format needs it
+        if self.output_callback is not None:
+            self.output_callback(numpy.clip(output, -1.0, 1.0))
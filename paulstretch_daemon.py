@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+"""
+Local render service with warm worker processes and a job API.
+
+The service keeps a pool of worker processes which have already imported
+numpy and the engines, and a priority queue of render jobs. Jobs are
+submitted, polled and cancelled over a small json HTTP API on localhost.
+Every request needs the token of the service ("Authorization: Bearer
+<token>"), which serve writes to a file only its user can read
+(~/.config/paulstretch/daemon_<port>.token, or $PAULSTRETCH_DAEMON_TOKEN);
+the POST bodies must be application/json:
+
+    POST   /jobs          {"method": "stereo", "input": "in.wav", "output": "out.wav",
+                           "stretch": 8.0, "window_size": 0.25, "priority": 0, ...}
+    GET    /jobs          list of all the jobs
+    GET    /jobs/<id>     status and progress of a job
+    DELETE /jobs/<id>     cancel a queued or running job
+
+usage: paulstretch_daemon.py serve [--port PORT] [--workers N] [--memory_limit MB]
+       paulstretch_daemon.py submit [options] input_wav output_wav
+       paulstretch_daemon.py status|cancel job_id
+       paulstretch_daemon.py list
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import heapq
+import queue
+import secrets
+import itertools
+import threading
+import multiprocessing
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from optparse import OptionParser
+
+import paulstretch_estimate
+from paulstretch_context import RenderContext, RenderCancelled
+from paulstretch_wavwriter import FORMATS
+
+DEFAULT_PORT = 8765
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".config", "paulstretch")
+
+# job parameters which are passed to the engine, with their defaults
+JOB_DEFAULTS = {
+    "method": "stereo",
+    "input": None,
+    "output": None,
+    "stretch": 8.0,
+    "window_size": 0.25,
+    "onset": 10.0,
+    "seed": None,
+    "silence_threshold": 0.0,
+    "output_format": "pcm16",
+    "dither": False,
+    "spectrum": False,
+    "manifest": None,
+    "metrics": None,
+}
+
+
+class _JobProgress:
+    """
+    Progress callback of a job in a worker: sends the progress events and
+    stops the render when the job is cancelled.
+    """
+    def __init__(self, job_id, event_queue, cancel_event):
+        self.job_id = job_id
+        self.event_queue = event_queue
+        self.cancel_event = cancel_event
+        self.last_percentage = -1
+
+    def __call__(self, percentage):
+        if self.cancel_event.is_set():
+            raise RenderCancelled()
+        if percentage != self.last_percentage:
+            self.last_percentage = percentage
+            self.event_queue.put((self.job_id, "progress", percentage))
+
+
+def token_filename(port=DEFAULT_PORT):
+    """The file with the access token of the service on port"""
+    return os.environ.get("PAULSTRETCH_DAEMON_TOKEN") or os.path.join(CONFIG_DIR, "daemon_%d.token" % port)
+
+
+def write_token(filename):
+    """Make a new access token and write it to filename, readable by this user only"""
+    token = secrets.token_hex(32)
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # an existing file keeps its mode with O_CREAT
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token + "\n")
+    return token
+
+
+def read_token(filename):
+    with open(filename) as f:
+        return f.read().strip()
+
+
+def run_job(params, progress=None, duration=None, spectrum=None):
+    """Render one job in the current process
+
+    duration, if given, is called with the length of the output (seconds)
+    once the input is loaded; spectrum is the spectrum tap of the render
+    (see RenderContext), used when the job has "spectrum" set.
+    """
+    import paulstretch_manifest
+    import paulstretch_methods
+    # the worker process is long lived: its peak RSS in the manifest is the one of this job
+    paulstretch_manifest.reset_peak_rss()
+    loaded = paulstretch_methods.load_wav(params["method"], params["input"])
+    if loaded is None:
+        raise IOError("Error loading wav: %s" % params["input"])
+    samplerate, smp = loaded
+    if duration is not None:
+        duration(smp.shape[-1] * params["stretch"] / float(samplerate))
+    context = RenderContext(seed=params["seed"], silence_threshold=params["silence_threshold"], progress=progress,
+                            output_format=params["output_format"], dither=params["dither"],
+                            spectrum_callback=spectrum if params["spectrum"] else None,
+                            manifest=params["manifest"], metrics=params["metrics"], input_filename=params["input"])
+    paulstretch_methods.run(params["method"], samplerate, smp, params["stretch"], params["window_size"],
+                            params["output"], params["onset"], context)
+
+
+def _worker_main(task_queue, event_queue, cancel_event):
+    # warm up: import everything and let numpy build its FFT machinery once,
+    # so the first job doesn't pay for it
+    import numpy
+    import paulstretch_methods
+    for method in paulstretch_methods.METHODS:
+        paulstretch_methods.get_engine(method)
+    numpy.fft.irfft(numpy.fft.rfft(numpy.zeros(4096)))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        job_id, params = task
+        created = not os.path.exists(params["output"])
+        try:
+            run_job(params, _JobProgress(job_id, event_queue, cancel_event),
+                    lambda seconds: event_queue.put((job_id, "duration", seconds)),
+                    lambda bands: event_queue.put((job_id, "spectrum", bands)))
+            event_queue.put((job_id, "done", None))
+        except RenderCancelled:
+            # don't leave a partial output behind, unless the file was there before the job
+            if created:
+                try:
+                    os.remove(params["output"])
+                except OSError:
+                    pass
+            event_queue.put((job_id, "cancelled", None))
+        except Exception as e:
+            event_queue.put((job_id, "failed", str(e)))
+
+
+class _Worker:
+    def __init__(self, mp_context, event_queue):
+        self.task_queue = mp_context.Queue()
+        self.cancel_event = mp_context.Event()
+        self.process = mp_context.Process(target=_worker_main, args=(self.task_queue, event_queue, self.cancel_event))
+        self.process.daemon = True
+        self.process.start()
+        self.job_id = None
+
+
+class RenderService:
+    """
+    Priority job queue in front of a pool of warm worker processes.
+
+    Higher priorities run first, jobs of the same priority run in submission
+    order (or the order given with move()). A listener can be registered to
+    be called (from the dispatcher thread) with the job status every time a
+    job changes. The throughput of a running job is the length of output
+    rendered per second, 10.0 is ten times faster than real time.
+
+    Submitted jobs get an estimate of their time, memory and output size
+    (see paulstretch_estimate); with admission set, the jobs which need more
+    memory than memory_limit (default: the physical memory) or more disk
+    space than the output's file system has are refused.
+
+    Jobs with "spectrum" set send the log binned spectra of their output
+    (see RenderContext.spectrum_callback) to spectrum_listener, called with
+    the job id and the bands from the dispatcher thread.
+
+    Every job writes a run manifest to its "manifest" file name, if it has
+    one, and adds its run to the metrics textfile (its "metrics" or the
+    service's, see paulstretch_manifest).
+    """
+    def __init__(self, workers=None, listener=None, spectrum_listener=None, admission=True, memory_limit=None,
+                 metrics=None):
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.event_queue = self.mp_context.Queue()
+        self.nworkers = workers or os.cpu_count() or 1
+        self.workers = [_Worker(self.mp_context, self.event_queue) for _ in range(self.nworkers)]
+        self.retired = []
+        self.listener = listener
+        self.spectrum_listener = spectrum_listener
+        self.admission = admission
+        self.memory_limit = memory_limit
+        self.metrics = metrics
+        self.jobs = {}
+        self.pending = []
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch_loop)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, params, priority=0):
+        """Queue a job and return its id immediately"""
+        job_params = dict(JOB_DEFAULTS)
+        job_params.update((k, v) for k, v in params.items() if k in JOB_DEFAULTS)
+        if not job_params["input"] or not job_params["output"]:
+            raise ValueError("A job needs an input and an output file")
+        if job_params["metrics"] is None:
+            job_params["metrics"] = self.metrics
+        if job_params["output_format"] not in FORMATS:
+            raise ValueError("Unknown output format: %s" % job_params["output_format"])
+        cost = self.estimate(job_params)
+        if self.admission and cost is not None:
+            problems = paulstretch_estimate.admission_problems(cost, job_params["output"], self.memory_limit)
+            if problems:
+                raise ValueError("The job doesn't fit: %s" % "; ".join(problems))
+        with self.lock:
+            job_id = "%d" % next(self.counter)
+            self.jobs[job_id] = {
+                "id": job_id,
+                "params": job_params,
+                "priority": priority,
+                "order": int(job_id),
+                "state": "queued",
+                "progress": 0,
+                "error": None,
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+                "duration": None,
+                "throughput": None,
+                "estimate": cost,
+            }
+            heapq.heappush(self.pending, (-priority, int(job_id), job_id))
+        self._notify(job_id)
+        self._assign()
+        return job_id
+
+    def estimate(self, params):
+        """Cost estimate of a job, None when its input can't be read (the job fails when it runs)"""
+        try:
+            return paulstretch_estimate.estimate(params["input"], params["method"], params["stretch"],
+                                                 params["window_size"], params["output_format"], onset_level=params["onset"])
+        except Exception:
+            return None
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def set_priority(self, job_id, priority):
+        """Change the priority of a queued job"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] != "queued":
+                return False
+            job["priority"] = priority
+            self.pending = [p for p in self.pending if p[2] != job_id]
+            self.pending.append((-priority, job["order"], job_id))
+            heapq.heapify(self.pending)
+            return True
+
+    def move(self, job_id, offset):
+        """Move a queued job up (negative offset) or down the queue, returns False if it isn't queued
+
+        The moved jobs exchange their places in the queue, priorities included.
+        """
+        with self.lock:
+            slots = sorted(p for p in self.pending if self.jobs[p[2]]["state"] == "queued")
+            order = [p[2] for p in slots]
+            if job_id not in order:
+                return False
+            i = order.index(job_id)
+            order.insert(max(0, min(len(order) - 1, i + offset)), order.pop(i))
+            self.pending = []
+            for (neg_priority, position, _), queued_id in zip(slots, order):
+                self.jobs[queued_id]["priority"] = -neg_priority
+                self.jobs[queued_id]["order"] = position
+                self.pending.append((neg_priority, position, queued_id))
+            heapq.heapify(self.pending)
+        for queued_id in order:
+            self._notify(queued_id)
+        return True
+
+    def resize(self, workers):
+        """Change the number of worker processes, the busy ones leave after their job"""
+        with self.lock:
+            self.nworkers = max(1, workers)
+        self._assign()
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job, returns False if it already finished"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] not in ("queued", "running"):
+                return False
+            if job["state"] == "queued":
+                job["state"] = "cancelled"
+                job["finished"] = time.time()
+            else:
+                for worker in self.workers:
+                    if worker.job_id == job_id:
+                        worker.cancel_event.set()
+        self._notify(job_id)
+        return True
+
+    def shutdown(self):
+        self.running = False
+        for worker in self.workers:
+            worker.task_queue.put(None)
+        for worker in self.workers + self.retired:
+            worker.process.join(5.0)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def _notify(self, job_id):
+        if self.listener:
+            status = self.status(job_id)
+            if status:
+                self.listener(status)
+
+    def _assign(self):
+        started = []
+        with self.lock:
+            while len(self.workers) < self.nworkers:
+                self.workers.append(_Worker(self.mp_context, self.event_queue))
+            for worker in [w for w in self.workers if w.job_id is None]:
+                if len(self.workers) <= self.nworkers:
+                    break
+                self.workers.remove(worker)
+                worker.task_queue.put(None)
+                self.retired.append(worker)
+            for worker in self.workers:
+                if worker.job_id is not None:
+                    continue
+                while self.pending:
+                    _, _, job_id = heapq.heappop(self.pending)
+                    job = self.jobs[job_id]
+                    if job["state"] != "queued":
+                        continue
+                    job["state"] = "running"
+                    job["started"] = time.time()
+                    worker.job_id = job_id
+                    worker.cancel_event.clear()
+                    worker.task_queue.put((job_id, job["params"]))
+                    started.append(job_id)
+                    break
+        for job_id in started:
+            self._notify(job_id)
+
+    def _finish(self, job_id, state, error=None):
+        with self.lock:
+            job = self.jobs[job_id]
+            job["state"] = state
+            job["error"] = error
+            job["finished"] = time.time()
+            if state == "done":
+                job["progress"] = 100
+            for worker in self.workers:
+                if worker.job_id == job_id:
+                    worker.job_id = None
+        self._notify(job_id)
+
+    def _dispatch_loop(self):
+        while self.running:
+            try:
+                job_id, kind, value = self.event_queue.get(timeout=0.2)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if kind == "progress":
+                with self.lock:
+                    job = self.jobs[job_id]
+                    job["progress"] = value
+                    elapsed = time.time() - job["started"]
+                    if job["duration"] is not None and elapsed > 0.0:
+                        job["throughput"] = job["duration"] * value / 100.0 / elapsed
+                self._notify(job_id)
+            elif kind == "duration":
+                with self.lock:
+                    self.jobs[job_id]["duration"] = value
+                self._notify(job_id)
+            elif kind == "spectrum":
+                if self.spectrum_listener:
+                    self.spectrum_listener(job_id, value)
+            else:
+                self._finish(job_id, kind, value)
+                self._assign()
+
+    def _check_workers(self):
+        """Replace the workers which died (for example killed by the OOM killer)"""
+        died = []
+        # under the lock: the HTTP threads assign jobs to the workers at the same time
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                if self.running and not worker.process.is_alive():
+                    if worker.job_id is not None:
+                        died.append(worker.job_id)
+                    self.workers[i] = _Worker(self.mp_context, self.event_queue)
+        for job_id in died:
+            self._finish(job_id, "failed", "worker process died")
+        self._assign()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def _authorized(self):
+        # the jobs read and write any file the service can: only the holder of
+        # the token may submit them, and a browser can't send this header cross-site
+        authorization = self.headers.get("Authorization", "")
+        if hmac.compare_digest(authorization.encode("utf-8"), ("Bearer " + self.server.token).encode("utf-8")):
+            return True
+        self._reply(401, {"error": "missing or wrong token"})
+        return False
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job_id(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs":
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        service = self.server.service
+        if self.path.rstrip("/") == "/jobs":
+            self._reply(200, service.list())
+            return
+        status = service.status(self._job_id())
+        if status is None:
+            self._reply(404, {"error": "no such job"})
+        else:
+            self._reply(200, status)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": "not found"})
+            return
+        if self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+            self._reply(415, {"error": "the job must be application/json"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(params, dict):
+                raise ValueError("The job must be a json object")
+            job_id = self.server.service.submit(params, int(params.get("priority", 0)))
+        except (ValueError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self._reply(202, {"id": job_id})
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        if self.server.service.cancel(self._job_id()):
+            self._reply(200, {"cancelled": True})
+        else:
+            self._reply(409, {"cancelled": False})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=DEFAULT_PORT, workers=None, memory_limit=None, metrics=None):
+    """Run the HTTP service until interrupted"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _RequestHandler)
+    token_file = token_filename(port)
+    server.token = write_token(token_file)
+    service = RenderService(workers, memory_limit=memory_limit, metrics=metrics)
+    server.service = service
+    print ("Paulstretch render service on http://127.0.0.1:%d with %d workers, token in %s"
+           % (port, service.nworkers, token_file))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        try:
+            os.remove(token_file)
+        except OSError:
+            pass
+
+
+def _request(port, method, path, data=None):
+    body = json.dumps(data).encode("utf-8") if data is not None else None
+    try:
+        token = read_token(token_filename(port))
+    except OSError:
+        return {"error": "no token of a service on port %d (is it running?)" % port}
+    request = urllib.request.Request("http://127.0.0.1:%d%s" % (port, path), data=body, method=method,
+                                     headers={"Content-Type": "application/json", "Authorization": "Bearer " + token})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read().decode("utf-8"))
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog serve [--port PORT] [--workers N] [--memory_limit MB]\n"
+                                "       %prog submit [options] input_wav output_wav\n"
+                                "       %prog status|cancel job_id\n"
+                                "       %prog list")
+    parser.add_option("-p", "--port", dest="port",help="port of the service on localhost",type="int",default=DEFAULT_PORT)
+    parser.add_option("-n", "--workers", dest="workers",help="number of worker processes (default: one per CPU)",type="int",default=None)
+    parser.add_option("-M", "--memory_limit", dest="memory_limit",help="refuse the jobs which need more memory (MB, default: the physical memory)",type="float",default=None)
+    parser.add_option("--metrics", dest="metrics",help="add every job to this Prometheus textfile collector file",default=None)
+    parser.add_option("-m", "--method", dest="method",help="processing method (mono, stereo, newmethod)",default="stereo")
+    parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (newmethod only)",type="float",default=10.0)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases",type="int",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("-P", "--priority", dest="priority",help="job priority (higher runs first)",type="int",default=0)
+    (options, args) = parser.parse_args()
+
+    command = args[0] if args else None
+    if command == "serve":
+        serve(options.port, options.workers,
+              options.memory_limit * 1024 * 1024 if options.memory_limit is not None else None, options.metrics)
+    elif command == "submit" and len(args) == 3:
+        reply = _request(options.port, "POST", "/jobs", {
+            "method": options.method, "input": os.path.abspath(args[1]), "output": os.path.abspath(args[2]),
+            "stretch": options.stretch, "window_size": options.window_size, "onset": options.onset,
+            "seed": options.seed, "output_format": options.format, "priority": options.priority})
+        if "id" not in reply:
+            print ("Error: %s" % reply["error"])
+            sys.exit(1)
+        print (reply["id"])
+    elif command == "status" and len(args) == 2:
+        print (json.dumps(_request(options.port, "GET", "/jobs/" + args[1]), indent=1))
+    elif command == "cancel" and len(args) == 2:
+        print (json.dumps(_request(options.port, "DELETE", "/jobs/" + args[1])))
+    elif command == "list":
+        for job in _request(options.port, "GET", "/jobs"):
+            throughput = "%.1fx" % job["throughput"] if job.get("throughput") else "-"
+            if job["state"] == "queued" and job.get("estimate"):
+                throughput = "~" + paulstretch_estimate.format_seconds(job["estimate"]["seconds"])
+            print ("%s %-9s %3d %% %7s %s" % (job["id"], job["state"], job["progress"], throughput, job["params"]["output"]))
+    else:
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+Distributed rendering through a shared job directory.
+
+A coordinator splits a render into chunks of output hops and publishes them
+in a job directory on a shared filesystem. Worker processes on any host
+which sees the directory claim chunks, render them with a RangeRenderer and
+commit them, and a final pass concatenates the encoded chunks into the
+output file without decoding or encoding them again.
+
+Each chunk is rendered from one hop before its start (the overlap-add
+context) and takes the random phases of its hops at their positions in the
+random stream of the render's seed, so the output is identical to a render
+by the engine on one machine with the same seed (one is chosen when none is
+given). With dither each chunk has its own dither seed, derived from the
+render's seed and the chunk number. The hop schedule of the new method
+depends on the onsets of all the input before a hop, so the coordinator
+computes it once (forward FFTs only) and publishes it with the job.
+
+Claims and commits are renames, which are atomic on a shared filesystem,
+so nothing else is needed to coordinate the workers:
+
+    job_dir/job.json         parameters of the render
+    job_dir/input.wav        copy of the input
+    job_dir/schedule.npz     hop schedule (new method)
+    job_dir/todo/000012      chunk 12, waiting for a worker
+    job_dir/claimed/000012   chunk 12, being rendered (its mtime is the worker's heartbeat)
+    job_dir/done/000012.raw  encoded frames of chunk 12
+
+A chunk whose worker died is put back with requeue. Chunks are
+deterministic, so a chunk rendered twice is committed twice with the same
+bytes.
+
+    python paulstretch_distributed.py submit -s 50 -r 1 input.wav output.wav /shared/job1
+    python paulstretch_distributed.py work /shared/job1      # on any number of hosts
+    python paulstretch_distributed.py assemble /shared/job1
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import multiprocessing
+import numpy as np
+from optparse import OptionParser
+
+import paulstretch_methods
+from paulstretch_range import RangeRenderer
+from paulstretch_wavwriter import FORMATS, Encoder, WavWriter
+
+# seconds between the heartbeats of a worker, and without one before a claim is stale
+HEARTBEAT_SECONDS = 10.0
+STALE_SECONDS = 60.0
+
+
+def _path(job_dir, *names):
+    return os.path.join(job_dir, *names)
+
+
+def _chunk_name(chunk):
+    return "%06d" % chunk
+
+
+def _write_atomically(filename, write):
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+def load_job(job_dir):
+    with open(_path(job_dir, "job.json")) as f:
+        return json.load(f)
+
+
+def submit(input_filename, output_filename, job_dir, method="stereo", stretch=8.0, windowsize_seconds=0.25,
+           onset_level=10.0, seed=None, silence_threshold=0.0, output_format="pcm16", dither=False,
+           chunk_seconds=60.0):
+    """Publish a render in job_dir as chunks of about chunk_seconds of output, return the job"""
+    if method not in paulstretch_methods.METHODS:
+        raise ValueError("Unknown method: %s" % method)
+    if output_format not in FORMATS:
+        raise ValueError("Unknown output format: %s" % output_format)
+    if os.path.exists(_path(job_dir, "job.json")):
+        raise ValueError("%s already holds a job" % job_dir)
+    for name in ("todo", "claimed", "done"):
+        os.makedirs(_path(job_dir, name), exist_ok=True)
+    shutil.copyfile(input_filename, _path(job_dir, "input.wav"))
+
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1)[0])
+    samplerate, smp = paulstretch_methods.load_wav(method, _path(job_dir, "input.wav"))
+    renderer = RangeRenderer(samplerate, smp, stretch, windowsize_seconds, method, onset_level, seed, silence_threshold)
+    total_hops = renderer.total_hops()
+    if method == "newmethod":
+        hop_frame, hop_tick = renderer.schedule()
+        _write_atomically(_path(job_dir, "schedule.npz"), lambda f: np.savez(f, hop_frame=hop_frame, hop_tick=hop_tick))
+
+    chunk_hops = max(1, int(round(chunk_seconds * samplerate / renderer.half_windowsize)))
+    job = {
+        "method": method,
+        "stretch": float(stretch),
+        "window_size": float(windowsize_seconds),
+        "onset": float(onset_level),
+        "seed": seed,
+        "silence_threshold": float(silence_threshold),
+        "output_format": output_format,
+        "dither": bool(dither),
+        "output": os.path.abspath(output_filename),
+        "samplerate": int(samplerate),
+        "nchannels": renderer.nchannels,
+        "nsamples": renderer.nsamples,
+        "half_windowsize": renderer.half_windowsize,
+        "total_hops": total_hops,
+        "chunk_hops": chunk_hops,
+        "nchunks": (total_hops + chunk_hops - 1) // chunk_hops,
+    }
+    # the job file first: a worker which sees a chunk can read its job
+    _write_atomically(_path(job_dir, "job.json"), lambda f: f.write(json.dumps(job, indent=1).encode("utf-8")))
+    for chunk in range(job["nchunks"]):
+        open(_path(job_dir, "todo", _chunk_name(chunk)), "wb").close()
+    return job
+
+
+def make_renderer(job_dir, job):
+    """The RangeRenderer of a job, with the published schedule"""
+    samplerate, smp = paulstretch_methods.load_wav(job["method"], _path(job_dir, "input.wav"))
+    renderer = RangeRenderer(samplerate, smp, job["stretch"], job["window_size"], job["method"], job["onset"],
+                             job["seed"], job["silence_threshold"])
+    if renderer.nsamples != job["nsamples"] or renderer.half_windowsize != job["half_windowsize"]:
+        raise ValueError("The input of %s doesn't match its job" % job_dir)
+    if job["method"] == "newmethod":
+        with np.load(_path(job_dir, "schedule.npz")) as schedule:
+            renderer.set_schedule(schedule["hop_frame"], schedule["hop_tick"])
+    return renderer
+
+
+def claim(job_dir, worker_name):
+    """Claim a waiting chunk, return its number (None when there is none left)"""
+    for name in sorted(os.listdir(_path(job_dir, "todo"))):
+        claimed = _path(job_dir, "claimed", name)
+        try:
+            os.rename(_path(job_dir, "todo", name), claimed)
+        except OSError:
+            # another worker was faster
+            continue
+        with open(claimed, "w") as f:
+            f.write(worker_name)
+        return int(name)
+    return None
+
+
+def render_chunk(job_dir, job, renderer, chunk, worker_name, heartbeat=HEARTBEAT_SECONDS):
+    """Render a claimed chunk and commit it"""
+    hop0 = chunk * job["chunk_hops"]
+    hop1 = min(hop0 + job["chunk_hops"], job["total_hops"])
+    encoder = Encoder(job["output_format"], job["dither"], [job["seed"], 1, chunk])
+    claimed = _path(job_dir, "claimed", _chunk_name(chunk))
+    done = _path(job_dir, "done", _chunk_name(chunk) + ".raw")
+    temp_filename = "%s.%s.tmp" % (done, worker_name)
+    last_heartbeat = time.monotonic()
+    with open(temp_filename, "wb", buffering=1 << 20) as f:
+        for output in renderer.iter_hops(hop0, hop1):
+            f.write(encoder.encode(output))
+            if time.monotonic() - last_heartbeat >= heartbeat:
+                last_heartbeat = time.monotonic()
+                try:
+                    os.utime(claimed)
+                except OSError:
+                    # requeued meanwhile; finish anyway, the commit is the same
+                    pass
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, done)
+    try:
+        os.remove(claimed)
+    except OSError:
+        pass
+
+
+def work(job_dir, worker_name=None, wait=False, poll=5.0, stream=sys.stdout):
+    """Render chunks of the job until none is waiting (with wait: until all are done), return their count"""
+    if worker_name is None:
+        worker_name = "%s-%d" % (socket.gethostname(), os.getpid())
+    job = load_job(job_dir)
+    renderer = None
+    count = 0
+    while True:
+        chunk = claim(job_dir, worker_name)
+        if chunk is None:
+            if not wait or status(job_dir)["done"] == job["nchunks"]:
+                return count
+            time.sleep(poll)
+            continue
+        if renderer is None:
+            renderer = make_renderer(job_dir, job)
+        start_time = time.time()
+        render_chunk(job_dir, job, renderer, chunk, worker_name)
+        count += 1
+        stream.write("%s: chunk %d of %d done in %.1f s\n" % (worker_name, chunk + 1, job["nchunks"], time.time() - start_time))
+        stream.flush()
+
+
+def status(job_dir, stale_seconds=STALE_SECONDS):
+    """Number of waiting, claimed (and stale among them) and done chunks"""
+    now = time.time()
+    claimed = os.listdir(_path(job_dir, "claimed"))
+    stale = 0
+    for name in claimed:
+        try:
+            if now - os.path.getmtime(_path(job_dir, "claimed", name)) > stale_seconds:
+                stale += 1
+        except OSError:
+            pass
+    return {
+        "todo": len(os.listdir(_path(job_dir, "todo"))),
+        "claimed": len(claimed),
+        "stale": stale,
+        "done": len([name for name in os.listdir(_path(job_dir, "done")) if name.endswith(".raw")]),
+        "nchunks": load_job(job_dir)["nchunks"],
+    }
+
+
+def requeue(job_dir, stale_seconds=STALE_SECONDS):
+    """Put back the claimed chunks without a heartbeat for stale_seconds (their worker died), return their count"""
+    now = time.time()
+    count = 0
+    for name in os.listdir(_path(job_dir, "claimed")):
+        claimed = _path(job_dir, "claimed", name)
+        try:
+            if now - os.path.getmtime(claimed) > stale_seconds:
+                os.rename(claimed, _path(job_dir, "todo", name))
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def assemble(job_dir, output_filename=None, remove=False):
+    """Concatenate the committed chunks into the output wav, return its file name"""
+    job = load_job(job_dir)
+    output_filename = output_filename or job["output"]
+    frame_size = job["nchannels"] * FORMATS[job["output_format"]][0]
+    chunk_files = []
+    for chunk in range(job["nchunks"]):
+        filename = _path(job_dir, "done", _chunk_name(chunk) + ".raw")
+        nhops = min(job["chunk_hops"], job["total_hops"] - chunk * job["chunk_hops"])
+        if not os.path.exists(filename):
+            raise ValueError("Chunk %d of %s is not rendered yet" % (chunk, job_dir))
+        if os.path.getsize(filename) != nhops * job["half_windowsize"] * frame_size:
+            raise ValueError("Chunk %d of %s has a wrong size" % (chunk, job_dir))
+        chunk_files.append(filename)
+
+    with WavWriter(output_filename, job["samplerate"], job["nchannels"], job["output_format"],
+                   expected_frames=job["total_hops"] * job["half_windowsize"]) as outfile:
+        for filename in chunk_files:
+            with open(filename, "rb") as f:
+                while True:
+                    block = f.read(1 << 22)
+                    if not block:
+                        break
+                    outfile.writeframes(block)
+    if remove:
+        shutil.rmtree(job_dir)
+    return output_filename
+
+
+def _local_worker(job_dir):
+    work(job_dir)
+
+
+def run(input_filename, output_filename, job_dir, workers=None, stream=sys.stdout, **params):
+    """Submit, render with local worker processes (more can join from other hosts) and assemble"""
+    job = submit(input_filename, output_filename, job_dir, **params)
+    stream.write("%d chunks of %d hops\n" % (job["nchunks"], job["chunk_hops"]))
+    mp_context = multiprocessing.get_context("spawn")
+    processes = [mp_context.Process(target=_local_worker, args=(job_dir,)) for _ in range(workers or os.cpu_count() or 1)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    counts = status(job_dir)
+    if counts["done"] != job["nchunks"]:
+        raise ValueError("%d chunks of %s are not rendered (workers on other hosts may still be busy)"
+                         % (job["nchunks"] - counts["done"], job_dir))
+    return assemble(job_dir, remove=True)
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog submit [options] input_wav output_wav job_dir\n"
+                                "       %prog work [--wait] job_dir\n"
+                                "       %prog status|requeue job_dir\n"
+                                "       %prog assemble [--keep] job_dir\n"
+                                "       %prog run [options] input_wav output_wav job_dir")
+    parser.add_option("-m", "--method", dest="method",help="processing method (mono, stereo, newmethod)",default="stereo")
+    parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (newmethod only)",type="float",default=10.0)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases (default: a random one, recorded in the job)",type="int",default=None)
+    parser.add_option("-q", "--silence_threshold", dest="silence_threshold",help="skip the frames quieter than this RMS level (dB, e.g. -80)",type="float",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("--dither", dest="dither",help="add TPDF dither to the integer output formats",action="store_true",default=False)
+    parser.add_option("-c", "--chunk", dest="chunk",help="length of the chunks (seconds of output)",type="float",default=60.0)
+    parser.add_option("-j", "--jobs", dest="jobs",help="local worker processes of run (default: one per CPU)",type="int",default=None)
+    parser.add_option("-S", "--stale", dest="stale",help="seconds without a heartbeat before a claim is stale",type="float",default=STALE_SECONDS)
+    parser.add_option("--wait", dest="wait",help="keep waiting for requeued chunks until the job is done",action="store_true",default=False)
+    parser.add_option("-k", "--keep", dest="keep",help="keep the job directory after assembling",action="store_true",default=False)
+    (options, args) = parser.parse_args()
+
+    command = args[0] if args else None
+    silence_threshold = 0.0
+    if options.silence_threshold is not None:
+        silence_threshold = pow(10.0, options.silence_threshold / 20.0)
+    params = dict(method=options.method, stretch=options.stretch, windowsize_seconds=options.window_size,
+                  onset_level=options.onset, seed=options.seed, silence_threshold=silence_threshold,
+                  output_format=options.format, dither=options.dither, chunk_seconds=options.chunk)
+    if ((options.method not in paulstretch_methods.METHODS) or (options.stretch<=0.0) or (options.window_size<=0.001)
+            or (options.format not in FORMATS) or (options.chunk<=0.0)):
+        command = None
+
+    try:
+        if command == "submit" and len(args) == 4:
+            job = submit(args[1], args[2], args[3], **params)
+            print ("%s: %d chunks, seed %d" % (args[3], job["nchunks"], job["seed"]))
+        elif command == "work" and len(args) == 2:
+            print ("%d chunks rendered" % work(args[1], wait=options.wait))
+        elif command == "status" and len(args) == 2:
+            counts = status(args[1], options.stale)
+            print ("%(done)d of %(nchunks)d chunks done, %(claimed)d being rendered (%(stale)d stale), %(todo)d waiting" % counts)
+        elif command == "requeue" and len(args) == 2:
+            print ("%d stale chunks requeued" % requeue(args[1], options.stale))
+        elif command == "assemble" and len(args) == 2:
+            print (assemble(args[1], remove=not options.keep))
+        elif command == "run" and len(args) == 4:
+            print (run(args[1], args[2], args[3], options.jobs, **params))
+        else:
+            print ("Error in command line parameters. Run this program with --help for help.")
+            sys.exit(1)
+    except ValueError as e:
+        print ("Error: %s" % e)
+        sys.exit(1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Draft quality renders for fast previews and parameter searches.
+
+The input is decimated by an integer factor, the regular engine is run at
+the reduced sample rate with the same window size in seconds (so the FFT
+size shrinks by the same factor) and the result is optionally resampled
+back to the original rate.
+
+The reported speedup is measured: a short slice of the input is rendered
+at full quality (without output) and its time per second of output is
+scaled to the length of the draft's output. The per hop overhead of the
+engines doesn't shrink with the FFT size, an n log2 n ratio would overstate
+the gain.
+"""
+import os
+import time
+import tempfile
+import scipy.signal
+
+import paulstretch_methods
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
+
+DRAFT_FACTORS = (1, 2, 4, 8)
+
+# hops of the full quality slice timed for the speedup
+TIMING_HOPS = 64
+
+
+class DraftReport:
+    """Timings and the speedup of a draft render
+
+    total_time includes everything the draft path costs, the timed full
+    quality slice too (slice_time of it).
+    """
+    def __init__(self, factor, samplerate, draft_samplerate, fft_size, draft_fft_size, engine_time, total_time,
+                 full_engine_time, slice_time=0.0):
+        self.factor = factor
+        self.samplerate = samplerate
+        self.draft_samplerate = draft_samplerate
+        self.fft_size = fft_size
+        self.draft_fft_size = draft_fft_size
+        self.engine_time = engine_time
+        self.total_time = total_time
+        # the engine time of the full quality render, from the timed slice
+        self.full_engine_time = full_engine_time
+        self.slice_time = slice_time
+
+    @property
+    def speedup(self):
+        """Speedup over a full quality render (its engine time over the draft's total time)"""
+        if self.total_time <= 0.0:
+            return 1.0
+        return self.full_engine_time / self.total_time
+
+    def __str__(self):
+        return ("draft 1/%d: %d Hz, FFT size %d instead of %d, %.2f s including %.2f s of timing (speedup %.1fx)"
+                % (self.factor, self.draft_samplerate, self.draft_fft_size, self.fft_size, self.total_time,
+                   self.slice_time, self.speedup))
+
+
+def fft_size(samplerate, windowsize_seconds, method):
+    """The window size the engine will use for these parameters"""
+    windowsize = int(windowsize_seconds * samplerate)
+    if windowsize < 16:
+        windowsize = 16
+    if method != "mono":
+        windowsize = paulstretch_methods.get_engine(method).optimize_windowsize(windowsize)
+    return int(windowsize / 2) * 2
+
+
+def time_full_quality(method, samplerate, smp, stretch, windowsize_seconds, onset_level, context):
+    """Seconds of engine time per second of output of a full quality render, timed on a slice of smp"""
+    windowsize = fft_size(samplerate, windowsize_seconds, method)
+    nsamples = smp.shape[-1]
+    length = min(nsamples, max(2 * windowsize, int(TIMING_HOPS * windowsize * 0.5 / max(stretch, 1.0)) + windowsize))
+    # from the middle, the start and the end are often quiet
+    start = (nsamples - length) // 2
+    timing_context = RenderContext(seed=context.seed, progress=lambda percentage: None,
+                                   silence_threshold=context.silence_threshold)
+    # the timing render is not a run of its own
+    timing_context.metrics = None
+    t0 = time.perf_counter()
+    paulstretch_methods.run(method, samplerate, smp[..., start:start + length].copy(), stretch, windowsize_seconds,
+                            None, onset_level, timing_context)
+    seconds = time.perf_counter() - t0
+    return seconds / (timing_context.frames_processed / float(samplerate))
+
+
+def decimate(smp, factor):
+    """Low-pass filter and downsample the samples (last axis) by an integer factor"""
+    if factor == 1:
+        return smp.copy()
+    return scipy.signal.resample_poly(smp, 1, factor, axis=-1)
+
+
+def draft_paulstretch(method, samplerate, smp, stretch, windowsize_seconds, outfilename,
+                      onset_level=10.0, factor=4, upsample=True, **options):
+    """Render a draft of the stretched sound and return a DraftReport
+
+    With upsample=False the output file keeps the reduced sample rate,
+    which is enough for listening tests and is faster to write. Upsampled,
+    the engine renders to a float32 temporary file in a context of its own
+    and the output format, dither, normalization and run record of the
+    context only apply to the final output.
+    """
+    if factor not in DRAFT_FACTORS:
+        raise ValueError("Draft factor must be one of %s" % (DRAFT_FACTORS,))
+
+    context = options.pop("context", None)
+    if context is None:
+        context = RenderContext(**options)
+
+    start_time = time.time()
+    full_time_per_second = None
+    if factor > 1:
+        full_time_per_second = time_full_quality(method, samplerate, smp, stretch, windowsize_seconds, onset_level, context)
+    slice_time = time.time() - start_time
+
+    draft_samplerate = int(round(samplerate / float(factor)))
+    draft_smp = decimate(smp, factor)
+
+    if not (upsample and factor > 1):
+        engine_start = time.time()
+        paulstretch_methods.run(method, draft_samplerate, draft_smp, stretch, windowsize_seconds,
+                                outfilename, onset_level, context)
+        engine_time = time.time() - engine_start
+        draft_seconds = context.frames_processed / float(draft_samplerate)
+    else:
+        fd, draft_filename = tempfile.mkstemp(suffix=".wav", prefix="paulstretch_draft_")
+        os.close(fd)
+        # unquantized, without manifest, metrics or checkpoints: only the final output is the render
+        draft_context = RenderContext(seed=context.seed, progress=context.progress_callback,
+                                      silence_threshold=context.silence_threshold, stream=context.stream,
+                                      output_format="float32", spectrum_callback=context.spectrum_callback)
+        draft_context.metrics = None
+        draft_context.cancel_event = context.cancel_event
+        params = {"engine": method, "samplerate": samplerate, "nsamples": smp.shape[-1], "stretch": stretch,
+                  "windowsize_seconds": windowsize_seconds, "windowsize": fft_size(draft_samplerate, windowsize_seconds, method),
+                  "draft_factor": factor}
+        if method == "newmethod":
+            params["onset_level"] = onset_level
+        context.start_run(params)
+        try:
+            engine_start = time.time()
+            paulstretch_methods.run(method, draft_samplerate, draft_smp, stretch, windowsize_seconds,
+                                    draft_filename, onset_level, draft_context)
+            engine_time = time.time() - engine_start
+            draft_seconds = draft_context.frames_processed / float(draft_samplerate)
+
+            rate, data = paulstretch_wavreader.read(draft_filename)
+        finally:
+            os.remove(draft_filename)
+        output = scipy.signal.resample_poly(data, factor, 1, axis=0).T
+        nchannels = output.shape[0] if output.ndim > 1 else 1
+        with context.open_output(outfilename, samplerate, nchannels) as outfile:
+            outfile.write(output)
+        context.write_output(output)
+        context.render_complete()
+
+    total_time = time.time() - start_time
+    full_engine_time = engine_time if full_time_per_second is None else full_time_per_second * draft_seconds
+    return DraftReport(factor, samplerate, draft_samplerate,
+                       fft_size(samplerate, windowsize_seconds, method),
+                       fft_size(draft_samplerate, windowsize_seconds, method),
+                       engine_time, total_time, full_engine_time, slice_time)
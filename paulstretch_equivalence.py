@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+Statistical equivalence of an engine with the reference loops.
+
+The random phases make every render different, so a faster engine can't be
+compared with the original sample by sample. This renders synthetic signals
+with the candidate engine and with the reference loops of
+paulstretch_reference.py and compares what doesn't depend on the phases:
+
+    length      output frames
+    ltas        long term average magnitude spectrum, third octave bands (dB)
+    envelope    RMS level over time, 50 ms blocks (dB)
+    onsets      times of the attacks in the output (new method)
+    clipping    samples at or over full scale
+
+A metric passes when the candidate is within its tolerance of the
+reference, or within twice the difference between two renders of the
+reference with different seeds (what the random phases alone change). Two
+renders of the candidate with the same seed must be identical, and
+different seeds must give different outputs. A candidate which draws the
+random phases in the reference's order is reported as identical.
+
+    python paulstretch_equivalence.py                      # the engines against the references
+    python paulstretch_equivalence.py -c my_engine -m stereo  # my_engine.paulstretch for the stereo method
+"""
+import os
+import sys
+import time
+import shutil
+import importlib
+import tempfile
+from optparse import OptionParser
+
+import numpy as np
+
+import paulstretch_methods
+import paulstretch_reference
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
+
+SAMPLERATE = 44100
+STRETCH = 4.0
+WINDOW_SIZE = 0.1
+
+# metric -> absolute tolerance of the difference with the reference
+TOLERANCES = {
+    "length": 0,          # frames
+    "ltas": 1.0,          # dB, largest band difference
+    "envelope": 1.5,      # dB, mean difference
+    "onsets": 0.05,       # seconds, largest shift (and the same count)
+    "clipping": 0.01,     # fraction of the samples
+}
+# the random variation between two seeds of the reference, times this, is tolerated too
+BASELINE_FACTOR = 2.0
+
+
+########################################
+# synthetic signals: stereo, samples x 2 (like a wav file), in -1..1
+
+def _chord(n):
+    t = np.arange(n) / float(SAMPLERATE)
+    left = sum(0.12 * np.sin(2 * np.pi * f * t) for f in (220.0, 277.2, 329.6, 440.0))
+    right = sum(0.12 * np.sin(2 * np.pi * f * t) for f in (110.0, 164.8, 659.3, 1318.5))
+    return np.stack([left, right], axis=1)
+
+
+def _noise_envelope(n):
+    # noise, 1/f tilted, with a slow swell and decay
+    rng = np.random.default_rng(10)
+    spectrum = np.fft.rfft(rng.standard_normal((2, n)))
+    spectrum /= np.sqrt(np.maximum(np.arange(spectrum.shape[1]), 1.0))
+    noise = np.fft.irfft(spectrum, n)
+    noise *= 0.3 / noise.std()
+    envelope = np.interp(np.arange(n), [0, n * 0.3, n * 0.6, n], [0.05, 1.0, 1.0, 0.1])
+    return (noise * envelope).T
+
+
+def _bursts(n):
+    # decaying tone and noise bursts every half second, digital silence between them
+    rng = np.random.default_rng(11)
+    out = np.zeros((n, 2))
+    length = int(0.2 * SAMPLERATE)
+    t = np.arange(length) / float(SAMPLERATE)
+    decay = np.exp(-t * 25.0)
+    for i, start in enumerate(range(int(0.25 * SAMPLERATE), n - length, int(0.5 * SAMPLERATE))):
+        burst = 0.5 * np.sin(2 * np.pi * (300.0 + 100.0 * i) * t) + 0.2 * rng.standard_normal(length)
+        out[start:start + length] += (burst * decay)[:, None]
+    return out
+
+
+def _loud(n):
+    # full scale noise and tone, the output clips
+    rng = np.random.default_rng(12)
+    t = np.arange(n) / float(SAMPLERATE)
+    tone = 0.6 * np.sin(2 * np.pi * 100.0 * t)
+    return np.clip(tone[:, None] + 0.5 * rng.standard_normal((n, 2)), -1.0, 1.0)
+
+
+SIGNALS = {
+    "chord": _chord,
+    "noise": _noise_envelope,
+    "bursts": _bursts,
+    "loud": _loud,
+}
+
+# (name, signal, onset level, silence threshold of the candidate), the
+# reference never skips frames, a skipping candidate must not sound different
+CASES = [
+    ("chord", "chord", 10.0, 0.0),
+    ("noise", "noise", 10.0, 0.0),
+    ("bursts", "bursts", 0.3, 0.0),
+    ("bursts/skip", "bursts", 0.3, 1e-4),
+    ("loud", "loud", 10.0, 0.0),
+]
+
+
+def engine_input(method, signal):
+    """The samples in the layout load_wav gives the engine"""
+    if method == "mono":
+        return (signal[:, 0] + signal[:, 1]) * 0.5
+    return signal.T.copy()
+
+
+########################################
+# metrics
+
+def ltas(x):
+    """Long term average magnitude spectrum in third octave bands (dB), frames x channels input"""
+    size = 4096
+    window = np.hanning(size)
+    mono = x.mean(axis=1)
+    nframes = max(1, (len(mono) - size) // (size // 2) + 1)
+    power = np.zeros(size // 2 + 1)
+    for i in range(nframes):
+        frame = mono[i * size // 2:i * size // 2 + size]
+        frame = np.append(frame, np.zeros(size - len(frame)))
+        power += np.abs(np.fft.rfft(frame * window)) ** 2
+    power /= nframes
+    freqs = np.fft.rfftfreq(size, 1.0 / SAMPLERATE)
+    edges = 40.0 * 2.0 ** (np.arange(0, 30) / 3.0)
+    edges = edges[edges < SAMPLERATE / 2.0]
+    bands = np.array([power[(freqs >= a) & (freqs < b)].mean() for a, b in zip(edges[:-1], edges[1:])])
+    return 10.0 * np.log10(bands + 1e-20)
+
+
+def envelope(x, block_seconds=0.05):
+    """RMS level (dB) of consecutive blocks"""
+    block = int(block_seconds * SAMPLERATE)
+    n = len(x) // block * block
+    rms = np.sqrt((x[:n].reshape(-1, block, x.shape[1]) ** 2).mean(axis=(1, 2)))
+    return 20.0 * np.log10(rms + 1e-5)
+
+
+def onsets(x, block_seconds=0.01):
+    """Times (seconds) where the level rises through 20 dB under the peak, after falling 30 dB under it"""
+    levels = envelope(x, block_seconds)
+    peak = levels.max()
+    times = []
+    armed = True
+    for i, level in enumerate(levels):
+        if armed and level > peak - 20.0:
+            times.append(i * block_seconds)
+            armed = False
+        elif level < peak - 30.0:
+            armed = True
+    return np.array(times)
+
+
+def onset_shift(a, b):
+    """Largest time difference of matching onsets, infinite when their counts differ"""
+    if len(a) != len(b):
+        return float("inf")
+    return float(np.abs(a - b).max()) if len(a) else 0.0
+
+
+def clipping(x):
+    return float(np.mean(np.abs(x) >= 1.0))
+
+
+def compare(a, b, method):
+    """{metric: difference} between two outputs (frames x channels)"""
+    n = min(len(a), len(b))
+    la, lb = ltas(a[:n]), ltas(b[:n])
+    audible = np.maximum(la, lb) > max(la.max(), lb.max()) - 60.0
+    ea, eb = envelope(a[:n]), envelope(b[:n])
+    loud = np.maximum(ea, eb) > max(ea.max(), eb.max()) - 50.0
+    differences = {
+        "length": abs(len(a) - len(b)),
+        "ltas": float(np.abs(la - lb)[audible].max()) if audible.any() else 0.0,
+        "envelope": float(np.abs(ea - eb)[loud].mean()) if loud.any() else 0.0,
+        "clipping": abs(clipping(a) - clipping(b)),
+    }
+    if method == "newmethod":
+        differences["onsets"] = onset_shift(onsets(a), onsets(b))
+    return differences
+
+
+########################################
+
+def render(function, method, smp, onset_level, filename, seed, silence_threshold=0.0):
+    """Render with an engine's paulstretch function to a float32 file, return (frames x channels, seconds)"""
+    context = RenderContext(seed=seed, progress=lambda percentage: None, output_format="float32",
+                            silence_threshold=silence_threshold)
+    t0 = time.perf_counter()
+    if method == "newmethod":
+        function(SAMPLERATE, smp.copy(), STRETCH, WINDOW_SIZE, onset_level, filename, context)
+    else:
+        function(SAMPLERATE, smp.copy(), STRETCH, WINDOW_SIZE, filename, context)
+    seconds = time.perf_counter() - t0
+    data = paulstretch_wavreader.read(filename)[1].astype(float)
+    return (data.reshape(-1, 1) if data.ndim == 1 else data), seconds
+
+
+def load_candidate(spec, method):
+    """The paulstretch function of a module name (or module:function), the engine's by default"""
+    if spec is None:
+        return paulstretch_methods.get_engine(method).paulstretch
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name or "paulstretch")
+
+
+def check_method(method, candidate, seconds, directory, stream=sys.stdout):
+    """Compare a candidate with the reference of a method on all the cases, return the list of failures"""
+    reference = paulstretch_reference.REFERENCES[method]
+    failures = []
+    for name, signal_name, onset_level, silence_threshold in CASES:
+        smp = engine_input(method, SIGNALS[signal_name](int(seconds * SAMPLERATE)))
+        path = lambda label: os.path.join(directory, "%s_%s.wav" % (label, name.replace("/", "_")))
+
+        ref, ref_seconds = render(reference, method, smp, onset_level, path("ref1"), 1)
+        ref2, _ = render(reference, method, smp, onset_level, path("ref2"), 2)
+        cand, cand_seconds = render(candidate, method, smp, onset_level, path("cand1"), 1, silence_threshold)
+        cand_again, _ = render(candidate, method, smp, onset_level, path("cand1b"), 1, silence_threshold)
+        cand2, _ = render(candidate, method, smp, onset_level, path("cand2"), 2, silence_threshold)
+
+        differences = compare(cand, ref, method)
+        baseline = compare(ref2, ref, method)
+        identical = cand.shape == ref.shape and np.array_equal(cand, ref)
+        stream.write("%s %s: %s, %.2f s (reference %.2f s)\n" % (
+            method, name, "identical to the reference" if identical else "differs from the reference",
+            cand_seconds, ref_seconds))
+        for metric in sorted(differences):
+            limit = max(TOLERANCES[metric], BASELINE_FACTOR * baseline[metric])
+            ok = differences[metric] <= limit
+            stream.write("    %-9s %10.4g  baseline %10.4g  limit %10.4g  %s\n" % (
+                metric, differences[metric], baseline[metric], limit, "ok" if ok else "FAIL"))
+            if not ok:
+                failures.append("%s %s: %s %.4g over %.4g" % (method, name, metric, differences[metric], limit))
+        if not (cand.shape == cand_again.shape and np.array_equal(cand, cand_again)):
+            failures.append("%s %s: two renders with the same seed differ" % (method, name))
+        if cand.shape == cand2.shape and np.array_equal(cand, cand2):
+            failures.append("%s %s: renders with different seeds are identical" % (method, name))
+    return failures
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-m", "--methods", dest="methods",help="comma separated methods",default=",".join(paulstretch_methods.METHODS))
+    parser.add_option("-c", "--candidate", dest="candidate",help="module (or module:function) with the candidate paulstretch(), default: the engine of the method",default=None)
+    parser.add_option("-l", "--length", dest="length",help="length of the synthetic inputs (seconds)",type="float",default=4.0)
+    (options, args) = parser.parse_args()
+
+    methods = [method for method in options.methods.split(",") if method]
+    if not methods or [method for method in methods if method not in paulstretch_methods.METHODS] or options.length < 1.0:
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    directory = tempfile.mkdtemp(prefix="paulstretch_equivalence_")
+    failures = []
+    try:
+        for method in methods:
+            failures.extend(check_method(method, load_candidate(options.candidate, method), options.length, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if failures:
+        print ("")
+        for failure in failures:
+            print ("FAIL %s" % failure)
+        sys.exit(1)
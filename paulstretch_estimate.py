@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""
+Cost model of a render: frames, FFTs, output size, memory and time.
+
+estimate() computes from the header of the input wav (nothing else is
+read) and the render parameters what the engine will do: the window size
+it will use, the number of hops and FFTs, the size of the output file and
+of the normalization scratch file, and the peak memory of the process
+(loading the input, then the samples plus the working memory of the
+engine). These follow the engines' code and don't depend on the machine.
+
+The time is estimated from the hops and the FFT work with the per-machine
+coefficients of a calibration profile, made by running short renders of
+every method with several window sizes (calibrate(), or
+paulstretch_estimate.py --calibrate) and stored in
+~/.config/paulstretch/calibration.json (or $PAULSTRETCH_CALIBRATION).
+Without a profile, built-in coefficients measured on one x86_64 machine
+are used.
+The frames skipped by the silence threshold are not known before the
+render, the time is for a render which skips none.
+
+    python paulstretch_estimate.py -m newmethod -s 20 -w 0.5 input.wav
+    python paulstretch_estimate.py --calibrate
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import platform
+import tempfile
+from optparse import OptionParser
+
+import numpy as np
+
+import paulstretch_methods
+import paulstretch_wavreader
+from paulstretch_wavwriter import FORMATS, _HEADER_SIZE
+
+DEFAULT_PROFILE = os.path.join(os.path.expanduser("~"), ".config", "paulstretch", "calibration.json")
+PROFILE_VERSION = 1
+
+# seconds per hop (the Python work of a hop) and per FFT point and channel
+# (N log2 N for one FFT of N points), used when no calibration was made
+DEFAULT_COEFFICIENTS = {
+    "mono": {"per_hop": 6.7e-5, "per_fft_point": 2.5e-9},
+    "stereo": {"per_hop": 1.0e-4, "per_fft_point": 2.0e-9},
+    "newmethod": {"per_hop": 5.0e-5, "per_fft_point": 3.7e-9},
+}
+DEFAULT_LOAD_PER_BYTE = 8.0e-10
+
+# memory of the interpreter with numpy and an engine imported, plus what
+# the allocator keeps of the freed load buffers
+BASELINE_BYTES = 36 * 1024 * 1024
+# working memory of a render: a constant (output buffers, writer, batches
+# of the new method) plus bytes per window sample and channel, measured
+# with paulstretch_memory.py
+WORKING_MEMORY = {
+    "mono": (1.85e6, 66.0),
+    "stereo": (1.92e6, 50.0),
+    "newmethod": (7.6e6, 50.0),
+}
+# frames per block of the normalization pass (see NormalizingWriter)
+NORMALIZE_BLOCK_FRAMES = 1 << 18
+
+# calibration renders: input length (seconds), stretch and window sizes
+CALIBRATION_SECONDS = 4.0
+CALIBRATION_STRETCH = 4.0
+CALIBRATION_WINDOWS = (0.02, 0.05, 0.2, 0.8)
+
+
+def window_size(method, samplerate, windowsize_seconds):
+    """The window size (samples) the engine of a method uses"""
+    windowsize = int(windowsize_seconds * samplerate)
+    if windowsize < 16:
+        windowsize = 16
+    if method != "mono":
+        windowsize = paulstretch_methods.get_engine(method).optimize_windowsize(windowsize)
+    return int(windowsize / 2) * 2
+
+
+def load_profile(filename=None):
+    """Return the calibration profile, or the default one if there is none"""
+    filename = filename or os.environ.get("PAULSTRETCH_CALIBRATION", DEFAULT_PROFILE)
+    try:
+        with open(filename) as f:
+            profile = json.load(f)
+        if profile.get("version") == PROFILE_VERSION:
+            return profile
+    except (OSError, ValueError):
+        pass
+    return {"version": PROFILE_VERSION, "calibrated": False, "methods": DEFAULT_COEFFICIENTS,
+            "load_per_byte": DEFAULT_LOAD_PER_BYTE}
+
+
+def save_profile(profile, filename=None):
+    filename = filename or os.environ.get("PAULSTRETCH_CALIBRATION", DEFAULT_PROFILE)
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    # write and rename, so a crash never leaves a truncated profile
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(profile, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_filename, filename)
+
+
+def estimate(input_filename, method="stereo", stretch=8.0, windowsize_seconds=0.25, output_format="pcm16",
+             normalize=False, profile=None, info=None, onset_level=10.0):
+    """Estimate the cost of a render from the header of its input
+
+    Returns a dict with the window size, the hops and FFTs, the output
+    length and size (bytes), the scratch space of the normalization, the
+    peak memory of the process (bytes) and the time (seconds). info can be
+    given instead of reading the header (see paulstretch_wavreader.read_info).
+
+    The onsets of the new method (onset_level under 1) add hops which are
+    not known before the analysis: then the hops, the output and the time
+    are upper bounds, and onset_hops is the margin included for them.
+    """
+    if method not in paulstretch_methods.METHODS:
+        raise ValueError("Unknown method: %s (expected one of %s)" % (method, ", ".join(paulstretch_methods.METHODS)))
+    if output_format not in FORMATS:
+        raise ValueError("Unknown output format: %s" % output_format)
+    if stretch <= 0.0 or windowsize_seconds <= 0.0:
+        raise ValueError("The stretch and the window size must be positive")
+    if info is None:
+        info = paulstretch_wavreader.read_info(input_filename)
+    if profile is None:
+        profile = load_profile()
+
+    samplerate = info["samplerate"]
+    nsamples = info["nframes"]
+    nchannels = 1 if method == "mono" else 2
+    windowsize = window_size(method, samplerate, windowsize_seconds)
+    half_windowsize = windowsize // 2
+
+    onset_hops = 0
+    if method == "newmethod":
+        # without onsets every input frame is used for 1/stretch hops (never
+        # less than one), the last frame gets one hop
+        input_frames = int(np.ceil(nsamples / float(half_windowsize)))
+        hops = int(np.ceil((input_frames - 1) * max(stretch, 1.0))) + 1
+        # an onset jumps to its frame at once and gives back the skipped hops
+        # later at half speed, which adds at most one hop per onset; the
+        # onset measure is at most 1, higher levels never trigger
+        if onset_level < 1.0:
+            onset_hops = input_frames
+            hops += onset_hops
+        forward_ffts = input_frames
+    else:
+        hops = int(np.ceil(nsamples / ((windowsize * 0.5) / stretch)))
+        forward_ffts = hops
+    inverse_ffts = hops
+    output_frames = hops * half_windowsize
+    sampwidth = FORMATS[output_format][0]
+    output_bytes = _HEADER_SIZE + output_frames * nchannels * sampwidth
+    scratch_bytes = output_frames * nchannels * 4 if normalize else 0
+
+    # loading: the file's samples, their conversion to float64 (24 bit
+    # samples are first padded to int32) and the engine's channel layout
+    samples_bytes = nsamples * nchannels * 8
+    load_bytes = info["data_bytes"] + nsamples * info["nchannels"] * 8
+    if info["bits"] == 24:
+        load_bytes += nsamples * info["nchannels"] * 4
+    if info["nchannels"] != nchannels:
+        load_bytes += samples_bytes
+    base, per_sample = WORKING_MEMORY[method]
+    working_bytes = base + per_sample * windowsize * nchannels
+    if normalize:
+        working_bytes = max(working_bytes, NORMALIZE_BLOCK_FRAMES * nchannels * 8 * 3)
+    peak_memory_bytes = BASELINE_BYTES + max(load_bytes, samples_bytes + working_bytes)
+
+    coefficients = profile["methods"].get(method, DEFAULT_COEFFICIENTS[method])
+    fft_points = (forward_ffts + inverse_ffts) * nchannels * windowsize * np.log2(windowsize)
+    seconds = (hops * coefficients["per_hop"] + fft_points * coefficients["per_fft_point"]
+               + info["data_bytes"] * profile.get("load_per_byte", DEFAULT_LOAD_PER_BYTE))
+
+    return {
+        "method": method,
+        "samplerate": samplerate,
+        "input_frames": nsamples,
+        "input_seconds": nsamples / float(samplerate),
+        "nchannels": nchannels,
+        "windowsize": windowsize,
+        "hops": hops,
+        "onset_hops": onset_hops,
+        "forward_ffts": forward_ffts,
+        "inverse_ffts": inverse_ffts,
+        "output_frames": output_frames,
+        "output_seconds": output_frames / float(samplerate),
+        "output_bytes": int(output_bytes),
+        "scratch_bytes": int(scratch_bytes),
+        "peak_memory_bytes": int(peak_memory_bytes),
+        "seconds": float(seconds),
+        "calibrated": bool(profile.get("calibrated", False)),
+    }
+
+
+def admission_problems(cost, output_filename=None, memory_limit=None, disk_free=None):
+    """Return the reasons why a render of this cost can't run here (an empty list if it fits)
+
+    memory_limit defaults to the physical memory of the machine, disk_free
+    to the free space of the output's file system.
+    """
+    problems = []
+    if memory_limit is None:
+        memory_limit = physical_memory()
+    if memory_limit is not None and cost["peak_memory_bytes"] > memory_limit:
+        problems.append("needs %s of memory, %s available" % (format_bytes(cost["peak_memory_bytes"]), format_bytes(memory_limit)))
+    if disk_free is None and output_filename is not None:
+        try:
+            disk_free = shutil.disk_usage(os.path.dirname(os.path.abspath(output_filename))).free
+        except OSError:
+            pass
+    # an existing output is replaced, its space comes back
+    if disk_free is not None and output_filename is not None and os.path.isfile(output_filename):
+        disk_free += os.path.getsize(output_filename)
+    disk_needed = cost["output_bytes"] + cost["scratch_bytes"]
+    if disk_free is not None and disk_needed > disk_free:
+        problems.append("needs %s of disk space, %s free" % (format_bytes(disk_needed), format_bytes(disk_free)))
+    return problems
+
+
+def physical_memory():
+    """Bytes of physical memory, None where it is not known"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def format_bytes(n):
+    for unit in ("bytes", "kB", "MB", "GB"):
+        if abs(n) < 1024.0 or unit == "GB":
+            return ("%d %s" % (n, unit)) if unit == "bytes" else ("%.1f %s" % (n, unit))
+        n /= 1024.0
+
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+
+def report(cost):
+    """Text description of an estimate"""
+    lines = [
+        "window = %d samples (%d FFT bins)" % (cost["windowsize"], cost["windowsize"] // 2 + 1),
+        "hops = %d, FFTs = %d forward + %d inverse, %d channel%s" % (
+            cost["hops"], cost["forward_ffts"], cost["inverse_ffts"], cost["nchannels"], "s" if cost["nchannels"] > 1 else ""),
+        "output = %s (%d frames), %s" % (format_seconds(cost["output_seconds"]), cost["output_frames"], format_bytes(cost["output_bytes"])),
+    ]
+    if cost.get("onset_hops"):
+        lines.append("at most: up to %d of the hops are for the onsets" % cost["onset_hops"])
+    if cost["scratch_bytes"]:
+        lines.append("normalization scratch = %s" % format_bytes(cost["scratch_bytes"]))
+    lines.append("peak memory = %s" % format_bytes(cost["peak_memory_bytes"]))
+    lines.append("render time = %s%s" % (format_seconds(cost["seconds"]),
+                                         "" if cost["calibrated"] else " (not calibrated, run paulstretch_estimate.py --calibrate)"))
+    return "\n".join(lines)
+
+
+########################################
+# calibration
+
+def _fit(features, times):
+    """Least squares non negative coefficients of times ~ features"""
+    features = np.asarray(features, dtype=float)
+    times = np.asarray(times, dtype=float)
+    # scale the columns, their magnitudes are far apart
+    scale = np.abs(features).max(axis=0)
+    scale[scale == 0.0] = 1.0
+    coefficients = np.linalg.lstsq(features / scale, times, rcond=None)[0]
+    if (coefficients < 0.0).any():
+        # drop the negative terms and fit the others again
+        keep = coefficients >= 0.0
+        coefficients = np.zeros(len(scale))
+        if keep.any():
+            coefficients[keep] = np.linalg.lstsq(features[:, keep] / scale[keep], times, rcond=None)[0].clip(0.0)
+    return coefficients / scale
+
+
+def calibrate(methods=None, windows=CALIBRATION_WINDOWS, seconds=CALIBRATION_SECONDS, stream=sys.stdout):
+    """Time short renders of each method and return the calibration profile"""
+    from paulstretch_context import RenderContext
+    from paulstretch_wavwriter import WavWriter
+    methods = methods or list(paulstretch_methods.METHODS)
+    directory = tempfile.mkdtemp(prefix="paulstretch_calibrate_")
+    samplerate = 44100
+    profile = {"version": PROFILE_VERSION, "calibrated": True, "created": time.time(),
+               "machine": {"node": platform.node(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                           "python": platform.python_version(), "numpy": np.__version__},
+               "methods": {}}
+    try:
+        input_filename = os.path.join(directory, "input.wav")
+        rng = np.random.default_rng(0)
+        with WavWriter(input_filename, samplerate, 2) as outfile:
+            outfile.write(rng.uniform(-0.5, 0.5, (2, int(seconds * samplerate))))
+        info = paulstretch_wavreader.read_info(input_filename)
+        output_filename = os.path.join(directory, "output.wav")
+        load_times = []
+        for method in methods:
+            engine = paulstretch_methods.get_engine(method)
+            features = []
+            times = []
+            for window in windows:
+                # the engines fade the end of the samples in place, load them again each time
+                t0 = time.perf_counter()
+                samplerate, smp = engine.load_wav(input_filename)
+                t1 = time.perf_counter()
+                paulstretch_methods.run(method, samplerate, smp, CALIBRATION_STRETCH, window, output_filename,
+                                        10.0, RenderContext(seed=1, progress=lambda percentage: None))
+                t2 = time.perf_counter()
+                load_times.append(t1 - t0)
+                cost = estimate(input_filename, method, CALIBRATION_STRETCH, window, info=info,
+                                profile={"methods": {method: {"per_hop": 1.0, "per_fft_point": 0.0}}, "load_per_byte": 0.0})
+                fft_points = ((cost["forward_ffts"] + cost["inverse_ffts"]) * cost["nchannels"]
+                              * cost["windowsize"] * np.log2(cost["windowsize"]))
+                features.append((cost["hops"], fft_points))
+                times.append(t2 - t1)
+                stream.write("%-10s window %-5g %6d hops %8.3f s\n" % (method, window, cost["hops"], t2 - t1))
+            per_hop, per_fft_point = _fit(features, times)
+            profile["methods"][method] = {"per_hop": float(per_hop), "per_fft_point": float(per_fft_point)}
+        profile["load_per_byte"] = float(min(load_times) / info["data_bytes"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return profile
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] input_wav\n       %prog --calibrate")
+    parser.add_option("-m", "--method", dest="method",help="processing method (mono, stereo, newmethod)",default="stereo")
+    parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (newmethod only)",type="float",default=10.0)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("-n", "--normalize", dest="normalize",help="the render is normalized (needs a scratch file)",action="store_true",default=False)
+    parser.add_option("-o", "--output", dest="output",help="output file, to check the free disk space",default=None)
+    parser.add_option("-j", "--json", dest="json",help="print the estimate as json",action="store_true",default=False)
+    parser.add_option("--calibrate", dest="calibrate",help="time renders of this machine and save the calibration profile",action="store_true",default=False)
+    parser.add_option("--profile", dest="profile",help="calibration profile file (default: %s)" % DEFAULT_PROFILE,default=None)
+    (options, args) = parser.parse_args()
+
+    if options.calibrate:
+        profile = calibrate()
+        save_profile(profile, options.profile)
+        print ("calibration saved in %s" % (options.profile or os.environ.get("PAULSTRETCH_CALIBRATION", DEFAULT_PROFILE)))
+        sys.exit(0)
+
+    if (len(args) != 1) or (options.method not in paulstretch_methods.METHODS) or (options.stretch <= 0.0) or \
+       (options.window_size <= 0.001) or (options.format not in FORMATS):
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    try:
+        cost = estimate(args[0], options.method, options.stretch, options.window_size, options.format,
+                        options.normalize, load_profile(options.profile), onset_level=options.onset)
+    except (OSError, ValueError, struct.error) as e:
+        print ("Error reading %s: %s" % (args[0], e))
+        sys.exit(1)
+    problems = admission_problems(cost, options.output)
+    if options.json:
+        cost["problems"] = problems
+        print (json.dumps(cost, indent=1, sort_keys=True))
+    else:
+        print (report(cost))
+        for problem in problems:
+            print ("does not fit: %s" % problem)
+    sys.exit(1 if problems else 0)
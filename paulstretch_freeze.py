@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Spectral freeze: hold one moment of the input for any length of time.
+
+The input is analyzed once at the chosen position (or over a short span,
+whose frame magnitudes are averaged), and the output is made only from that
+magnitude spectrum: random phases, inverse FFT, window and overlap-add, like
+paulstretch_stereo with an infinite stretch but without reading, windowing
+and transforming the input again for every frame.
+
+    python paulstretch_freeze.py -p 12.5 -l 300 input.wav drone.wav
+    python paulstretch_freeze.py -p 12.5 -l 0 input.wav - | aplay -f S16_LE -c 2 -r 44100
+
+From Python, freeze_blocks() is an endless generator of output blocks.
+"""
+import os
+import sys
+import numpy as np
+from optparse import OptionParser
+
+import paulstretch_stereo
+from paulstretch_context import RenderContext, RenderCancelled
+from paulstretch_wavwriter import FORMATS
+
+
+def window_size(samplerate, windowsize_seconds):
+    """The window size of the stereo engine for these parameters"""
+    windowsize = int(windowsize_seconds * samplerate)
+    if windowsize < 16:
+        windowsize = 16
+    windowsize = paulstretch_stereo.optimize_windowsize(windowsize)
+    return int(windowsize / 2) * 2
+
+
+def make_window(windowsize):
+    return pow(1.0 - pow(np.linspace(-1.0, 1.0, windowsize), 2.0), 1.25)
+
+
+def analyze(samplerate, smp, position, windowsize_seconds, span=0.0):
+    """Magnitude spectrum (channels x bins) of the input at position (seconds)
+
+    With a span (seconds) the magnitudes of the frames from position to
+    position+span, half a window apart, are averaged, which gives a smoother
+    and less static texture than a single frame.
+    """
+    windowsize = window_size(samplerate, windowsize_seconds)
+    window = make_window(windowsize)
+    nchannels, nsamples = smp.shape
+    start = int(position * samplerate)
+    if start < 0 or start >= nsamples:
+        raise ValueError("The freeze position is outside of the input")
+    end = max(start, int((position + span) * samplerate))
+    starts = range(start, end + 1, windowsize // 2)
+    mag = np.zeros((nchannels, windowsize // 2 + 1))
+    for frame_start in starts:
+        buf = smp[:, frame_start:frame_start + windowsize]
+        if buf.shape[1] < windowsize:
+            buf = np.append(buf, np.zeros((nchannels, windowsize - buf.shape[1])), 1)
+        mag += np.abs(np.fft.rfft(buf * window))
+    return mag / len(starts)
+
+
+def freeze_blocks(mag, rng=None):
+    """Endless generator of output hops (channels x windowsize/2 floats) made from a magnitude spectrum"""
+    if rng is None:
+        rng = np.random.default_rng()
+    nchannels, nbins = mag.shape
+    windowsize = (nbins - 1) * 2
+    half_windowsize = windowsize // 2
+    window = make_window(windowsize)
+    old_windowed_buf = np.zeros((nchannels, windowsize))
+    while True:
+        ph = rng.uniform(0, 2 * np.pi, (nchannels, nbins)) * 1j
+        buf = np.fft.irfft(mag * np.exp(ph)) * window
+        yield buf[:, 0:half_windowsize] + old_windowed_buf[:, half_windowsize:windowsize]
+        old_windowed_buf = buf
+
+
+def freeze(samplerate, smp, position, duration, windowsize_seconds, outfilename, span=0.0, context=None):
+    """Render duration seconds of the frozen input (endless with duration None, for a pipe or output_callback)"""
+    if context is None:
+        context = RenderContext()
+    mag = analyze(samplerate, smp, position, windowsize_seconds, span)
+    half_windowsize = mag.shape[1] - 1
+    nhops = None
+    if duration is not None:
+        nhops = max(1, int(np.ceil(duration * samplerate / half_windowsize)))
+
+    context.start_run({"engine": "freeze", "samplerate": samplerate, "nsamples": smp.shape[1],
+                       "windowsize_seconds": windowsize_seconds, "windowsize": half_windowsize * 2,
+                       "position": position, "span": span, "duration": duration})
+    outfile = None
+    if outfilename is not None:
+        outfile = context.open_output(outfilename, samplerate, mag.shape[0],
+                                      expected_frames=None if nhops is None else nhops * half_windowsize)
+    hop = 0
+    try:
+        for output in freeze_blocks(mag, context.rng):
+            if outfile is not None:
+                outfile.write(output)
+            context.write_output(output)
+            hop += 1
+            if nhops is not None:
+                if hop >= nhops:
+                    context.report_progress(100)
+                    break
+                context.report_progress(int(100.0 * hop / nhops))
+            elif context.cancelled:
+                raise RenderCancelled()
+    except BaseException:
+        # an endless render to a pipe ends here too, the output file stays valid
+        if outfile is not None:
+            outfile.abort()
+        raise
+    if outfile is not None:
+        outfile.close()
+    context.render_complete()
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] input_wav output_wav (- for raw PCM to stdout)")
+    parser.add_option("-p", "--position", dest="position",help="position of the frozen moment in the input (seconds)",type="float",default=0.0)
+    parser.add_option("-l", "--length", dest="length",help="length of the output (seconds, 0 = endless with - as output)",type="float",default=60.0)
+    parser.add_option("-S", "--span", dest="span",help="average the spectra over this span after the position (seconds)",type="float",default=0.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases",type="int",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("--dither", dest="dither",help="add TPDF dither to the integer output formats",action="store_true",default=False)
+    parser.add_option("--manifest", dest="manifest",help="write a json manifest of the run (parameters, times, sizes) to this file",default=None)
+    parser.add_option("--metrics", dest="metrics",help="add the run to this Prometheus textfile collector file (default: $PAULSTRETCH_METRICS)",default=None)
+    (options, args) = parser.parse_args()
+
+    if ((len(args)<2) or (options.window_size<=0.001) or (options.length<0.0) or (options.span<0.0)
+            or (options.format not in FORMATS) or (options.length==0.0 and args[1]!="-")):
+        sys.stderr.write("Error in command line parameters. Run this program with --help for help.\n")
+        sys.exit(1)
+
+    loaded = paulstretch_stereo.load_wav(args[0])
+    if loaded is None:
+        sys.exit(1)
+    samplerate, smp = loaded
+    # with the output on stdout, the progress goes to stderr
+    context = RenderContext(seed=options.seed, output_format=options.format, dither=options.dither,
+                            stream=sys.stderr if args[1] == "-" else None,
+                            manifest=options.manifest, metrics=options.metrics, input_filename=args[0])
+    try:
+        freeze(samplerate, smp, options.position, options.length if options.length > 0.0 else None,
+               options.window_size, args[1], options.span, context)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    except BrokenPipeError:
+        # the reader went away: silence the flush of stdout at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
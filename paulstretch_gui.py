@@ -1,25 +1,91 @@
 #!/usr/bin/env python
 import os
 import sys
+import time
 import wx
 import wx.adv
 import threading
-import scipy.io.wavfile
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
+import collections
 
-# Import the paulstretch modules
-import paulstretch_mono
-import paulstretch_stereo
-import paulstretch_newmethod
-from paulstretch_stdout_redirect import StdoutRedirector
+# Import the paulstretch modules; matplotlib, scipy and the engines are
+# imported when first used, so that the window shows up quickly
+import paulstretch_methods
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
+
+# Live spectrogram: bands of the engine's spectrum tap, columns of history, redraws per second
+SPECTROGRAM_BANDS = 64
+SPECTROGRAM_COLUMNS = 300
+SPECTROGRAM_FPS = 15
+
+class JobRow(wx.Panel):
+    """One job of the render queue: its parameters, progress gauge, throughput and buttons"""
+    def __init__(self, parent, frame, job_id, params):
+        super(JobRow, self).__init__(parent)
+        self.frame = frame
+        self.job_id = job_id
+        
+        description = f"{os.path.basename(params['output'])}  ({params['method']}, stretch {params['stretch']:.1f}, window {params['window_size']:.2f})"
+        self.label = wx.StaticText(self, label=description)
+        self.state_text = wx.StaticText(self, label="queued", size=(80, -1))
+        self.gauge = wx.Gauge(self, range=100, size=(150, -1))
+        self.throughput_text = wx.StaticText(self, label="", size=(170, -1))
+        self.up_btn = wx.Button(self, label="Up", style=wx.BU_EXACTFIT)
+        self.down_btn = wx.Button(self, label="Down", style=wx.BU_EXACTFIT)
+        self.cancel_btn = wx.Button(self, label="Cancel", style=wx.BU_EXACTFIT)
+        
+        sizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(self.label, 1, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 3)
+        sizer.Add(self.state_text, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 3)
+        sizer.Add(self.gauge, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 3)
+        sizer.Add(self.throughput_text, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 3)
+        sizer.Add(self.up_btn, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 1)
+        sizer.Add(self.down_btn, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 1)
+        sizer.Add(self.cancel_btn, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 1)
+        self.SetSizer(sizer)
+        
+        self.label.SetToolTip("Click to show the spectrogram of this job")
+        self.label.Bind(wx.EVT_LEFT_DOWN, lambda event: self.frame.show_spectrogram(self.job_id))
+        self.up_btn.Bind(wx.EVT_BUTTON, lambda event: self.frame.move_job(self.job_id, -1))
+        self.down_btn.Bind(wx.EVT_BUTTON, lambda event: self.frame.move_job(self.job_id, 1))
+        self.cancel_btn.Bind(wx.EVT_BUTTON, lambda event: self.frame.cancel_job(self.job_id))
+    
+    def update(self, job):
+        """Show the status of the job (a RenderService status dict)"""
+        state = job["state"]
+        self.state_text.SetLabel(state)
+        self.gauge.SetValue(job["progress"])
+        if state == "running" and job["throughput"]:
+            # remaining time from the progress rate so far
+            elapsed = time.time() - job["started"]
+            remaining = elapsed * (100 - job["progress"]) / max(job["progress"], 1)
+            self.throughput_text.SetLabel(f"{job['throughput']:.1f}x realtime, {int(remaining) // 60}:{int(remaining) % 60:02d} left")
+        elif state == "queued" and job.get("estimate"):
+            estimate = job["estimate"]
+            self.throughput_text.SetLabel(f"~{int(estimate['seconds']) // 60}:{int(estimate['seconds']) % 60:02d} estimated, "
+                                          f"{estimate['output_bytes'] / (1024.0 * 1024.0):.0f} MB")
+        elif state == "done":
+            self.throughput_text.SetLabel(f"{job['finished'] - job['started']:.1f} s")
+        elif state == "failed":
+            self.throughput_text.SetLabel(job["error"] or "")
+            self.throughput_text.SetToolTip(job["error"] or "")
+        self.up_btn.Enable(state == "queued")
+        self.down_btn.Enable(state == "queued")
+        self.cancel_btn.Enable(state in ("queued", "running"))
 
 class PaulstretchFrame(wx.Frame):
     def __init__(self, parent=None, title="Paulstretch Audio Processor"):
-        super(PaulstretchFrame, self).__init__(parent, title=title, size=(900, 900))
+        super(PaulstretchFrame, self).__init__(parent, title=title, size=(900, 1000))
         
-        self.processing_thread = None
-        self.is_processing = False
+        # The render queue; its worker processes are started with the first job
+        self.render_service = None
+        self.job_rows = {}
+        
+        # Spectra of the job shown in the spectrogram, filled by the service's
+        # dispatcher thread and drawn by a timer at a bounded rate
+        self.spectrogram_job_id = None
+        self.spectrum_columns = collections.deque(maxlen=SPECTROGRAM_COLUMNS)
+        self.spectrogram_figure = None
         
         # Track previous slider values
         self.prev_stretch_value = 0
@@ -50,6 +116,10 @@ class PaulstretchFrame(wx.Frame):
         process_sizer = self.create_process_section()
         main_sizer.Add(process_sizer, 0, wx.EXPAND | wx.ALL, 10)
         
+        # Create the render queue
+        queue_sizer = self.create_queue_section()
+        main_sizer.Add(queue_sizer, 1, wx.EXPAND | wx.ALL, 10)
+        
         # Create the status bar
         self.statusbar = self.CreateStatusBar()
         self.statusbar.SetStatusText("Ready")
@@ -61,8 +131,10 @@ class PaulstretchFrame(wx.Frame):
         # Bind the close event
         self.Bind(wx.EVT_CLOSE, self.on_close)
         
-        # Set up stdout redirector for progress updates
-        self.stdout_redirector = StdoutRedirector(self.update_progress)
+        # Redraw the spectrogram with the new columns
+        self.spectrogram_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_spectrogram_timer, self.spectrogram_timer)
+        self.spectrogram_timer.Start(1000 // SPECTROGRAM_FPS)
         
         # Final setup
         self.Centre()
@@ -223,9 +295,25 @@ class PaulstretchFrame(wx.Frame):
         """Create the audio visualization section"""
         sizer = wx.StaticBoxSizer(wx.VERTICAL, self.panel, "Audio Visualization")
         
-        # Create matplotlib figure for waveform visualization
+        # The matplotlib figure is created once the window is shown
+        self.figure = None
+        self.canvas_holder = wx.Panel(self.panel, size=(800, 300))
+        self.canvas_holder.SetSizer(wx.BoxSizer(wx.VERTICAL))
+        wx.CallAfter(self.create_waveform_canvas)
+        
+        sizer.Add(self.canvas_holder, 1, wx.EXPAND | wx.ALL, 5)
+        
+        return sizer
+    
+    def create_waveform_canvas(self):
+        """Create the matplotlib figure for waveform visualization"""
+        if self.figure is not None:
+            return
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
+        
         self.figure = Figure(figsize=(8, 3), dpi=100)
-        self.canvas = FigureCanvas(self.panel, -1, self.figure)
+        self.canvas = FigureCanvas(self.canvas_holder, -1, self.figure)
         
         # Initially, show a placeholder
         self.axes = self.figure.add_subplot(111)
@@ -233,38 +321,139 @@ class PaulstretchFrame(wx.Frame):
         self.axes.set_xticks([])
         self.axes.set_yticks([])
         
-        sizer.Add(self.canvas, 1, wx.EXPAND | wx.ALL, 5)
-        
-        return sizer
+        self.canvas_holder.GetSizer().Add(self.canvas, 1, wx.EXPAND)
+        self.canvas_holder.Layout()
+    
+    def create_spectrogram_canvas(self):
+        """Create the figure of the live spectrogram of the output, below the waveform"""
+        if self.spectrogram_figure is not None:
+            return
+        import numpy
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
+        
+        self.spectrogram_figure = Figure(figsize=(8, 2), dpi=100)
+        self.spectrogram_canvas = FigureCanvas(self.canvas_holder, -1, self.spectrogram_figure)
+        self.spectrogram_axes = self.spectrogram_figure.add_subplot(111)
+        self.spectrogram_axes.set_title("Output spectrogram")
+        self.spectrogram_axes.set_xticks([])
+        self.spectrogram_axes.set_yticks([])
+        
+        # The image is animated: full redraws leave it out and it is blitted
+        # over the saved background when new columns arrive
+        self.spectrogram_data = numpy.full((SPECTROGRAM_BANDS, SPECTROGRAM_COLUMNS), -120.0, dtype=numpy.float32)
+        self.spectrogram_image = self.spectrogram_axes.imshow(self.spectrogram_data, origin="lower", aspect="auto",
+                                                              vmin=-100.0, vmax=0.0, cmap="magma", animated=True)
+        self.spectrogram_background = None
+        self.spectrogram_canvas.mpl_connect("draw_event", self.on_spectrogram_draw)
+        
+        self.canvas_holder.GetSizer().Add(self.spectrogram_canvas, 1, wx.EXPAND)
+        self.canvas_holder.Layout()
+        self.spectrogram_canvas.draw()
+    
+    def on_spectrogram_draw(self, event):
+        """After a full redraw (first show, resize): save the background for blitting"""
+        self.spectrogram_background = self.spectrogram_canvas.copy_from_bbox(self.spectrogram_axes.bbox)
+        self.spectrogram_axes.draw_artist(self.spectrogram_image)
+    
+    def on_spectrum(self, job_id, bands):
+        """Spectrum tap of the service, called from its dispatcher thread"""
+        if job_id == self.spectrogram_job_id:
+            self.spectrum_columns.append(bands)
+    
+    def show_spectrogram(self, job_id):
+        """Show the spectrogram of another job (from now on)"""
+        if job_id == self.spectrogram_job_id:
+            return
+        self.spectrogram_job_id = job_id
+        self.spectrum_columns.clear()
+        if self.spectrogram_figure is not None:
+            self.spectrogram_data.fill(-120.0)
+            self.spectrogram_axes.set_title(f"Output spectrogram of job {job_id}")
+            self.spectrogram_canvas.draw_idle()
+    
+    def on_spectrogram_timer(self, event):
+        """Scroll the new columns into the spectrogram and blit it, at most SPECTROGRAM_FPS times per second"""
+        if not self.spectrum_columns:
+            return
+        self.create_spectrogram_canvas()
+        columns = []
+        while self.spectrum_columns:
+            columns.append(self.spectrum_columns.popleft())
+        n = min(len(columns), SPECTROGRAM_COLUMNS)
+        bands = min(len(columns[-1]), SPECTROGRAM_BANDS)
+        self.spectrogram_data[:, :-n] = self.spectrogram_data[:, n:]
+        self.spectrogram_data[:, -n:] = -120.0
+        for i, column in enumerate(columns[-n:]):
+            self.spectrogram_data[:bands, SPECTROGRAM_COLUMNS - n + i] = column[:bands]
+        self.spectrogram_image.set_data(self.spectrogram_data)
+        if self.spectrogram_background is None:
+            return
+        self.spectrogram_canvas.restore_region(self.spectrogram_background)
+        self.spectrogram_axes.draw_artist(self.spectrogram_image)
+        self.spectrogram_canvas.blit(self.spectrogram_axes.bbox)
     
     def create_process_section(self):
         """Create the processing controls section"""
         sizer = wx.StaticBoxSizer(wx.HORIZONTAL, self.panel, "Processing")
         
         # Processing buttons
-        self.process_btn = wx.Button(self.panel, label="Process")
-        self.stop_btn = wx.Button(self.panel, label="Stop")
+        self.process_btn = wx.Button(self.panel, label="Add to Queue")
+        self.process_btn.SetToolTip("Render the input with the current parameters (several jobs run at the same time)")
+        self.stop_btn = wx.Button(self.panel, label="Stop All")
         self.preview_btn = wx.Button(self.panel, label="Preview")
+        self.preview_quality = wx.Choice(self.panel, choices=["Full quality", "Draft 1/2", "Draft 1/4"])
+        self.preview_quality.SetSelection(2)
+        self.preview_quality.SetToolTip("Render the preview at a reduced sample rate for faster feedback")
         
-        # Progress indicator
-        self.progress = wx.Gauge(self.panel, range=100)
+        # Spectrum tap of the jobs for the spectrogram
+        self.spectrogram_check = wx.CheckBox(self.panel, label="Live spectrogram")
+        self.spectrogram_check.SetValue(True)
+        self.spectrogram_check.SetToolTip("Show the spectrum of the output while the job renders")
+        
+        # Run manifest next to each output (and $PAULSTRETCH_METRICS if set)
+        self.manifest_check = wx.CheckBox(self.panel, label="Run manifest")
+        self.manifest_check.SetToolTip("Write the parameters, times and sizes of each render to <output>.manifest.json")
+        
+        # Number of jobs rendered at the same time
+        workers_label = wx.StaticText(self.panel, label="Parallel jobs:")
+        self.workers_spin = wx.SpinCtrl(self.panel, min=1, max=64, initial=max(1, (os.cpu_count() or 2) // 2))
+        self.workers_spin.SetToolTip("Number of worker processes rendering the queued jobs")
         
         # Add to sizer
         sizer.Add(self.process_btn, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
         sizer.Add(self.stop_btn, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
         sizer.Add(self.preview_btn, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
-        sizer.Add(self.progress, 1, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        sizer.Add(self.preview_quality, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        sizer.Add(self.spectrogram_check, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        sizer.Add(self.manifest_check, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        sizer.AddStretchSpacer()
+        sizer.Add(workers_label, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        sizer.Add(self.workers_spin, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
         
         # Bind events
         self.process_btn.Bind(wx.EVT_BUTTON, self.on_process)
         self.stop_btn.Bind(wx.EVT_BUTTON, self.on_stop)
         self.preview_btn.Bind(wx.EVT_BUTTON, self.on_preview)
+        self.workers_spin.Bind(wx.EVT_SPINCTRL, self.on_workers_changed)
         
         # Initially disable the stop button
         self.stop_btn.Enable(False)
         
         return sizer
     
+    def create_queue_section(self):
+        """Create the render queue section, one row per job"""
+        sizer = wx.StaticBoxSizer(wx.VERTICAL, self.panel, "Render Queue")
+        
+        self.queue_window = wx.ScrolledWindow(self.panel, size=(-1, 150), style=wx.VSCROLL)
+        self.queue_window.SetScrollRate(0, 10)
+        self.queue_window.SetSizer(wx.BoxSizer(wx.VERTICAL))
+        
+        sizer.Add(self.queue_window, 1, wx.EXPAND | wx.ALL, 5)
+        
+        return sizer
+    
     def on_browse_input(self, event):
         """Handle input file browsing"""
         dlg = wx.FileDialog(
@@ -316,7 +505,7 @@ class PaulstretchFrame(wx.Frame):
     def detect_file_format(self, filepath):
         """Detect if the audio file is mono or stereo"""
         try:
-            wavedata = scipy.io.wavfile.read(filepath)
+            wavedata = paulstretch_wavreader.read(filepath)
             smp = wavedata[1]
             
             if len(smp.shape) > 1:
@@ -337,7 +526,7 @@ class PaulstretchFrame(wx.Frame):
     def load_waveform(self, filepath):
         """Load and display the waveform of the audio file"""
         try:
-            samplerate, data = scipy.io.wavfile.read(filepath)
+            samplerate, data = paulstretch_wavreader.read(filepath)
             
             # Convert to mono for display if stereo
             if len(data.shape) > 1:
@@ -353,6 +542,7 @@ class PaulstretchFrame(wx.Frame):
                 display_data = display_data[::len(display_data)//10000]
             
             # Clear the figure and plot the waveform
+            self.create_waveform_canvas()
             self.figure.clear()
             self.axes = self.figure.add_subplot(111)
             self.axes.plot(display_data)
@@ -440,35 +630,113 @@ class PaulstretchFrame(wx.Frame):
         self.prev_window_value = self.window_slider.GetValue()
         self.prev_onset_value = self.onset_slider.GetValue()
     
-    def update_progress(self, percentage):
-        """Update the progress gauge based on stdout output"""
-        wx.CallAfter(self.progress.SetValue, percentage)
-        # Return True to continue processing, False to stop
-        return self.is_processing
-    
     def on_process(self, event):
-        """Handle processing button click"""
+        """Handle processing button click: add a job with the current parameters to the queue"""
         # Validate input parameters
         if not self.validate_parameters():
             return
         
-        # Start processing in a new thread
-        self.is_processing = True
-        self.processing_thread = threading.Thread(target=self.process_audio)
-        self.processing_thread.daemon = True
-        self.processing_thread.start()
+        # Determine which method to use
+        method = "mono"
+        if self.rb_stereo.GetValue():
+            method = "stereo"
+        elif self.rb_advanced.GetValue():
+            method = "newmethod"
+        
+        params = {
+            "method": method,
+            "input": self.input_text.GetValue(),
+            "output": self.output_text.GetValue(),
+            "stretch": float(self.stretch_text.GetLabel()),
+            "window_size": float(self.window_text.GetLabel()),
+            # Ensure onset is a float, not an int
+            "onset": float(self.onset_text.GetLabel()) if method == "newmethod" else 10.0,
+            "spectrum": self.spectrogram_check.GetValue(),
+            "manifest": self.output_text.GetValue() + ".manifest.json" if self.manifest_check.GetValue() else None,
+        }
+        
+        if self.render_service is None:
+            from paulstretch_daemon import RenderService
+            self.statusbar.SetStatusText("Starting the workers...")
+            self.render_service = RenderService(self.workers_spin.GetValue(),
+                                                listener=lambda job: wx.CallAfter(self.on_job_update, job),
+                                                spectrum_listener=self.on_spectrum)
+        try:
+            job_id = self.render_service.submit(params)
+        except ValueError as e:
+            wx.MessageBox(f"Error adding the job: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            return
         
-        # Update UI
-        self.process_btn.Enable(False)
+        self.add_job_row(job_id, params)
         self.stop_btn.Enable(True)
-        self.statusbar.SetStatusText("Processing...")
+        self.statusbar.SetStatusText(f"Job {job_id} queued")
+    
+    def add_job_row(self, job_id, params):
+        """Add the row of a job to the queue panel (if the listener hasn't already)"""
+        if job_id in self.job_rows:
+            return self.job_rows[job_id]
+        row = JobRow(self.queue_window, self, job_id, params)
+        self.job_rows[job_id] = row
+        self.queue_window.GetSizer().Add(row, 0, wx.EXPAND)
+        self.queue_window.FitInside()
+        self.queue_window.Layout()
+        return row
+    
+    def on_job_update(self, job):
+        """Show a job status change, called through wx.CallAfter from the service"""
+        row = self.add_job_row(job["id"], job["params"])
+        row.update(job)
+        # follow the latest started job, unless the one shown is still running
+        if job["state"] == "running" and job["params"]["spectrum"]:
+            shown = self.render_service.status(self.spectrogram_job_id) if self.spectrogram_job_id else None
+            if shown is None or shown["state"] != "running":
+                self.show_spectrogram(job["id"])
+        if job["state"] == "done":
+            self.statusbar.SetStatusText(f"Job {job['id']} complete: {job['params']['output']}")
+        elif job["state"] == "failed":
+            self.statusbar.SetStatusText(f"Job {job['id']} failed: {job['error']}")
+        elif job["state"] == "cancelled":
+            self.statusbar.SetStatusText(f"Job {job['id']} cancelled")
+        self.stop_btn.Enable(self.active_jobs() > 0)
+    
+    def active_jobs(self):
+        """Number of queued and running jobs"""
+        if self.render_service is None:
+            return 0
+        return sum(1 for job in self.render_service.list() if job["state"] in ("queued", "running"))
+    
+    def move_job(self, job_id, offset):
+        """Move a queued job up or down the queue and show the rows in the new order"""
+        if not self.render_service.move(job_id, offset):
+            return
+        # running and finished jobs first, then the queued ones in the order they will start
+        jobs = self.render_service.list()
+        jobs.sort(key=lambda job: (job["state"] == "queued", -job["priority"] if job["state"] == "queued" else 0,
+                                   job["order"] if job["state"] == "queued" else int(job["id"])))
+        queue_sizer = self.queue_window.GetSizer()
+        for job in jobs:
+            queue_sizer.Detach(self.job_rows[job["id"]])
+        for job in jobs:
+            queue_sizer.Add(self.job_rows[job["id"]], 0, wx.EXPAND)
+        self.queue_window.Layout()
+    
+    def cancel_job(self, job_id):
+        """Cancel one queued or running job; a running job stops at its next hop"""
+        if self.render_service.cancel(job_id):
+            self.statusbar.SetStatusText(f"Cancelling job {job_id}...")
+    
+    def on_workers_changed(self, event):
+        """Change the number of jobs rendered at the same time"""
+        if self.render_service is not None:
+            self.render_service.resize(self.workers_spin.GetValue())
     
     def on_stop(self, event):
-        """Handle stop button click"""
-        if self.is_processing:
-            self.is_processing = False
-            # The processing thread will check this flag and terminate
-            self.statusbar.SetStatusText("Stopping...")
+        """Handle stop button click: cancel all the queued and running jobs"""
+        if self.render_service is None:
+            return
+        for job in self.render_service.list():
+            self.render_service.cancel(job["id"])
+        self.statusbar.SetStatusText("Stopping...")
     
     def on_preview(self, event):
         """Handle preview button click"""
@@ -483,28 +751,30 @@ class PaulstretchFrame(wx.Frame):
         # Process a small segment (5-10 seconds) of the input file
         try:
             # Read the input file
-            samplerate, data = scipy.io.wavfile.read(input_file)
+            samplerate, data = paulstretch_wavreader.read(input_file)
             
             # Create a shorter version for preview (5 seconds)
             preview_length = min(len(data), 5 * samplerate)
             preview_data = data[:preview_length]
             
             # Write the preview segment to a temporary file
+            import scipy.io.wavfile
             scipy.io.wavfile.write(temp_file, samplerate, preview_data)
             
             # Process the preview
             self.statusbar.SetStatusText("Generating preview...")
             
             # Start preview processing in a new thread
+            draft_factor = (1, 2, 4)[self.preview_quality.GetSelection()]
             threading.Thread(
                 target=self.preview_audio, 
-                args=(temp_file,)
+                args=(temp_file, draft_factor)
             ).start()
             
         except Exception as e:
             self.statusbar.SetStatusText(f"Preview error: {str(e)}")
     
-    def preview_audio(self, temp_file):
+    def preview_audio(self, temp_file, draft_factor=1):
         """Process and play a preview of the audio"""
         preview_output = os.path.join(os.path.dirname(temp_file), "preview_output.wav")
         
@@ -520,22 +790,26 @@ class PaulstretchFrame(wx.Frame):
         elif self.rb_advanced.GetValue():
             method = "advanced"
         
+        # The preview has its own context, so it can run while a file is processed
+        context = RenderContext(progress=lambda percentage: wx.CallAfter(
+            self.statusbar.SetStatusText, f"Generating preview... {percentage} %"))
+        
         try:
-            # Redirect stdout to capture progress
-            with self.stdout_redirector:
-                if method == "mono":
-                    samplerate, smp = paulstretch_mono.load_wav(temp_file)
-                    paulstretch_mono.paulstretch(samplerate, smp, stretch, window_size, preview_output)
-                elif method == "stereo":
-                    samplerate, smp = paulstretch_stereo.load_wav(temp_file)
-                    paulstretch_stereo.paulstretch(samplerate, smp, stretch, window_size, preview_output)
-                else:  # advanced
-                    samplerate, smp = paulstretch_newmethod.load_wav(temp_file)
-                    # Ensure onset is a float, not an int
-                    paulstretch_newmethod.paulstretch(samplerate, smp, stretch, window_size, float(onset), preview_output)
+            # Only the engine of the method is imported; ensure onset is a float, not an int
+            engine_method = "newmethod" if method == "advanced" else method
+            samplerate, smp = paulstretch_methods.load_wav(engine_method, temp_file)
+            if draft_factor > 1:
+                import paulstretch_draft
+                report = paulstretch_draft.draft_paulstretch(engine_method, samplerate, smp, stretch, window_size,
+                                                             preview_output, float(onset), draft_factor, context=context)
+            else:
+                paulstretch_methods.run(engine_method, samplerate, smp, stretch, window_size, preview_output, float(onset), context)
             
             # Play the preview
-            wx.CallAfter(self.statusbar.SetStatusText, "Playing preview...")
+            if draft_factor > 1:
+                wx.CallAfter(self.statusbar.SetStatusText, f"Playing preview ({report})...")
+            else:
+                wx.CallAfter(self.statusbar.SetStatusText, "Playing preview...")
             
             # Use platform-specific commands to play audio
             if sys.platform == "win32":
@@ -582,61 +856,13 @@ class PaulstretchFrame(wx.Frame):
         
         return True
     
-    def process_audio(self):
-        """Process the audio file with the selected method and parameters"""
-        input_file = self.input_text.GetValue()
-        output_file = self.output_text.GetValue()
-        
-        # Get the processing parameters
-        stretch = float(self.stretch_text.GetLabel())
-        window_size = float(self.window_text.GetLabel())
-        onset = float(self.onset_text.GetLabel()) if self.rb_advanced.GetValue() else 10.0
-        
-        # Determine which method to use
-        method = "mono"
-        if self.rb_stereo.GetValue():
-            method = "stereo"
-        elif self.rb_advanced.GetValue():
-            method = "advanced"
-        
-        try:
-            # Redirect stdout to capture progress
-            with self.stdout_redirector:
-                # Process the file with the appropriate method
-                if method == "mono":
-                    samplerate, smp = paulstretch_mono.load_wav(input_file)
-                    paulstretch_mono.paulstretch(samplerate, smp, stretch, window_size, output_file)
-                elif method == "stereo":
-                    samplerate, smp = paulstretch_stereo.load_wav(input_file)
-                    paulstretch_stereo.paulstretch(samplerate, smp, stretch, window_size, output_file)
-                else:  # advanced
-                    samplerate, smp = paulstretch_newmethod.load_wav(input_file)
-                    # Ensure onset is a float, not an int
-                    paulstretch_newmethod.paulstretch(samplerate, smp, stretch, window_size, float(onset), output_file)
-            
-            # Update UI on completion
-            if self.is_processing:  # Only update if not manually stopped
-                wx.CallAfter(self.statusbar.SetStatusText, "Processing complete")
-                wx.CallAfter(wx.MessageBox, "Processing complete", "Success", wx.OK | wx.ICON_INFORMATION)
-            
-        except Exception as e:
-            wx.CallAfter(self.statusbar.SetStatusText, f"Processing error: {str(e)}")
-            wx.CallAfter(wx.MessageBox, f"Error during processing: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
-        
-        finally:
-            # Reset UI state
-            self.is_processing = False
-            wx.CallAfter(self.process_btn.Enable, True)
-            wx.CallAfter(self.stop_btn.Enable, False)
-            wx.CallAfter(self.progress.SetValue, 0)
-    
     def on_close(self, event):
         """Handle window close event"""
-        # If processing is active, show confirmation dialog
-        if self.is_processing:
+        # If jobs are queued or running, show confirmation dialog
+        if self.active_jobs() > 0:
             dlg = wx.MessageDialog(
                 self,
-                "Processing is still active. Are you sure you want to close the application?",
+                "Jobs are still queued or running. Are you sure you want to close the application?",
                 "Confirm Close",
                 wx.YES_NO | wx.ICON_QUESTION
             )
@@ -648,10 +874,13 @@ class PaulstretchFrame(wx.Frame):
                 event.Veto()
                 return
         
-        # Stop any ongoing processing
-        self.is_processing = False
-        if self.processing_thread and self.processing_thread.is_alive():
-            self.processing_thread.join(1.0)  # Wait for the thread to terminate, with timeout
+        # Stop any ongoing processing and the worker processes
+        self.spectrogram_timer.Stop()
+        if self.render_service is not None:
+            self.render_service.listener = None
+            for job in self.render_service.list():
+                self.render_service.cancel(job["id"])
+            self.render_service.shutdown()
         
         # Destroy the window
         self.Destroy()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Import time benchmark of the command line programs and the GUI.
+
+Each module is imported in a fresh interpreter with python -X importtime,
+several times, and the best cumulative time is compared to its budget. The
+heavy packages a module must not load at import time (scipy, matplotlib,
+the engines the GUI loads on first use) are checked as well, since these
+are what made the startup slow and the timings alone are noisy.
+
+    python paulstretch_importtime.py            # exit status 1 when over budget
+    python paulstretch_importtime.py -n 10 -x 2  # 10 runs, budgets doubled (slow machine)
+"""
+import os
+import sys
+import subprocess
+from optparse import OptionParser
+
+# module -> import time budget (ms) on a recent desktop machine; numpy alone is ~100 ms
+BUDGETS = {
+    "paulstretch_mono": 250,
+    "paulstretch_stereo": 250,
+    "paulstretch_newmethod": 250,
+    "paulstretch_methods": 250,
+    "paulstretch_pipe": 250,
+    "paulstretch_freeze": 250,
+    "paulstretch_sweep": 250,
+    "paulstretch_range": 250,
+    "paulstretch_cache": 250,
+    "paulstretch_project": 250,
+    "paulstretch_daemon": 300,
+    "paulstretch_distributed": 250,
+    "paulstretch_estimate": 250,
+    "paulstretch_manifest": 250,
+    "paulstretch_gui": 600,
+}
+
+# top level packages a module must not import until they are used
+HEAVY = ("scipy", "matplotlib")
+LAZY_ENGINES = ("paulstretch_mono", "paulstretch_stereo", "paulstretch_newmethod", "paulstretch_draft")
+FORBIDDEN = dict((module, HEAVY) for module in BUDGETS)
+FORBIDDEN["paulstretch_gui"] = HEAVY + LAZY_ENGINES
+FORBIDDEN["paulstretch_methods"] = HEAVY + LAZY_ENGINES
+
+
+def measure(module, directory=None):
+    """Import module in a new interpreter, return (cumulative time in ms, set of the imported module names)"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("import %s failed:\n%s" % (module, result.stderr))
+    total = None
+    imported = set()
+    # lines like "import time:       self [us] |  cumulative | imported package"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        imported.add(name)
+        if name == module:
+            total = int(fields[1]) / 1000.0
+    if total is None:
+        raise RuntimeError("no import time reported for %s" % module)
+    return total, imported
+
+
+def available(module):
+    """False for the GUI when wx is not installed"""
+    if module != "paulstretch_gui":
+        return True
+    return subprocess.run([sys.executable, "-c", "import wx"], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+def check(modules, runs=5, scale=1.0, directory=None, stream=sys.stdout):
+    """Print a table of the import times, return the list of failures"""
+    failures = []
+    stream.write("%-24s %10s %10s  %s\n" % ("module", "best (ms)", "budget", "status"))
+    for module in modules:
+        if not available(module):
+            stream.write("%-24s %10s %10s  %s\n" % (module, "-", "-", "skipped (wx not installed)"))
+            continue
+        budget = BUDGETS[module] * scale
+        best = None
+        imported = set()
+        for i in range(runs):
+            total, imported = measure(module, directory)
+            if best is None or total < best:
+                best = total
+        problems = []
+        if best > budget:
+            problems.append("over budget")
+        heavy = sorted(name for name in imported
+                       if name.split(".")[0] in FORBIDDEN.get(module, ()) and "." not in name)
+        if heavy:
+            problems.append("imports " + ", ".join(heavy))
+        stream.write("%-24s %10.1f %10.0f  %s\n" % (module, best, budget, "; ".join(problems) or "ok"))
+        failures.extend("%s: %s" % (module, problem) for problem in problems)
+    return failures
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] [module...]")
+    parser.add_option("-n", "--runs", dest="runs",help="imports per module, the best is kept",type="int",default=5)
+    parser.add_option("-x", "--scale", dest="scale",help="multiply the budgets (for slow machines)",type="float",default=1.0)
+    (options, args) = parser.parse_args()
+
+    modules = args or sorted(BUDGETS)
+    unknown = [module for module in modules if module not in BUDGETS]
+    if unknown or options.runs < 1 or options.scale <= 0.0:
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    failures = check(modules, options.runs, options.scale, os.path.dirname(os.path.abspath(__file__)))
+    if failures:
+        print ("")
+        for failure in failures:
+            print ("FAIL %s" % failure)
+        sys.exit(1)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Run manifests and metrics of the renders.
+
+A render whose RenderContext has a manifest file name writes there, when it
+is complete, a json record of the run: its parameters, the window size the
+engine used, the frames it made, the wall and CPU time, the real time
+factor, the peak RSS (of the run in a render service worker, which resets it
+before each job, else of the process), the bytes read and written and the FFT
+implementation. With a metrics file name (or $PAULSTRETCH_METRICS) the run
+is also added to the counters of a Prometheus textfile collector file,
+labelled by engine, engine version and host, so the throughput of a fleet
+can be graphed from rate(paulstretch_output_audio_seconds_total) over
+rate(paulstretch_render_wall_seconds_total).
+
+The metrics file is rewritten (write and rename, under a lock when several
+processes share it) rather than appended to: the collector reads it as a
+whole and each series must appear once.
+
+    python paulstretch_manifest.py metrics.prom   # print the totals of a metrics file
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+
+import numpy
+
+from paulstretch_wavwriter import FORMATS
+
+MANIFEST_VERSION = 1
+
+# name -> (type, help, record field); the counters add up the runs, the gauges keep the last one
+METRICS = [
+    ("paulstretch_renders_total", "counter", "Completed renders", None),
+    ("paulstretch_render_wall_seconds_total", "counter", "Wall time of the renders", "wall_seconds"),
+    ("paulstretch_render_cpu_seconds_total", "counter", "CPU time of the render threads", "cpu_seconds"),
+    ("paulstretch_output_audio_seconds_total", "counter", "Length of the rendered audio", "output_seconds"),
+    ("paulstretch_frames_processed_total", "counter", "Output frames rendered", "frames_processed"),
+    ("paulstretch_bytes_read_total", "counter", "Bytes of the input files", "bytes_read"),
+    ("paulstretch_bytes_written_total", "counter", "Bytes of the output files", "bytes_written"),
+    ("paulstretch_last_realtime_factor", "gauge", "Seconds of audio per second of the last render", "realtime_factor"),
+    ("paulstretch_last_peak_rss_bytes", "gauge", "Peak RSS of the last render (of its process when not reset per render)", "peak_rss_bytes"),
+    ("paulstretch_last_render_timestamp_seconds", "gauge", "End time of the last render", "finished"),
+]
+
+
+# set once reset_peak_rss() worked: the peak is then the one since the last reset
+_peak_rss_reset = False
+
+
+def reset_peak_rss():
+    """Restart the peak RSS of this process from its current RSS (Linux only)
+
+    A long lived process which runs one render at a time (a render service
+    worker) calls this before each one, so that the peak of a run isn't the
+    peak of the largest render the process ever made. Returns False where
+    the peak can't be reset; it is then the peak of the whole process.
+    """
+    global _peak_rss_reset
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    _peak_rss_reset = True
+    return True
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process (since reset_peak_rss()), None where it is not known"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def fft_info():
+    # the engines use numpy.fft (pocketfft), which runs in the calling thread
+    return {"backend": "numpy.fft (pocketfft)", "numpy": numpy.__version__, "threads": 1}
+
+
+def run_record(context, params, started, output_filename, nchannels, cpu_seconds=None):
+    """The manifest of a complete render
+
+    params are the ones the engine gave to RenderContext.resume_state (or
+    start_run), started the (time, perf_counter, thread_time) when it began.
+    The renders which are not made by an engine of paulstretch_methods
+    give their window size in params["windowsize"].
+    """
+    import paulstretch_cache
+    import paulstretch_estimate
+    wall_seconds = time.perf_counter() - started[1]
+    if cpu_seconds is None:
+        cpu_seconds = time.thread_time() - started[2]
+    samplerate = params["samplerate"]
+    frames = context.frames_processed
+    output_seconds = frames / float(samplerate)
+
+    bytes_read = None
+    if context.input_filename is not None and os.path.isfile(context.input_filename):
+        bytes_read = os.path.getsize(context.input_filename)
+    if output_filename is None:
+        bytes_written = 0
+    elif output_filename == "-":
+        bytes_written = frames * nchannels * FORMATS[context.output_format][0]
+    else:
+        bytes_written = os.path.getsize(output_filename) if os.path.isfile(output_filename) else None
+
+    windowsize = params.get("windowsize")
+    if windowsize is None:
+        windowsize = paulstretch_estimate.window_size(params["engine"], samplerate, params["windowsize_seconds"])
+    parameters = dict((k, v) for k, v in params.items() if k not in ("engine", "samplerate", "nsamples", "nchannels", "windowsize"))
+    parameters.update(seed=context.seed, silence_threshold=context.silence_threshold,
+                      output_format=context.output_format, dither=context.dither, normalize=context.normalize)
+    return {
+        "version": MANIFEST_VERSION,
+        "engine": params["engine"],
+        "engine_version": paulstretch_cache.ENGINE_VERSION,
+        "host": platform.node(),
+        "pid": os.getpid(),
+        "python": platform.python_version(),
+        "fft": fft_info(),
+        "input": os.path.abspath(context.input_filename) if context.input_filename is not None else None,
+        "output": output_filename if output_filename in (None, "-") else os.path.abspath(output_filename),
+        "parameters": parameters,
+        "samplerate": samplerate,
+        "nchannels": nchannels,
+        "input_frames": int(params["nsamples"]),
+        "windowsize": windowsize,
+        "resumed": context.resumed,
+        "frames_processed": frames,
+        "output_seconds": output_seconds,
+        "started": started[0],
+        "finished": time.time(),
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": cpu_seconds,
+        "realtime_factor": output_seconds / wall_seconds if wall_seconds > 0.0 else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+        # "run" when the process reset its peak before the render, else the peak of the whole process
+        "peak_rss_scope": "run" if _peak_rss_reset else "process",
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+    }
+
+
+def write_manifest(filename, record):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_filename, filename)
+
+
+def _labels(record):
+    labels = [("engine", record["engine"]), ("host", record["host"]), ("version", record["engine_version"])]
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+
+def read_metrics(filename):
+    """{(metric name, labels): value} of our metrics in a textfile"""
+    values = {}
+    try:
+        with open(filename) as f:
+            lines = f.readlines()
+    except OSError:
+        return values
+    for line in lines:
+        line = line.strip()
+        if not line.startswith("paulstretch_"):
+            continue
+        series, _, value = line.rpartition(" ")
+        name, _, labels = series.partition("{")
+        try:
+            values[(name, labels.rstrip("}"))] = float(value)
+        except ValueError:
+            pass
+    return values
+
+
+def update_metrics(filename, record):
+    """Add a run to the metrics textfile"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    with open(filename + ".lock", "w") as lock:
+        try:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        values = read_metrics(filename)
+        labels = _labels(record)
+        for name, kind, help_text, field in METRICS:
+            value = 1.0 if field is None else record[field]
+            if value is None:
+                continue
+            if kind == "counter":
+                values[(name, labels)] = values.get((name, labels), 0.0) + value
+            else:
+                values[(name, labels)] = float(value)
+
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            for name, kind, help_text, field in METRICS:
+                series = sorted((l, v) for (n, l), v in values.items() if n == name)
+                if not series:
+                    continue
+                f.write("# HELP %s %s\n# TYPE %s %s\n" % (name, help_text, name, kind))
+                for series_labels, value in series:
+                    f.write("%s{%s} %s\n" % (name, series_labels, repr(value)))
+        # mkstemp makes the file private, the node exporter may run as another user
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+
+
+########################################
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print ("usage: paulstretch_manifest.py metrics_file")
+        sys.exit(1)
+    values = read_metrics(sys.argv[1])
+    series = sorted(set(labels for name, labels in values))
+    for labels in series:
+        renders = values.get(("paulstretch_renders_total", labels), 0.0)
+        wall = values.get(("paulstretch_render_wall_seconds_total", labels), 0.0)
+        audio = values.get(("paulstretch_output_audio_seconds_total", labels), 0.0)
+        print ("%s: %d renders, %.1f s of audio in %.1f s (%.1fx realtime)"
+               % (labels, renders, audio, wall, audio / wall if wall > 0.0 else 0.0))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Memory footprint benchmark of the engines.
+
+Each engine is run on synthetic inputs of increasing length, with several
+window sizes, in a fresh interpreter per case. For every case this records
+the tracemalloc peak of load_wav (relative to the size of the loaded
+samples), the tracemalloc peak of the render itself (what the engine
+allocates besides its input: it must not grow with the input length, the
+output is written as it is made) and the peak RSS of the process.
+
+The results are compared to the budgets recorded in
+paulstretch_memory_budget.json; the program exits with an error when a
+case goes over its budget or when the render memory grows with the input
+length.
+
+    python paulstretch_memory.py            # check against the budgets
+    python paulstretch_memory.py --record   # record new budgets (after an intended change)
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+BUDGET_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "paulstretch_memory_budget.json")
+
+METHODS = ("mono", "stereo", "newmethod")
+LENGTHS = (5.0, 20.0, 80.0)
+WINDOWS = (0.1, 0.5)
+SAMPLERATE = 44100
+
+# allowed excess over a recorded value: relative, plus an absolute slack for the small values
+TOLERANCE = 0.2
+SLACK = {"load_ratio": 0.1, "render_peak_kb": 256.0, "rss_mb": 16.0}
+# the render memory of the longest input may exceed the shortest's by this much
+GROWTH_TOLERANCE = 0.1
+GROWTH_SLACK_KB = 256.0
+
+
+def make_input(filename, seconds, samplerate=SAMPLERATE):
+    """Write a stereo 16 bit wav of noise, seconds long"""
+    import numpy as np
+    from paulstretch_wavwriter import WavWriter
+    rng = np.random.default_rng(0)
+    with WavWriter(filename, samplerate, 2) as outfile:
+        # in one second blocks, so the generator doesn't add to the measurement
+        for start in range(0, int(seconds * samplerate), samplerate):
+            nframes = min(samplerate, int(seconds * samplerate) - start)
+            outfile.write(rng.uniform(-0.5, 0.5, (2, nframes)))
+
+
+def measure(method, input_filename, windowsize_seconds, output_filename):
+    """Measure one case in the current process (called in a fresh interpreter)"""
+    import resource
+    import tracemalloc
+    import paulstretch_methods
+    from paulstretch_context import RenderContext
+    # import before measuring, the modules are not part of the footprint
+    paulstretch_methods.get_engine(method)
+
+    tracemalloc.start()
+    samplerate, smp = paulstretch_methods.load_wav(method, input_filename)
+    load_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    context = RenderContext(seed=1, progress=lambda percentage: None)
+    paulstretch_methods.run(method, samplerate, smp, 1.0, windowsize_seconds, output_filename, 10.0, context)
+    render_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+    return {
+        "input_mb": smp.nbytes / (1024.0 * 1024.0),
+        "load_ratio": load_peak / float(smp.nbytes),
+        "render_peak_kb": render_peak / 1024.0,
+        "rss_mb": rss_mb,
+    }
+
+
+def case_key(method, seconds, windowsize_seconds):
+    return "%s/%g/%g" % (method, seconds, windowsize_seconds)
+
+
+def run_cases(methods, lengths, windows, stream=sys.stdout):
+    """Measure every case in its own interpreter, return {case key: results}"""
+    script = os.path.abspath(__file__)
+    directory = tempfile.mkdtemp(prefix="paulstretch_memory_")
+    results = {}
+    try:
+        stream.write("%-22s %9s %10s %14s %9s\n" % ("case", "input MB", "load peak", "render peak", "RSS MB"))
+        for seconds in lengths:
+            input_filename = os.path.join(directory, "input_%g.wav" % seconds)
+            make_input(input_filename, seconds)
+            for method in methods:
+                for window in windows:
+                    command = [sys.executable, script, "--measure", method, input_filename, repr(window),
+                               os.path.join(directory, "output.wav")]
+                    result = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True,
+                                            cwd=os.path.dirname(script))
+                    if result.returncode != 0:
+                        raise RuntimeError("measurement of %s failed" % case_key(method, seconds, window))
+                    key = case_key(method, seconds, window)
+                    results[key] = json.loads(result.stdout)
+                    stream.write("%-22s %9.1f %9.2fx %11.0f kB %9.1f\n" % (
+                        key, results[key]["input_mb"], results[key]["load_ratio"],
+                        results[key]["render_peak_kb"], results[key]["rss_mb"]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def check(results, budgets, methods, lengths, windows):
+    """Return the list of failures: cases over budget and render memory growing with the input length"""
+    failures = []
+    for key, measured in sorted(results.items()):
+        budget = budgets.get(key)
+        if budget is None:
+            continue
+        for name in ("load_ratio", "render_peak_kb", "rss_mb"):
+            limit = budget[name] * (1.0 + TOLERANCE) + SLACK[name]
+            if measured[name] > limit:
+                failures.append("%s: %s %.2f over the budget %.2f" % (key, name, measured[name], limit))
+    shortest, longest = min(lengths), max(lengths)
+    if shortest != longest:
+        for method in methods:
+            for window in windows:
+                short = results[case_key(method, shortest, window)]["render_peak_kb"]
+                long = results[case_key(method, longest, window)]["render_peak_kb"]
+                if long > short * (1.0 + GROWTH_TOLERANCE) + GROWTH_SLACK_KB:
+                    failures.append("%s window %g: render memory grows with the input length (%.0f kB for %gs, %.0f kB for %gs)"
+                                    % (method, window, short, shortest, long, longest))
+    return failures
+
+
+def _number_list(text):
+    return [float(x) for x in text.split(",") if x.strip()]
+
+
+########################################
+if __name__ == "__main__":
+    if len(sys.argv) == 6 and sys.argv[1] == "--measure":
+        print (json.dumps(measure(sys.argv[2], sys.argv[3], float(sys.argv[4]), sys.argv[5])))
+        sys.exit(0)
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-m", "--methods", dest="methods",help="comma separated methods",default=",".join(METHODS))
+    parser.add_option("-l", "--lengths", dest="lengths",help="comma separated input lengths (seconds)",default=",".join("%g" % x for x in LENGTHS))
+    parser.add_option("-w", "--windows", dest="windows",help="comma separated window sizes (seconds)",default=",".join("%g" % x for x in WINDOWS))
+    parser.add_option("--record", dest="record",help="record the results as the new budgets",action="store_true",default=False)
+    (options, args) = parser.parse_args()
+
+    methods = [method for method in options.methods.split(",") if method]
+    try:
+        lengths = _number_list(options.lengths)
+        windows = _number_list(options.windows)
+    except ValueError:
+        lengths = windows = []
+    if (not methods or not lengths or not windows or [method for method in methods if method not in METHODS]
+            or min(lengths) <= 0.0 or min(windows) <= 0.001):
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    results = run_cases(methods, lengths, windows)
+
+    budgets = {}
+    if os.path.exists(BUDGET_FILENAME):
+        with open(BUDGET_FILENAME) as f:
+            budgets = json.load(f)
+    if options.record:
+        budgets.update(results)
+        with open(BUDGET_FILENAME, "w") as f:
+            json.dump(budgets, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print ("budgets recorded in %s" % BUDGET_FILENAME)
+        sys.exit(0)
+
+    missing = [key for key in results if key not in budgets]
+    if missing:
+        print ("no budget for %s (record them with --record)" % ", ".join(missing))
+    failures = check(results, budgets, methods, lengths, windows)
+    if failures:
+        print ("")
+        for failure in failures:
+            print ("FAIL %s" % failure)
+        sys.exit(1)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Common entry point for the three Paulstretch engines.
+
+The engines have slightly different signatures (only the new method takes
+an onset level), so the helpers and the GUI call them through here instead
+of repeating the if/elif chain on the method name.
+"""
+import importlib
+
+from paulstretch_context import RenderContext
+
+# method name -> engine module
+METHODS = {
+    "mono": "paulstretch_mono",
+    "stereo": "paulstretch_stereo",
+    "newmethod": "paulstretch_newmethod",
+}
+
+
+def get_engine(method):
+    """Return the engine module for a method name"""
+    if method not in METHODS:
+        raise ValueError("Unknown method: %s (expected one of %s)" % (method, ", ".join(METHODS)))
+    return importlib.import_module(METHODS[method])
+
+
+def load_wav(method, filename):
+    """Load a wav file in the layout expected by the engine (mono or 2 channels)"""
+    return get_engine(method).load_wav(filename)
+
+
+def run(method, samplerate, smp, stretch, windowsize_seconds, outfilename, onset_level=10.0, context=None, **options):
+    """Run the engine of the given method
+
+    Without a context, one is made from the extra keyword options (see
+    paulstretch_context.RenderContext).
+    """
+    engine = get_engine(method)
+    if context is None:
+        context = RenderContext(**options)
+    if method == "newmethod":
+        return engine.paulstretch(samplerate, smp, stretch, windowsize_seconds, float(onset_level), outfilename, context)
+    return engine.paulstretch(samplerate, smp, stretch, windowsize_seconds, outfilename, context)
@@ -10,14 +10,13 @@
 #
 
 
-import sys
-from numpy import *
-import scipy.io.wavfile
-import wave
+from numpy import append, arange, cos, dot, exp, fft, floor, linspace, pi, sqrt, zeros
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
 
 def load_wav(filename):
     try:
-        wavedata=scipy.io.wavfile.read(filename)
+        wavedata=paulstretch_wavreader.read(filename)
         samplerate=int(wavedata[0])
         smp=wavedata[1]*(1.0/32768.0)
         if len(smp.shape)>1: #convert to mono
@@ -31,11 +30,17 @@ def load_wav(filename):
 
 ########################################
 
-def paulstretch(samplerate,smp,stretch,windowsize_seconds,outfilename):
-    outfile=wave.open(outfilename,"wb")
-    outfile.setsampwidth(2)
-    outfile.setframerate(samplerate)
-    outfile.setnchannels(1)
+def paulstretch(samplerate,smp,stretch,windowsize_seconds,outfilename,context=None):
+    if context is None:
+        context=RenderContext()
+
+    #continue from the last checkpoint of an interrupted render
+    state=context.resume_state(outfilename,{"engine":"mono","samplerate":samplerate,"nsamples":len(smp),"stretch":stretch,"windowsize_seconds":windowsize_seconds},smp)
+
+    #the output can go only to output_callback, without any file
+    outfile=None
+    if outfilename is not None:
+        outfile=context.open_output(outfilename,samplerate,1,expected_frames=int(len(smp)*stretch))
 
     #make sure that windowsize is even and larger than 16
     windowsize=int(windowsize_seconds*samplerate)
@@ -58,55 +63,82 @@ def paulstretch(samplerate,smp,stretch,windowsize_seconds,outfilename):
     #create Hann window
     window=0.5-cos(arange(windowsize,dtype='float')*2.0*pi/(windowsize-1))*0.5
 
+    #random generator for the phases, a given seed makes the render reproducible
+    rng=context.rng
+    silence_threshold=context.silence_threshold
+
     old_windowed_buf=zeros(windowsize)
     hinv_sqrt2=(1+sqrt(0.5))*0.5
     hinv_buf=hinv_sqrt2-(1.0-hinv_sqrt2)*cos(arange(half_windowsize,dtype='float')*2.0*pi/half_windowsize)
 
-    while True:
+    if state is not None:
+        start_pos=float(state["start_pos"])
+        old_windowed_buf=state["old_windowed_buf"]
 
-        #get the windowed buffer
-        istart_pos=int(floor(start_pos))
-        buf=smp[istart_pos:istart_pos+windowsize]
-        if len(buf)<windowsize:
-            buf=append(buf,zeros(windowsize-len(buf)))
-        buf=buf*window
+    #a cancelled or failed render still leaves a valid (partial) output file and no scratch file
+    try:
+        while True:
+
+            #get the windowed buffer
+            istart_pos=int(floor(start_pos))
+            buf=smp[istart_pos:istart_pos+windowsize]
+            if len(buf)<windowsize:
+                buf=append(buf,zeros(windowsize-len(buf)))
+
+            #skip the FFTs of the frames which are quieter than the threshold
+            #the overlap-add tail of the previous frame decays normally
+            if silence_threshold>0.0 and sqrt(dot(buf,buf)/windowsize)<silence_threshold:
+                buf=zeros(windowsize)
+                #keep the random sequence aligned with a render without skipping
+                rng.bit_generator.advance(half_windowsize+1)
+            else:
+                buf=buf*window
     
-        #get the amplitudes of the frequency components and discard the phases
-        freqs=abs(fft.rfft(buf))
-
-        #randomize the phases by multiplication with a random complex number with modulus=1
-        ph=random.uniform(0,2*pi,len(freqs))*1j
-        freqs=freqs*exp(ph)
-
-        #do the inverse FFT 
-        buf=fft.irfft(freqs)
-
-        #window again the output buffer
-        buf*=window
-
-
-        #overlap-add the output
-        output=buf[0:half_windowsize]+old_windowed_buf[half_windowsize:windowsize]
-        old_windowed_buf=buf
-
-        #remove the resulted amplitude modulation
-        output*=hinv_buf
-        
-        #clamp the values to -1..1 
-        output[output>1.0]=1.0
-        output[output<-1.0]=-1.0
-
-        #write the output to wav file
-        outfile.writeframes(int16(output*32767.0).tobytes())
-
-        start_pos+=displace_pos
-        if start_pos>=len(smp):
-            print ("100 %")
-            break
-        sys.stdout.write ("%d %% \r" % int(100.0*start_pos/len(smp)))
-        sys.stdout.flush()
-
-    outfile.close()
+                #get the amplitudes of the frequency components and discard the phases
+                freqs=abs(fft.rfft(buf))
+                context.report_spectrum(freqs)
+
+                #randomize the phases by multiplication with a random complex number with modulus=1
+                ph=rng.uniform(0,2*pi,len(freqs))*1j
+                freqs=freqs*exp(ph)
+
+                #do the inverse FFT 
+                buf=fft.irfft(freqs)
+
+                #window again the output buffer
+                buf*=window
+
+
+            #overlap-add the output
+            output=buf[0:half_windowsize]+old_windowed_buf[half_windowsize:windowsize]
+            old_windowed_buf=buf
+
+            #remove the resulted amplitude modulation
+            output*=hinv_buf
+
+            #write the output to wav file (the encoder clamps the values to -1..1 for the integer formats)
+            if outfile is not None:
+                outfile.write(output)
+            context.write_output(output)
+
+            start_pos+=displace_pos
+            if start_pos>=len(smp):
+                context.report_progress(100)
+                break
+            context.report_progress(int(100.0*start_pos/len(smp)))
+
+            #save the state now and then, to resume after a crash
+            if context.checkpoint_due():
+                context.save_checkpoint(outfile,start_pos=start_pos,old_windowed_buf=old_windowed_buf)
+    except BaseException:
+        if outfile is not None:
+            outfile.abort()
+        raise
+
+    if outfile is not None:
+        outfile.close()
+        context.remove_checkpoint()
+    context.render_complete()
 ########################################
 
 if __name__ == "__main__":
@@ -13,19 +13,16 @@
 
 
 import sys
-from numpy import *
-import scipy.io.wavfile
-import wave
+from numpy import append, arange, array, cos, exp, fft, floor, linspace, mean, pi, sqrt, tile, vdot, zeros
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
+from paulstretch_wavwriter import FORMATS
 from optparse import OptionParser
 
-plot_onsets=False
-if plot_onsets:
-    import matplotlib.pyplot as plt
-
 
 def load_wav(filename):
     try:
-        wavedata=scipy.io.wavfile.read(filename)
+        wavedata=paulstretch_wavreader.read(filename)
         samplerate=int(wavedata[0])
         smp=wavedata[1]*(1.0/32768.0)
         smp=smp.transpose()
@@ -54,17 +51,85 @@ def optimize_windowsize(n):
         orig_n+=1
     return orig_n
 
-def paulstretch(samplerate,smp,stretch,windowsize_seconds,onset_level,outfilename):
 
-    if plot_onsets:
-        onsets=[]
+NUM_BINS_SCALED_FREQ=32
+
+def onset_measure(freqs,old_freqs_scaled):
+    """Onset value (0..1) of an input frame from its amplitude spectrum (channels x bins)
+    and the scaled spectrum of the previous frame; returns (m,freqs_scaled)"""
+    #scale down the spectrum to detect onsets
+    freqs_len=freqs.shape[1]
+    if NUM_BINS_SCALED_FREQ<freqs_len:
+        freqs_len_div=freqs_len//NUM_BINS_SCALED_FREQ
+        new_freqs_len=freqs_len_div*NUM_BINS_SCALED_FREQ
+        freqs_scaled=mean(mean(freqs,0)[:new_freqs_len].reshape([NUM_BINS_SCALED_FREQ,freqs_len_div]),1)
+    else:
+        freqs_scaled=zeros(NUM_BINS_SCALED_FREQ)
+
+    m=2.0*mean(freqs_scaled-old_freqs_scaled)/(mean(abs(old_freqs_scaled))+1e-3)
+    if m<0.0:
+        m=0.0
+    if m>1.0:
+        m=1.0
+    return (m,freqs_scaled)
+
+
+class OnsetSchedule:
+    """
+    The hop schedule of the new method: every output hop crossfades the
+    spectra of two consecutive input frames with the weight displace_tick,
+    which grows by 1/stretch per hop; at an onset it jumps to the new frame
+    at once and the time saved is given back later at half speed.
+    The engine, the sweeps and the range renderer all step this one.
+    """
+    def __init__(self,stretch,onset_level,displace_tick=0.0,extra_onset_time_credit=0.0,get_next_buf=True):
+        self.onset_level=onset_level
+        self.displace_tick_increase=1.0/stretch
+        if self.displace_tick_increase>1.0:
+            self.displace_tick_increase=1.0
+        self.displace_tick=displace_tick
+        self.extra_onset_time_credit=extra_onset_time_credit
+        #the next hop starts a new input frame
+        self.get_next_buf=get_next_buf
+
+    def new_frame(self,m):
+        """Called with the onset value of the new input frame when get_next_buf is set"""
+        if m>self.onset_level:
+            self.displace_tick=1.0
+            self.extra_onset_time_credit+=1.0
+
+    def next_hop(self):
+        """Move on after a hop; get_next_buf tells if the next hop needs a new input frame"""
+        self.get_next_buf=False
+        if self.extra_onset_time_credit<=0.0:
+            self.displace_tick+=self.displace_tick_increase
+        else:
+            credit_get=0.5*self.displace_tick_increase #this must be less than displace_tick_increase
+            self.extra_onset_time_credit-=credit_get
+            if self.extra_onset_time_credit<0:
+                self.extra_onset_time_credit=0
+            self.displace_tick+=self.displace_tick_increase-credit_get
+
+        if self.displace_tick>=1.0:
+            self.displace_tick=self.displace_tick % 1.0
+            self.get_next_buf=True
+
+
+def paulstretch(samplerate,smp,stretch,windowsize_seconds,onset_level,outfilename,context=None):
+
+    if context is None:
+        context=RenderContext()
 
     nchannels=smp.shape[0]
 
-    outfile=wave.open(outfilename,"wb")
-    outfile.setsampwidth(2)
-    outfile.setframerate(samplerate)
-    outfile.setnchannels(nchannels)
+    #continue from the last checkpoint of an interrupted render
+    state=context.resume_state(outfilename,{"engine":"newmethod","samplerate":samplerate,"nsamples":smp.shape[1],"nchannels":nchannels,
+                                            "stretch":stretch,"windowsize_seconds":windowsize_seconds,"onset_level":onset_level},smp)
+
+    #the output can go only to output_callback, without any file
+    outfile=None
+    if outfilename is not None:
+        outfile=context.open_output(outfilename,samplerate,nchannels,expected_frames=int(smp.shape[1]*stretch))
 
     #make sure that windowsize is even and larger than 16
     windowsize=int(windowsize_seconds*samplerate)
@@ -90,117 +155,153 @@ def paulstretch(samplerate,smp,stretch,windowsize_seconds,onset_level,outfilenam
     #create Hann window
     window=0.5-cos(arange(windowsize,dtype='float')*2.0*pi/(windowsize-1))*0.5
 
+    #random generator for the phases, a given seed makes the render reproducible
+    rng=context.rng
+    silence_threshold=context.silence_threshold
+
     old_windowed_buf=zeros((2,windowsize))
     hinv_sqrt2=(1+sqrt(0.5))*0.5
     hinv_buf=2.0*(hinv_sqrt2-(1.0-hinv_sqrt2)*cos(arange(half_windowsize,dtype='float')*2.0*pi/half_windowsize))/hinv_sqrt2
 
     freqs=zeros((2,half_windowsize+1))
     old_freqs=freqs
+    silent=True
+    old_silent=True
 
-    num_bins_scaled_freq=32
-    freqs_scaled=zeros(num_bins_scaled_freq)
+    freqs_scaled=zeros(NUM_BINS_SCALED_FREQ)
     old_freqs_scaled=freqs_scaled
 
-    displace_tick=0.0
-    displace_tick_increase=1.0/stretch
-    if displace_tick_increase>1.0:
-        displace_tick_increase=1.0
-    extra_onset_time_credit=0.0
-    get_next_buf=True
-    while True:
-        if get_next_buf:
-            old_freqs=freqs
-            old_freqs_scaled=freqs_scaled
-
-            #get the windowed buffer
-            istart_pos=int(floor(start_pos))
-            buf=smp[:,istart_pos:istart_pos+windowsize]
-            if buf.shape[1]<windowsize:
-                buf=append(buf,zeros((2,windowsize-buf.shape[1])),1)
-            buf=buf*window
-    
-            #get the amplitudes of the frequency components and discard the phases
-            freqs=abs(fft.rfft(buf))
-
-            #scale down the spectrum to detect onsets
-            freqs_len=freqs.shape[1]
-            if num_bins_scaled_freq<freqs_len:
-                freqs_len_div=freqs_len//num_bins_scaled_freq
-                new_freqs_len=freqs_len_div*num_bins_scaled_freq
-                freqs_scaled=mean(mean(freqs,0)[:new_freqs_len].reshape([num_bins_scaled_freq,freqs_len_div]),1)
-            else:
-                freqs_scaled=zeros(num_bins_scaled_freq)
-
-
-            #process onsets
-            m=2.0*mean(freqs_scaled-old_freqs_scaled)/(mean(abs(old_freqs_scaled))+1e-3)
-            if m<0.0:
-                m=0.0
-            if m>1.0:
-                m=1.0
-            if plot_onsets:
-                onsets.append(m)
-            if m>onset_level:
-                displace_tick=1.0
-                extra_onset_time_credit+=1.0
-
-        cfreqs=(freqs*displace_tick)+(old_freqs*(1.0-displace_tick))
-
-        #randomize the phases by multiplication with a random complex number with modulus=1
-        ph=random.uniform(0,2*pi,(nchannels,cfreqs.shape[1]))*1j
-        cfreqs=cfreqs*exp(ph)
-
-        #do the inverse FFT 
-        buf=fft.irfft(cfreqs)
-
-        #window again the output buffer
-        buf*=window
-
-        #overlap-add the output
-        output=buf[:,0:half_windowsize]+old_windowed_buf[:,half_windowsize:windowsize]
-        old_windowed_buf=buf
-
-        #remove the resulted amplitude modulation
-        output*=hinv_buf
-        
-        #clamp the values to -1..1 
-        output[output>1.0]=1.0
-        output[output<-1.0]=-1.0
-
-        #write the output to wav file
-        outfile.writeframes(int16(output.ravel('F')*32767.0).tobytes())
-
-        if get_next_buf:
-            start_pos+=displace_pos
+    schedule=OnsetSchedule(stretch,onset_level)
 
-        get_next_buf=False
+    if state is not None:
+        start_pos=float(state["start_pos"])
+        old_windowed_buf=state["old_windowed_buf"]
+        freqs,old_freqs=state["freqs"],state["old_freqs"]
+        freqs_scaled,old_freqs_scaled=state["freqs_scaled"],state["old_freqs_scaled"]
+        silent,old_silent=bool(state["silent"]),bool(state["old_silent"])
+        schedule=OnsetSchedule(stretch,onset_level,float(state["displace_tick"]),float(state["extra_onset_time_credit"]),
+                               bool(state["get_next_buf"]))
 
-        if start_pos>=nsamples:
-            print ("100 %")
-            break
-        sys.stdout.write ("%d %% \r" % int(100.0*start_pos/nsamples))
-        sys.stdout.flush()
+    #hops synthesized together: 1 MB of complex spectra at most, many hops for the
+    #small windows where the per hop overhead matters, few for the large ones
+    batch_size=max(1,min(256,(1<<20)//(nchannels*(half_windowsize+1)*16)))
 
+    done=False
+    #a cancelled or failed render still leaves a valid (partial) output file and no scratch file
+    try:
+        while not done:
+            #schedule: run the onset state machine for a batch of hops, analyzing the
+            #input frames as it reaches them; hop k interpolates between the frames
+            #hop_frame[k]-1 and hop_frame[k] of batch_freqs with the weight hop_tick[k]
+            batch_freqs=[old_freqs,freqs]
+            batch_silent=[old_silent,silent]
+            hop_frame=[]
+            hop_tick=[]
+            while len(hop_frame)<batch_size:
+                if schedule.get_next_buf:
+                    old_freqs=freqs
+                    old_freqs_scaled=freqs_scaled
+                    old_silent=silent
+
+                    #get the windowed buffer
+                    istart_pos=int(floor(start_pos))
+                    buf=smp[:,istart_pos:istart_pos+windowsize]
+                    if buf.shape[1]<windowsize:
+                        buf=append(buf,zeros((2,windowsize-buf.shape[1])),1)
+
+                    #skip the FFT of the frames which are quieter than the threshold
+                    silent=silence_threshold>0.0 and sqrt(vdot(buf,buf)/buf.size)<silence_threshold
+                    if silent:
+                        freqs=zeros((nchannels,half_windowsize+1))
+                    else:
+                        buf=buf*window
         
-        if extra_onset_time_credit<=0.0:
-            displace_tick+=displace_tick_increase
-        else:
-            credit_get=0.5*displace_tick_increase #this must be less than displace_tick_increase
-            extra_onset_time_credit-=credit_get
-            if extra_onset_time_credit<0:
-                extra_onset_time_credit=0
-            displace_tick+=displace_tick_increase-credit_get
+                        #get the amplitudes of the frequency components and discard the phases
+                        freqs=abs(fft.rfft(buf))
+                    batch_freqs.append(freqs)
+                    batch_silent.append(silent)
+
+                    #process onsets
+                    (m,freqs_scaled)=onset_measure(freqs,old_freqs_scaled)
+                    if context.plot_onsets:
+                        context.onsets.append(m)
+                    schedule.new_frame(m)
+
+                hop_frame.append(len(batch_freqs)-1)
+                hop_tick.append(schedule.displace_tick)
+
+                if schedule.get_next_buf:
+                    start_pos+=displace_pos
+
+                if start_pos>=nsamples:
+                    done=True
+                    break
+
+                schedule.next_hop()
+
+            #synthesis of the whole batch at once: hops x channels x bins
+            nhops=len(hop_frame)
+            batch_freqs=array(batch_freqs)
+            batch_silent=array(batch_silent)
+            hop_frame=array(hop_frame)
+            hop_tick=array(hop_tick).reshape(nhops,1,1)
+            cfreqs=(batch_freqs[hop_frame]*hop_tick)+(batch_freqs[hop_frame-1]*(1.0-hop_tick))
+            context.report_spectrum(cfreqs[-1])
+
+            #randomize the phases by multiplication with a random complex number with modulus=1
+            #(the same random sequence as one hop at a time, the hops between silent frames included)
+            ph=rng.uniform(0,2*pi,(nhops,nchannels,half_windowsize+1))*1j
+
+            #when both frames are silent the interpolated spectrum is zero too, so the
+            #inverse FFT is skipped and the overlap-add tail of the previous buffer decays normally
+            audible=~(batch_silent[hop_frame]&batch_silent[hop_frame-1])
+            bufs=zeros((nhops,nchannels,windowsize))
+            if audible.all():
+                bufs=fft.irfft(cfreqs*exp(ph))
+            elif audible.any():
+                bufs[audible]=fft.irfft(cfreqs[audible]*exp(ph[audible]))
+
+            #window again the output buffers
+            bufs*=window
+
+            #overlap-add the output: each hop adds the tail of the previous buffer
+            outputs=bufs[:,:,0:half_windowsize].copy()
+            outputs[0]+=old_windowed_buf[:,half_windowsize:windowsize]
+            outputs[1:]+=bufs[:-1,:,half_windowsize:windowsize]
+            #a copy, so that the buffers of the batch can be freed
+            old_windowed_buf=bufs[-1].copy()
+
+            #remove the resulted amplitude modulation
+            outputs*=hinv_buf
+
+            #write the output to wav file (the encoder clamps the values to -1..1 for the integer formats),
+            #one hop at a time like the engine always did, which keeps the dither noise sequence
+            for output in outputs:
+                if outfile is not None:
+                    outfile.write(output)
+                context.write_output(output)
+
+            if done:
+                context.report_progress(100)
+                break
+            context.report_progress(int(100.0*start_pos/nsamples))
+
+            #save the state now and then, to resume after a crash
+            if context.checkpoint_due():
+                context.save_checkpoint(outfile,start_pos=start_pos,old_windowed_buf=old_windowed_buf,
+                                        freqs=freqs,old_freqs=old_freqs,freqs_scaled=freqs_scaled,old_freqs_scaled=old_freqs_scaled,
+                                        silent=silent,old_silent=old_silent,displace_tick=schedule.displace_tick,
+                                        extra_onset_time_credit=schedule.extra_onset_time_credit,get_next_buf=schedule.get_next_buf)
+    except BaseException:
+        if outfile is not None:
+            outfile.abort()
+        raise
+
+    if outfile is not None:
+        outfile.close()
+        context.remove_checkpoint()
+    context.render_complete()
 
-        if displace_tick>=1.0:
-            displace_tick=displace_tick % 1.0
-            get_next_buf=True
-
-    outfile.close()
-    
-    if plot_onsets:
-        plt.plot(onsets)
-        plt.show()
-    
 
 ########################################
 if __name__ == "__main__":
@@ -211,25 +312,79 @@ if __name__ == "__main__":
     parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
     parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
     parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (0.0=max,1.0=min)",type="float",default=10.0)
+    parser.add_option("-d", "--draft", dest="draft",help="draft quality: render at 1/DRAFT of the sample rate (1, 2, 4 or 8)",type="int",default=1)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases (makes the render reproducible)",type="int",default=None)
+    parser.add_option("-q", "--silence_threshold", dest="silence_threshold",help="skip the frames quieter than this RMS level (dB, e.g. -80)",type="float",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("--dither", dest="dither",help="add TPDF dither to the integer output formats",action="store_true",default=False)
+    parser.add_option("-n", "--normalize", dest="normalize",help="normalize the output to this peak level (dB, e.g. -1) instead of clipping",type="float",default=None)
+    parser.add_option("-c", "--checkpoint", dest="checkpoint",help="save the render state every CHECKPOINT seconds, to resume it after a crash",type="float",default=None)
+    parser.add_option("--resume", dest="resume",help="continue the render from the checkpoint of the output file",action="store_true",default=False)
+    parser.add_option("--manifest", dest="manifest",help="write a json manifest of the run (parameters, times, sizes) to this file",default=None)
+    parser.add_option("--metrics", dest="metrics",help="add the run to this Prometheus textfile collector file (default: $PAULSTRETCH_METRICS)",default=None)
+    parser.add_option("--dry-run", dest="dry_run",help="estimate the time, memory and disk space of the (full quality) render and exit",action="store_true",default=False)
+    parser.add_option("-p", "--plot_onsets", dest="plot_onsets",help="plot the onsets curve at the end (needs matplotlib)",action="store_true",default=False)
     (options, args) = parser.parse_args()
 
 
-    if (len(args)<2) or (options.stretch<=0.0) or (options.window_size<=0.001):
+    if (len(args)<2) or (options.stretch<=0.0) or (options.window_size<=0.001) or (options.draft not in (1,2,4,8)) or (options.format not in FORMATS) or \
+       (options.normalize is not None and (options.checkpoint is not None or options.resume)):
         print ("Error in command line parameters. Run this program with --help for help.")
         sys.exit(1)
 
     print ("stretch amount = %g" % options.stretch)
     print ("window size = %g seconds" % options.window_size)
     print ("onset sensitivity = %g" % options.onset)
+    if options.seed is not None:
+        print ("random seed = %d" % options.seed)
+    if options.format!="pcm16" or options.dither:
+        print ("output format = %s%s" % (options.format," with dither" if options.dither else ""))
+    normalize=None
+    if options.normalize is not None:
+        print ("normalize to %g dB" % options.normalize)
+        normalize=pow(10.0,options.normalize/20.0)
+    silence_threshold=0.0
+    if options.silence_threshold is not None:
+        print ("silence threshold = %g dB" % options.silence_threshold)
+        silence_threshold=pow(10.0,options.silence_threshold/20.0)
+    context=RenderContext(seed=options.seed, silence_threshold=silence_threshold,
+                          output_format=options.format, dither=options.dither,
+                          checkpoint_interval=options.checkpoint, resume=options.resume, normalize=normalize,
+                          manifest=options.manifest, metrics=options.metrics, input_filename=args[0],
+                          plot_onsets=options.plot_onsets)
     
     # Only read and process input file when directly running the script
     input_filename = args[0]
     output_filename = args[1]
     
+    if options.dry_run:
+        import paulstretch_estimate
+        try:
+            cost=paulstretch_estimate.estimate(input_filename,"newmethod",options.stretch,options.window_size,options.format,options.normalize is not None,
+                                               onset_level=options.onset)
+        except Exception:
+            print ("Error loading wav: "+input_filename)
+            sys.exit(1)
+        print (paulstretch_estimate.report(cost))
+        problems=paulstretch_estimate.admission_problems(cost,output_filename)
+        for problem in problems:
+            print ("does not fit: %s" % problem)
+        sys.exit(1 if problems else 0)
+
     samplerate_and_samples = load_wav(input_filename)
     if samplerate_and_samples is not None:
         (samplerate, smp) = samplerate_and_samples
-        paulstretch(samplerate, smp, options.stretch, options.window_size, options.onset, output_filename)
+        if options.draft>1:
+            import paulstretch_draft
+            report=paulstretch_draft.draft_paulstretch("newmethod", samplerate, smp, options.stretch, options.window_size, output_filename,
+                                                       options.onset, options.draft, context=context)
+            print (report)
+        else:
+            paulstretch(samplerate, smp, options.stretch, options.window_size, options.onset, output_filename, context)
+        if options.plot_onsets:
+            import matplotlib.pyplot as plt
+            plt.plot(context.onsets)
+            plt.show()
     else:
         print("Error: Could not process input file")
 
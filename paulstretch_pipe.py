@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Pipe mode: read the input from stdin and write the stretched sound to stdout.
+
+The input is either a wav stream (detected by its RIFF/RF64 header) or raw
+interleaved PCM, whose sample rate, channel count and format are given on
+the command line. The output is raw interleaved PCM in the output format,
+written in large blocks; the progress goes to stderr. No intermediate file
+is written:
+
+    ffmpeg -i input.mp3 -f s16le -ac 2 -ar 44100 - \\
+        | python paulstretch_pipe.py -R 44100 -C 2 -s 20 \\
+        | flac --endian=little --sign=signed --channels=2 --bps=16 --sample-rate=44100 -o output.flac -
+
+The input is read completely before the render starts (the engines need
+random access to it), which is small next to the stretched output.
+"""
+import io
+import os
+import sys
+import numpy as np
+from optparse import OptionParser
+
+import paulstretch_methods
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
+from paulstretch_wavwriter import FORMATS
+
+
+def decode_raw(data, nchannels, format="pcm16"):
+    """Raw interleaved little endian PCM bytes -> floats, samples x channels"""
+    if format not in FORMATS:
+        raise ValueError("Unknown input format: %s (expected one of %s)" % (format, ", ".join(FORMATS)))
+    sampwidth = FORMATS[format][0]
+    frame_size = nchannels * sampwidth
+    data = data[:len(data) - len(data) % frame_size]
+    if format == "float32":
+        samples = np.frombuffer(data, '<f4').astype(np.float64)
+    elif format == "pcm16":
+        samples = np.frombuffer(data, '<i2') * (1.0 / 32768.0)
+    elif format == "pcm32":
+        samples = np.frombuffer(data, '<i4') * (1.0 / 2147483648.0)
+    else:
+        # pcm24: put the 3 bytes in the high bytes of an int32
+        padded = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(data, np.uint8).reshape(-1, 3)
+        samples = padded.view('<i4').ravel() * (1.0 / 2147483648.0)
+    return samples.reshape(-1, nchannels)
+
+
+def decode_wav(data):
+    """wav (or RF64) bytes -> (samplerate, floats samples x channels)"""
+    samplerate, samples = paulstretch_wavreader.read(io.BytesIO(data))
+    if samples.dtype == np.uint8:
+        samples = (samples - 128.0) * (1.0 / 128.0)
+    elif samples.dtype.kind == "i":
+        samples = samples * (1.0 / 2 ** (samples.dtype.itemsize * 8 - 1))
+    else:
+        samples = samples.astype(np.float64)
+    if samples.ndim == 1:
+        samples = samples.reshape(-1, 1)
+    return int(samplerate), samples
+
+
+def engine_layout(method, samples):
+    """Arrange samples x channels like the load_wav of the engine: 1D for mono, channels x samples otherwise"""
+    if method == "mono":
+        if samples.shape[1] > 1:
+            return (samples[:, 0] + samples[:, 1]) * 0.5
+        return samples[:, 0].copy()
+    smp = samples.T.copy()
+    if smp.shape[0] == 1:
+        smp = np.tile(smp, (2, 1))
+    return smp
+
+
+def read_input(stream, method, samplerate=None, nchannels=None, format="pcm16"):
+    """Read the whole input stream, return (samplerate, smp) for the engine of method"""
+    data = stream.read()
+    if data[:4] in (b"RIFF", b"RF64"):
+        samplerate, samples = decode_wav(data)
+    else:
+        if samplerate is None or nchannels is None:
+            raise ValueError("Raw input needs the sample rate and the number of channels")
+        samples = decode_raw(data, nchannels, format)
+    if samples.shape[0] == 0:
+        raise ValueError("No input samples")
+    return samplerate, engine_layout(method, samples)
+
+
+def pipe(method, stretch, windowsize_seconds, onset_level=10.0, samplerate=None, nchannels=None, input_format="pcm16",
+         input_stream=None, output_stream=None, progress_stream=None, **options):
+    """Stretch input_stream (default: stdin) to raw PCM on output_stream (default: stdout)
+
+    Extra options (seed, silence_threshold, output_format, dither) go to the
+    render context. Returns the sample rate and the number of channels of
+    the output.
+    """
+    if input_stream is None:
+        input_stream = sys.stdin.buffer
+    if output_stream is None:
+        output_stream = sys.stdout.buffer
+    if progress_stream is None:
+        progress_stream = sys.stderr
+    samplerate, smp = read_input(input_stream, method, samplerate, nchannels, input_format)
+    context = RenderContext(stream=progress_stream, output_stream=output_stream, **options)
+    paulstretch_methods.run(method, samplerate, smp, stretch, windowsize_seconds, "-", onset_level, context)
+    return samplerate, 1 if smp.ndim == 1 else smp.shape[0]
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] < input > output.raw")
+    parser.add_option("-m", "--method", dest="method",help="processing method (mono, stereo, newmethod)",default="stereo")
+    parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (newmethod only)",type="float",default=10.0)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases",type="int",default=None)
+    parser.add_option("-q", "--silence_threshold", dest="silence_threshold",help="skip the frames quieter than this RMS level (dB, e.g. -80)",type="float",default=None)
+    parser.add_option("-R", "--rate", dest="rate",help="sample rate of a raw input",type="int",default=None)
+    parser.add_option("-C", "--channels", dest="channels",help="number of channels of a raw input",type="int",default=None)
+    parser.add_option("-i", "--input_format", dest="input_format",help="format of a raw input: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("--dither", dest="dither",help="add TPDF dither to the integer output formats",action="store_true",default=False)
+    parser.add_option("-n", "--normalize", dest="normalize",help="normalize the output to this peak level (dB, e.g. -1) instead of clipping",type="float",default=None)
+    (options, args) = parser.parse_args()
+
+    if ((options.method not in paulstretch_methods.METHODS) or (options.stretch<=0.0) or (options.window_size<=0.001)
+            or (options.input_format not in FORMATS) or (options.format not in FORMATS)):
+        sys.stderr.write("Error in command line parameters. Run this program with --help for help.\n")
+        sys.exit(1)
+
+    silence_threshold = 0.0
+    if options.silence_threshold is not None:
+        silence_threshold = pow(10.0, options.silence_threshold / 20.0)
+    normalize = None
+    if options.normalize is not None:
+        normalize = pow(10.0, options.normalize / 20.0)
+    try:
+        samplerate, nchannels = pipe(options.method, options.stretch, options.window_size, options.onset,
+                                     options.rate, options.channels, options.input_format,
+                                     seed=options.seed, silence_threshold=silence_threshold,
+                                     output_format=options.format, dither=options.dither, normalize=normalize)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    except BrokenPipeError:
+        # the reader went away: silence the flush of stdout at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    sys.stderr.write("output: %d Hz, %d channels, %s\n" % (samplerate, nchannels, options.format))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+Project renders: per-region parameters and incremental re-rendering.
+
+A project is a json file which splits the input into regions, each with its
+own stretch amount (and optionally its own seed and gain):
+
+    {
+        "input": "input.wav",
+        "output": "output.wav",
+        "window_size": 0.25,
+        "seed": 1,
+        "regions": [
+            {"start": 0.0, "stretch": 8.0},
+            {"start": 12.5, "stretch": 30.0, "gain": 0.8}
+        ]
+    }
+
+The frames of each region start at the region start and advance by that
+region's displacement, and their random phases come from a generator keyed
+on (seed, region start), so the content of a region does not depend on the
+other regions. Rendering records this frame-to-output mapping next to the
+project (project.json.map). When the project is rendered again only the
+regions whose parameters changed are computed, together with the overlap-add
+border hops shared with their neighbours, and spliced into the existing
+output file. If a region changes length the rest of the file is shifted in
+place, which is a plain copy without any FFT work.
+
+The stereo method (window and no amplitude correction) is used.
+
+usage: paulstretch_project.py render [--full] project.json
+       paulstretch_project.py map project.json
+"""
+import os
+import sys
+import json
+import struct
+import numpy as np
+from optparse import OptionParser
+
+import paulstretch_stereo
+from paulstretch_cache import hash_file
+from paulstretch_context import RenderContext
+from paulstretch_wavwriter import open_output, patch_sizes
+
+
+def load_project(filename):
+    """Read a project file, relative paths are relative to the project"""
+    with open(filename) as f:
+        project = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    for key in ("input", "output"):
+        project[key] = os.path.join(base_dir, project[key])
+    project.setdefault("window_size", 0.25)
+    project.setdefault("seed", 0)
+    if not project.get("regions"):
+        project["regions"] = [{"start": 0.0, "stretch": 8.0}]
+    return project
+
+
+def compute_layout(project, samplerate, nsamples, windowsize):
+    """The frame-to-output mapping of every region
+
+    Each region gets its input sample range, the displacement of its frames,
+    its number of frames and the output hop of its first frame.
+    """
+    half_windowsize = windowsize // 2
+    starts = [int(round(r["start"] * samplerate)) for r in project["regions"]]
+    layout = []
+    first_hop = 0
+    for i, region in enumerate(project["regions"]):
+        start = min(max(starts[i], 0), nsamples)
+        end = min(starts[i + 1], nsamples) if i + 1 < len(starts) else nsamples
+        if end <= start:
+            continue
+        displace_pos = half_windowsize / float(region["stretch"])
+        nframes = int(np.ceil((end - start) / displace_pos))
+        layout.append({
+            "start": start,
+            "end": end,
+            "stretch": float(region["stretch"]),
+            "seed": int(region.get("seed", project["seed"])),
+            "gain": float(region.get("gain", 1.0)),
+            "displace_pos": displace_pos,
+            "nframes": nframes,
+            "first_hop": first_hop,
+        })
+        first_hop += nframes
+    return layout
+
+
+def region_changed(old, new):
+    return any(old[key] != new[key] for key in ("start", "end", "stretch", "seed", "gain"))
+
+
+class FrameRenderer:
+    """Computes single frames of a region, the same way as paulstretch_stereo does"""
+    def __init__(self, smp, windowsize):
+        self.smp = smp
+        self.nchannels = smp.shape[0]
+        self.windowsize = windowsize
+        self.nbins = windowsize // 2 + 1
+        self.window = pow(1.0 - pow(np.linspace(-1.0, 1.0, windowsize), 2.0), 1.25)
+
+    def frame(self, region, k):
+        """Windowed output buffer of the k-th frame of a region"""
+        istart_pos = int(np.floor(region["start"] + k * region["displace_pos"]))
+        buf = self.smp[:, istart_pos:istart_pos + self.windowsize]
+        if buf.shape[1] < self.windowsize:
+            buf = np.append(buf, np.zeros((self.nchannels, self.windowsize - buf.shape[1])), 1)
+        freqs = np.abs(np.fft.rfft(buf * self.window))
+
+        # one random stream per region, positioned at the frame
+        bit_generator = np.random.PCG64(np.random.SeedSequence([region["seed"], region["start"]]))
+        bit_generator.advance(k * self.nchannels * self.nbins)
+        ph = np.random.Generator(bit_generator).uniform(0, 2 * np.pi, (self.nchannels, self.nbins)) * 1j
+
+        buf = np.fft.irfft(freqs * np.exp(ph))
+        buf *= self.window
+        return buf * region["gain"]
+
+    def hops(self, layout, index, k0, k1):
+        """Output hops of the frames k0..k1-1 of a region, as int16 interleaved bytes"""
+        region = layout[index]
+        half_windowsize = self.windowsize // 2
+        if k0 > 0:
+            old_windowed_buf = self.frame(region, k0 - 1)
+        elif index > 0:
+            old_windowed_buf = self.frame(layout[index - 1], layout[index - 1]["nframes"] - 1)
+        else:
+            old_windowed_buf = np.zeros((self.nchannels, self.windowsize))
+        blocks = []
+        for k in range(k0, k1):
+            buf = self.frame(region, k)
+            output = buf[:, 0:half_windowsize] + old_windowed_buf[:, half_windowsize:self.windowsize]
+            old_windowed_buf = buf
+            np.clip(output, -1.0, 1.0, out=output)
+            blocks.append(np.int16(output.ravel('F') * 32767.0).tobytes())
+        return b"".join(blocks)
+
+
+def find_data_offset(filename):
+    """Byte offset of the samples in a wav file"""
+    with open(filename, "rb") as f:
+        f.seek(12)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("No data chunk in %s" % filename)
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"data":
+                return f.tell()
+            f.seek(size + (size & 1), 1)
+
+
+def move_bytes(f, src, dst, length, block_size=4 * 1024 * 1024):
+    """Move length bytes inside a file from src to dst (like memmove)"""
+    if src == dst or length <= 0:
+        return
+    if dst < src:
+        done = 0
+        while done < length:
+            n = min(block_size, length - done)
+            f.seek(src + done)
+            data = f.read(n)
+            f.seek(dst + done)
+            f.write(data)
+            done += n
+    else:
+        done = length
+        while done > 0:
+            n = min(block_size, done)
+            f.seek(src + done - n)
+            data = f.read(n)
+            f.seek(dst + done - n)
+            f.write(data)
+            done -= n
+
+
+def progress(done, total):
+    if total > 0:
+        sys.stdout.write("%d %% \r" % int(100.0 * done / total))
+        sys.stdout.flush()
+
+
+def render(project_filename, full=False, context=None):
+    """Render a project, incrementally when a matching map exists
+
+    Returns the list of region indices which were rendered. The context
+    only receives the record of the run (its manifest and metrics), whose
+    frames are the ones rendered this time; the seeds and the output format
+    come from the project.
+    """
+    project = load_project(project_filename)
+    if context is None:
+        context = RenderContext(seed=project["seed"], input_filename=project["input"])
+    map_filename = project_filename + ".map"
+
+    samplerate, smp = paulstretch_stereo.load_wav(project["input"])
+    nchannels, nsamples = smp.shape
+    windowsize = int(project["window_size"] * samplerate)
+    if windowsize < 16:
+        windowsize = 16
+    windowsize = paulstretch_stereo.optimize_windowsize(windowsize)
+    windowsize = int(windowsize / 2) * 2
+    half_windowsize = windowsize // 2
+    hop_bytes = half_windowsize * nchannels * 2
+
+    # same end correction as the engine
+    end_size = max(int(samplerate * 0.05), 16)
+    smp[:, nsamples - end_size:nsamples] *= np.linspace(1, 0, end_size)
+
+    layout = compute_layout(project, samplerate, nsamples, windowsize)
+    renderer = FrameRenderer(smp, windowsize)
+    context.start_run({"engine": "project", "samplerate": samplerate, "nsamples": nsamples,
+                       "windowsize_seconds": project["window_size"], "windowsize": windowsize,
+                       "project": os.path.abspath(project_filename), "regions": len(layout), "full": full},
+                      project["output"], nchannels)
+    total_hops = sum(r["nframes"] for r in layout)
+    new_map = {
+        "input_hash": hash_file(project["input"]),
+        "samplerate": samplerate,
+        "nchannels": nchannels,
+        "windowsize": windowsize,
+        "regions": layout,
+    }
+
+    old_map = None
+    if not full and os.path.exists(map_filename) and os.path.exists(project["output"]):
+        with open(map_filename) as f:
+            old_map = json.load(f)
+        if any(old_map.get(key) != new_map[key] for key in ("input_hash", "samplerate", "nchannels", "windowsize")):
+            old_map = None
+
+    if old_map is None:
+        with open_output(project["output"], samplerate, nchannels, expected_frames=total_hops * half_windowsize) as outfile:
+            for i, region in enumerate(layout):
+                for k0 in range(0, region["nframes"], 64):
+                    k1 = min(k0 + 64, region["nframes"])
+                    outfile.writeframes(renderer.hops(layout, i, k0, k1))
+                    context.frames_processed += (k1 - k0) * half_windowsize
+                    progress(region["first_hop"] + k0, total_hops)
+        rendered = list(range(len(layout)))
+    else:
+        old_regions = {r["start"]: r for r in old_map["regions"]}
+        changed = [i for i, r in enumerate(layout) if r["start"] not in old_regions or region_changed(old_regions[r["start"]], r)]
+        # a region with a different start (added, removed or moved regions) can't be reused either
+        unchanged = [i for i in range(len(layout)) if i not in changed]
+        data_offset = find_data_offset(project["output"])
+        with open(project["output"], "r+b") as f:
+            # shift the unchanged regions to their new places; moving the
+            # regions which go backwards in ascending order and the ones
+            # which go forwards in descending order never overwrites data
+            # that still has to be moved
+            moves = [(old_regions[layout[i]["start"]]["first_hop"], layout[i]["first_hop"], layout[i]["nframes"]) for i in unchanged]
+            for old_hop, new_hop, nframes in [m for m in moves if m[1] < m[0]]:
+                move_bytes(f, data_offset + old_hop * hop_bytes, data_offset + new_hop * hop_bytes, nframes * hop_bytes)
+            for old_hop, new_hop, nframes in reversed([m for m in moves if m[1] > m[0]]):
+                move_bytes(f, data_offset + old_hop * hop_bytes, data_offset + new_hop * hop_bytes, nframes * hop_bytes)
+            patch_sizes(f, data_offset, total_hops * hop_bytes, nchannels * 2)
+
+            for i in changed:
+                region = layout[i]
+                f.seek(data_offset + region["first_hop"] * hop_bytes)
+                for k0 in range(0, region["nframes"], 64):
+                    k1 = min(k0 + 64, region["nframes"])
+                    f.write(renderer.hops(layout, i, k0, k1))
+                    context.frames_processed += (k1 - k0) * half_windowsize
+                    progress(k0, region["nframes"])
+                # the first hop of the next region overlaps the last frame of this one
+                if i + 1 < len(layout) and (i + 1) not in changed:
+                    f.seek(data_offset + layout[i + 1]["first_hop"] * hop_bytes)
+                    f.write(renderer.hops(layout, i + 1, 0, 1))
+                    context.frames_processed += half_windowsize
+        rendered = changed
+
+    with open(map_filename, "w") as f:
+        json.dump(new_map, f, indent=1)
+    print("100 %")
+    context.render_complete()
+    return rendered
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog render [--full] project_json\n       %prog map project_json")
+    parser.add_option("-f", "--full", dest="full",help="render everything, ignoring the previous render",action="store_true",default=False)
+    parser.add_option("--manifest", dest="manifest",help="write a json manifest of the run (parameters, times, sizes) to this file",default=None)
+    parser.add_option("--metrics", dest="metrics",help="add the run to this Prometheus textfile collector file (default: $PAULSTRETCH_METRICS)",default=None)
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2 or args[0] not in ("render", "map"):
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    if args[0] == "render":
+        project = load_project(args[1])
+        context = RenderContext(seed=project["seed"], manifest=options.manifest, metrics=options.metrics,
+                                input_filename=project["input"])
+        rendered = render(args[1], options.full, context)
+        print ("rendered regions: %s" % ", ".join(str(i) for i in rendered) if rendered else "nothing to render")
+    else:
+        with open(args[1] + ".map") as f:
+            output_map = json.load(f)
+        half_windowsize = output_map["windowsize"] // 2
+        rate = float(output_map["samplerate"])
+        for i, region in enumerate(output_map["regions"]):
+            print ("region %d: input %.3f-%.3f s, stretch %g, %d frames -> output %.3f-%.3f s"
+                   % (i, region["start"]/rate, region["end"]/rate, region["stretch"], region["nframes"],
+                      region["first_hop"]*half_windowsize/rate, (region["first_hop"]+region["nframes"])*half_windowsize/rate))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Random access rendering of any output time window.
+
+The engines produce their output from the beginning, one hop at a time. A
+RangeRenderer maps an output interval to the input frames it needs and only
+computes those, plus the previous hop for the overlap-add. With a seed the
+samples are the same as the ones of a full render by the engine: the random
+phases of hop j are taken at position j of the same random stream.
+
+For the new method the hop schedule depends on the onsets found in all the
+previous input frames, so the onset curve is computed (forward FFTs only)
+up to the requested time and kept for the next requests.
+
+Like the engines, the renderer expects the samples returned by load_wav,
+before any engine has faded their end in place.
+"""
+import sys
+import numpy as np
+from optparse import OptionParser
+
+import paulstretch_methods
+import paulstretch_newmethod
+from paulstretch_context import RenderContext
+from paulstretch_wavwriter import FORMATS
+
+
+class RangeRenderer:
+    def __init__(self, samplerate, smp, stretch, windowsize_seconds, method="stereo", onset_level=10.0,
+                 seed=None, silence_threshold=0.0):
+        engine = paulstretch_methods.get_engine(method)
+        self.method = method
+        self.samplerate = samplerate
+        self.mono = len(smp.shape) == 1
+        self.smp = smp.reshape(1, -1) if self.mono else smp
+        self.nchannels, self.nsamples = self.smp.shape
+        self.onset_level = onset_level
+        self.silence_threshold = silence_threshold
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().generate_state(1)[0])
+
+        # the same window sizes and windows as the engines
+        windowsize = int(windowsize_seconds * samplerate)
+        if windowsize < 16:
+            windowsize = 16
+        if method != "mono":
+            windowsize = engine.optimize_windowsize(windowsize)
+        self.windowsize = int(windowsize / 2) * 2
+        self.half_windowsize = self.windowsize // 2
+        self.nbins = self.half_windowsize + 1
+
+        self.end_size = max(int(samplerate * 0.05), 16)
+        self.fade = np.linspace(1, 0, self.end_size)
+
+        if method == "stereo":
+            self.window = pow(1.0 - pow(np.linspace(-1.0, 1.0, self.windowsize), 2.0), 1.25)
+            self.hinv_buf = None
+        else:
+            self.window = 0.5 - np.cos(np.arange(self.windowsize, dtype='float') * 2.0 * np.pi / (self.windowsize - 1)) * 0.5
+            hinv_sqrt2 = (1 + np.sqrt(0.5)) * 0.5
+            self.hinv_buf = hinv_sqrt2 - (1.0 - hinv_sqrt2) * np.cos(np.arange(self.half_windowsize, dtype='float') * 2.0 * np.pi / self.half_windowsize)
+            if method == "newmethod":
+                self.hinv_buf = 2.0 * self.hinv_buf / hinv_sqrt2
+
+        if method == "newmethod":
+            self.displace_pos = self.windowsize * 0.5
+            self._init_schedule(stretch)
+            self._freqs_cache = {}
+        else:
+            self.displace_pos = (self.windowsize * 0.5) / stretch
+            # the engine accumulates the position, do the same additions to get the same frames
+            nhops = int(np.ceil(self.nsamples / self.displace_pos)) + 2
+            positions = np.concatenate(([0.0], np.cumsum(np.full(nhops, self.displace_pos))))
+            self.nhops = int(np.argmax(positions[1:] >= self.nsamples)) + 1
+            self.frame_pos = positions[:self.nhops]
+
+    ########################################
+    # input frames
+
+    def _input_frame(self, istart_pos):
+        """Input samples of a frame, padded with zeros and with the engine's end fade"""
+        buf = self.smp[:, istart_pos:istart_pos + self.windowsize]
+        if buf.shape[1] < self.windowsize:
+            buf = np.append(buf, np.zeros((self.nchannels, self.windowsize - buf.shape[1])), 1)
+        fade_start = self.nsamples - self.end_size
+        if istart_pos + self.windowsize > fade_start:
+            buf = buf.copy()
+            a = max(fade_start, istart_pos)
+            b = min(self.nsamples, istart_pos + self.windowsize)
+            if b > a:
+                buf[:, a - istart_pos:b - istart_pos] *= self.fade[a - fade_start:b - fade_start]
+        return buf
+
+    def _is_silent(self, buf):
+        return self.silence_threshold > 0.0 and np.sqrt(np.vdot(buf, buf) / buf.size) < self.silence_threshold
+
+    def _analyze(self, i):
+        """Amplitude spectrum and silence flag of the i-th input frame of the new method"""
+        if i < 0:
+            return np.zeros((self.nchannels, self.nbins)), True
+        buf = self._input_frame(int(np.floor(i * self.displace_pos)))
+        if self._is_silent(buf):
+            return np.zeros((self.nchannels, self.nbins)), True
+        return np.abs(np.fft.rfft(buf * self.window)), False
+
+    ########################################
+    # onset method schedule
+
+    def _init_schedule(self, stretch):
+        self.hop_frame = []
+        self.hop_tick = []
+        self.schedule_done = False
+        self._schedule = paulstretch_newmethod.OnsetSchedule(stretch, self.onset_level)
+        self._state = {
+            "frame": -1,
+            "start_pos": 0.0,
+            "freqs_scaled": np.zeros(paulstretch_newmethod.NUM_BINS_SCALED_FREQ),
+        }
+
+    def _extend_schedule(self, nhops):
+        """Step the engine's schedule until nhops hops are known (or the end)"""
+        schedule = self._schedule
+        st = self._state
+        while len(self.hop_frame) < nhops and not self.schedule_done:
+            if schedule.get_next_buf:
+                st["frame"] += 1
+                freqs, silent = self._analyze(st["frame"])
+                m, st["freqs_scaled"] = paulstretch_newmethod.onset_measure(freqs, st["freqs_scaled"])
+                schedule.new_frame(m)
+
+            self.hop_frame.append(st["frame"])
+            self.hop_tick.append(schedule.displace_tick)
+
+            if schedule.get_next_buf:
+                st["start_pos"] += self.displace_pos
+            if st["start_pos"] >= self.nsamples:
+                self.schedule_done = True
+                break
+            schedule.next_hop()
+
+    def schedule(self):
+        """The whole hop schedule of the new method: input frame and displace tick of every hop"""
+        self.total_hops()
+        return np.array(self.hop_frame, dtype=np.int64), np.array(self.hop_tick, dtype=np.float64)
+
+    def set_schedule(self, hop_frame, hop_tick):
+        """Use a schedule from schedule(), computed once for several renderers (in other processes)"""
+        self.hop_frame = [int(i) for i in hop_frame]
+        self.hop_tick = [float(tick) for tick in hop_tick]
+        self.schedule_done = True
+
+    def _frame_freqs(self, i):
+        if i not in self._freqs_cache:
+            if len(self._freqs_cache) > 8:
+                self._freqs_cache.pop(min(self._freqs_cache))
+            self._freqs_cache[i] = self._analyze(i)
+        return self._freqs_cache[i]
+
+    ########################################
+    # synthesis
+
+    def _rng(self, hop):
+        bit_generator = np.random.PCG64(self.seed)
+        bit_generator.advance(hop * self.nchannels * self.nbins)
+        return np.random.Generator(bit_generator)
+
+    def _hop_buffer(self, hop, rng):
+        """Windowed output buffer of a hop, rng must be positioned at this hop"""
+        if self.method == "newmethod":
+            i = self.hop_frame[hop]
+            tick = self.hop_tick[hop]
+            freqs, silent = self._frame_freqs(i)
+            old_freqs, old_silent = self._frame_freqs(i - 1)
+            if silent and old_silent:
+                rng.bit_generator.advance(self.nchannels * self.nbins)
+                return np.zeros((self.nchannels, self.windowsize))
+            freqs = (freqs * tick) + (old_freqs * (1.0 - tick))
+        else:
+            buf = self._input_frame(int(np.floor(self.frame_pos[hop])))
+            if self._is_silent(buf):
+                rng.bit_generator.advance(self.nchannels * self.nbins)
+                return np.zeros((self.nchannels, self.windowsize))
+            freqs = np.abs(np.fft.rfft(buf * self.window))
+        ph = rng.uniform(0, 2 * np.pi, (self.nchannels, self.nbins)) * 1j
+        buf = np.fft.irfft(freqs * np.exp(ph))
+        buf *= self.window
+        return buf
+
+    def total_hops(self):
+        """Number of output hops of the whole render"""
+        if self.method == "newmethod":
+            while not self.schedule_done:
+                self._extend_schedule(len(self.hop_frame) + 4096)
+            return len(self.hop_frame)
+        return self.nhops
+
+    def duration(self):
+        """Length of the whole output in seconds"""
+        return self.total_hops() * self.half_windowsize / float(self.samplerate)
+
+    def iter_hops(self, hop0, hop1):
+        """Generator of the output blocks (channels x half window, not clamped) of hops hop0 to hop1-1
+
+        The hops must exist (hop1 <= total_hops()); like render_range() the
+        rendering starts one hop before hop0 for the overlap-add.
+        """
+        if hop1 <= hop0:
+            return
+        first = max(hop0 - 1, 0)
+        rng = self._rng(first)
+        old_windowed_buf = np.zeros((self.nchannels, self.windowsize))
+        if first < hop0:
+            old_windowed_buf = self._hop_buffer(first, rng)
+        for hop in range(hop0, hop1):
+            buf = self._hop_buffer(hop, rng)
+            out = buf[:, 0:self.half_windowsize] + old_windowed_buf[:, self.half_windowsize:self.windowsize]
+            old_windowed_buf = buf
+            if self.hinv_buf is not None:
+                out *= self.hinv_buf
+            yield out
+
+    def render_range(self, t0, t1):
+        """Output samples between t0 and t1 seconds, clamped to -1..1
+
+        The result has the shape of the input (1D for mono) and is shorter
+        than requested when t1 is past the end of the output.
+        """
+        s0 = max(int(round(t0 * self.samplerate)), 0)
+        s1 = max(int(round(t1 * self.samplerate)), s0)
+        hop0 = s0 // self.half_windowsize
+        hop1 = (s1 + self.half_windowsize - 1) // self.half_windowsize
+        if self.method == "newmethod":
+            self._extend_schedule(hop1)
+            hop1 = min(hop1, len(self.hop_frame))
+        else:
+            hop1 = min(hop1, self.nhops)
+
+        output = np.zeros((self.nchannels, max(hop1 - hop0, 0) * self.half_windowsize))
+        for k, out in enumerate(self.iter_hops(hop0, hop1)):
+            output[:, k * self.half_windowsize:(k + 1) * self.half_windowsize] = out
+        np.clip(output, -1.0, 1.0, out=output)
+
+        output = output[:, s0 - hop0 * self.half_windowsize:s1 - hop0 * self.half_windowsize]
+        return output[0] if self.mono else output
+
+
+def render_range(samplerate, smp, stretch, windowsize_seconds, t0, t1, method="stereo", onset_level=10.0,
+                 seed=None, silence_threshold=0.0, outfilename=None, **options):
+    """Output samples between t0 and t1 seconds of a render, see RangeRenderer
+
+    With outfilename they are also written there, like the engines write
+    their output. Extra options (output_format, dither, manifest, metrics,
+    input_filename) go to the RenderContext of the run; the manifest has
+    the seed used, which renders the same range again when none was given.
+    """
+    renderer = RangeRenderer(samplerate, smp, stretch, windowsize_seconds, method, onset_level, seed, silence_threshold)
+    context = RenderContext(seed=renderer.seed, silence_threshold=silence_threshold, **options)
+    params = {"engine": method, "samplerate": samplerate, "nsamples": renderer.nsamples, "stretch": stretch,
+              "windowsize_seconds": windowsize_seconds, "windowsize": renderer.windowsize, "t0": t0, "t1": t1}
+    if method == "newmethod":
+        params["onset_level"] = onset_level
+    context.start_run(params, nchannels=renderer.nchannels)
+    output = renderer.render_range(t0, t1)
+    if outfilename is not None:
+        with context.open_output(outfilename, samplerate, renderer.nchannels) as outfile:
+            outfile.write(output)
+    context.frames_processed = output.shape[-1]
+    context.render_complete()
+    return output
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] input_wav output_wav start_seconds end_seconds")
+    parser.add_option("-m", "--method", dest="method",help="processing method (mono, stereo, newmethod)",default="stereo")
+    parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-t", "--onset", dest="onset",help="onset sensitivity (newmethod only)",type="float",default=10.0)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases",type="int",default=None)
+    parser.add_option("-q", "--silence_threshold", dest="silence_threshold",help="skip the frames quieter than this RMS level (dB, e.g. -80)",type="float",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("--dither", dest="dither",help="add TPDF dither to the integer output formats",action="store_true",default=False)
+    parser.add_option("--manifest", dest="manifest",help="write a json manifest of the run (parameters, times, sizes) to this file",default=None)
+    parser.add_option("--metrics", dest="metrics",help="add the run to this Prometheus textfile collector file (default: $PAULSTRETCH_METRICS)",default=None)
+    (options, args) = parser.parse_args()
+
+    if ((len(args)<4) or (options.method not in paulstretch_methods.METHODS) or (options.stretch<=0.0) or (options.window_size<=0.001)
+            or (options.format not in FORMATS)):
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    silence_threshold = 0.0
+    if options.silence_threshold is not None:
+        silence_threshold = pow(10.0, options.silence_threshold / 20.0)
+
+    loaded = paulstretch_methods.load_wav(options.method, args[0])
+    if loaded is None:
+        sys.exit(1)
+    samplerate, smp = loaded
+    render_range(samplerate, smp, options.stretch, options.window_size, float(args[2]), float(args[3]),
+                 options.method, options.onset, options.seed, silence_threshold, args[1],
+                 output_format=options.format, dither=options.dither, manifest=options.manifest,
+                 metrics=options.metrics, input_filename=args[0])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Reference loops of the three Paulstretch algorithms.
+
+These are the plain one hop at a time loops of the engines, kept as they
+are for paulstretch_equivalence.py to validate faster rewrites against:
+no silence skipping, checkpoints, spectrum tap or batching, and their own
+copy of the window size rounding. They take the engines' arguments and a
+RenderContext, draw the random phases from context.rng in the same order as
+the engines (so a seeded engine which keeps that order gives the same
+samples), and don't modify the input samples.
+"""
+from numpy import append, arange, cos, exp, fft, floor, linspace, mean, pi, sqrt, zeros
+
+from paulstretch_context import RenderContext
+
+
+def optimize_windowsize(n):
+    orig_n = n
+    while True:
+        n = orig_n
+        while (n % 2) == 0:
+            n /= 2
+        while (n % 3) == 0:
+            n /= 3
+        while (n % 5) == 0:
+            n /= 5
+        if n < 2:
+            break
+        orig_n += 1
+    return orig_n
+
+
+def _windowsize(samplerate, windowsize_seconds, optimize=True):
+    windowsize = int(windowsize_seconds * samplerate)
+    if windowsize < 16:
+        windowsize = 16
+    if optimize:
+        windowsize = optimize_windowsize(windowsize)
+    return int(windowsize / 2) * 2
+
+
+def _faded(samplerate, smp):
+    """The samples with the engines' fade out at the end"""
+    end_size = max(int(samplerate * 0.05), 16)
+    smp = smp.copy()
+    smp[..., smp.shape[-1] - end_size:] *= linspace(1, 0, end_size)
+    return smp
+
+
+def mono(samplerate, smp, stretch, windowsize_seconds, outfilename, context=None):
+    """paulstretch_mono.paulstretch: Hann window, amplitude correction of the overlap-add"""
+    context = context or RenderContext()
+    smp = _faded(samplerate, smp)
+    nsamples = len(smp)
+    windowsize = _windowsize(samplerate, windowsize_seconds, optimize=False)
+    half_windowsize = windowsize // 2
+    displace_pos = (windowsize * 0.5) / stretch
+    window = 0.5 - cos(arange(windowsize, dtype='float') * 2.0 * pi / (windowsize - 1)) * 0.5
+    hinv_sqrt2 = (1 + sqrt(0.5)) * 0.5
+    hinv_buf = hinv_sqrt2 - (1.0 - hinv_sqrt2) * cos(arange(half_windowsize, dtype='float') * 2.0 * pi / half_windowsize)
+
+    outfile = context.open_output(outfilename, samplerate, 1)
+    old_windowed_buf = zeros(windowsize)
+    start_pos = 0.0
+    while True:
+        istart_pos = int(floor(start_pos))
+        buf = smp[istart_pos:istart_pos + windowsize]
+        if len(buf) < windowsize:
+            buf = append(buf, zeros(windowsize - len(buf)))
+        freqs = abs(fft.rfft(buf * window))
+        freqs = freqs * exp(context.rng.uniform(0, 2 * pi, len(freqs)) * 1j)
+        buf = fft.irfft(freqs) * window
+
+        output = (buf[0:half_windowsize] + old_windowed_buf[half_windowsize:windowsize]) * hinv_buf
+        old_windowed_buf = buf
+        outfile.write(output)
+
+        start_pos += displace_pos
+        if start_pos >= nsamples:
+            break
+        context.report_progress(int(100.0 * start_pos / nsamples))
+    outfile.close()
+    context.report_progress(100)
+
+
+def stereo(samplerate, smp, stretch, windowsize_seconds, outfilename, context=None):
+    """paulstretch_stereo.paulstretch: 2 channels, power window without amplitude correction"""
+    context = context or RenderContext()
+    smp = _faded(samplerate, smp)
+    nchannels, nsamples = smp.shape
+    windowsize = _windowsize(samplerate, windowsize_seconds)
+    half_windowsize = windowsize // 2
+    displace_pos = (windowsize * 0.5) / stretch
+    window = pow(1.0 - pow(linspace(-1.0, 1.0, windowsize), 2.0), 1.25)
+
+    outfile = context.open_output(outfilename, samplerate, nchannels)
+    old_windowed_buf = zeros((nchannels, windowsize))
+    start_pos = 0.0
+    while True:
+        istart_pos = int(floor(start_pos))
+        buf = smp[:, istart_pos:istart_pos + windowsize]
+        if buf.shape[1] < windowsize:
+            buf = append(buf, zeros((nchannels, windowsize - buf.shape[1])), 1)
+        freqs = abs(fft.rfft(buf * window))
+        freqs = freqs * exp(context.rng.uniform(0, 2 * pi, (nchannels, freqs.shape[1])) * 1j)
+        buf = fft.irfft(freqs) * window
+
+        output = buf[:, 0:half_windowsize] + old_windowed_buf[:, half_windowsize:windowsize]
+        old_windowed_buf = buf
+        outfile.write(output)
+
+        start_pos += displace_pos
+        if start_pos >= nsamples:
+            break
+        context.report_progress(int(100.0 * start_pos / nsamples))
+    outfile.close()
+    context.report_progress(100)
+
+
+def newmethod(samplerate, smp, stretch, windowsize_seconds, onset_level, outfilename, context=None):
+    """paulstretch_newmethod.paulstretch: crossfaded spectra of the input frames, faster through the onsets"""
+    context = context or RenderContext()
+    smp = _faded(samplerate, smp)
+    nchannels, nsamples = smp.shape
+    windowsize = _windowsize(samplerate, windowsize_seconds)
+    half_windowsize = windowsize // 2
+    displace_pos = windowsize * 0.5
+    window = 0.5 - cos(arange(windowsize, dtype='float') * 2.0 * pi / (windowsize - 1)) * 0.5
+    hinv_sqrt2 = (1 + sqrt(0.5)) * 0.5
+    hinv_buf = 2.0 * (hinv_sqrt2 - (1.0 - hinv_sqrt2) * cos(arange(half_windowsize, dtype='float') * 2.0 * pi / half_windowsize)) / hinv_sqrt2
+
+    num_bins_scaled_freq = 32
+    freqs = zeros((nchannels, half_windowsize + 1))
+    freqs_scaled = zeros(num_bins_scaled_freq)
+    displace_tick = 0.0
+    displace_tick_increase = min(1.0 / stretch, 1.0)
+    extra_onset_time_credit = 0.0
+    get_next_buf = True
+
+    outfile = context.open_output(outfilename, samplerate, nchannels)
+    old_windowed_buf = zeros((nchannels, windowsize))
+    start_pos = 0.0
+    while True:
+        if get_next_buf:
+            old_freqs = freqs
+            old_freqs_scaled = freqs_scaled
+
+            istart_pos = int(floor(start_pos))
+            buf = smp[:, istart_pos:istart_pos + windowsize]
+            if buf.shape[1] < windowsize:
+                buf = append(buf, zeros((nchannels, windowsize - buf.shape[1])), 1)
+            freqs = abs(fft.rfft(buf * window))
+
+            # onset: rise of the spectrum scaled down to 32 bands
+            freqs_len = freqs.shape[1]
+            if num_bins_scaled_freq < freqs_len:
+                freqs_len_div = freqs_len // num_bins_scaled_freq
+                new_freqs_len = freqs_len_div * num_bins_scaled_freq
+                freqs_scaled = mean(mean(freqs, 0)[:new_freqs_len].reshape([num_bins_scaled_freq, freqs_len_div]), 1)
+            else:
+                freqs_scaled = zeros(num_bins_scaled_freq)
+            m = 2.0 * mean(freqs_scaled - old_freqs_scaled) / (mean(abs(old_freqs_scaled)) + 1e-3)
+            m = min(max(m, 0.0), 1.0)
+            if m > onset_level:
+                displace_tick = 1.0
+                extra_onset_time_credit += 1.0
+
+        cfreqs = (freqs * displace_tick) + (old_freqs * (1.0 - displace_tick))
+        cfreqs = cfreqs * exp(context.rng.uniform(0, 2 * pi, (nchannels, cfreqs.shape[1])) * 1j)
+        buf = fft.irfft(cfreqs) * window
+
+        output = (buf[:, 0:half_windowsize] + old_windowed_buf[:, half_windowsize:windowsize]) * hinv_buf
+        old_windowed_buf = buf
+        outfile.write(output)
+
+        if get_next_buf:
+            start_pos += displace_pos
+        get_next_buf = False
+        if start_pos >= nsamples:
+            break
+        context.report_progress(int(100.0 * start_pos / nsamples))
+
+        if extra_onset_time_credit <= 0.0:
+            displace_tick += displace_tick_increase
+        else:
+            credit_get = 0.5 * displace_tick_increase
+            extra_onset_time_credit = max(extra_onset_time_credit - credit_get, 0.0)
+            displace_tick += displace_tick_increase - credit_get
+        if displace_tick >= 1.0:
+            displace_tick = displace_tick % 1.0
+            get_next_buf = True
+    outfile.close()
+    context.report_progress(100)
+
+
+# method name -> reference function, like paulstretch_methods.METHODS
+REFERENCES = {
+    "mono": mono,
+    "stereo": stereo,
+    "newmethod": newmethod,
+}
@@ -13,14 +13,15 @@
 
 
 import sys
-from numpy import *
-import scipy.io.wavfile
-import wave
+from numpy import append, exp, fft, floor, linspace, pi, sqrt, tile, vdot, zeros
+import paulstretch_wavreader
+from paulstretch_context import RenderContext
+from paulstretch_wavwriter import FORMATS
 from optparse import OptionParser
 
 def load_wav(filename):
     try:
-        wavedata=scipy.io.wavfile.read(filename)
+        wavedata=paulstretch_wavreader.read(filename)
         samplerate=int(wavedata[0])
         smp=wavedata[1]*(1.0/32768.0)
         smp=smp.transpose()
@@ -49,13 +50,19 @@ def optimize_windowsize(n):
         orig_n+=1
     return orig_n
 
-def paulstretch(samplerate,smp,stretch,windowsize_seconds,outfilename):
+def paulstretch(samplerate,smp,stretch,windowsize_seconds,outfilename,context=None):
+    if context is None:
+        context=RenderContext()
+
     nchannels=smp.shape[0]
 
-    outfile=wave.open(outfilename,"wb")
-    outfile.setsampwidth(2)
-    outfile.setframerate(samplerate)
-    outfile.setnchannels(nchannels)
+    #continue from the last checkpoint of an interrupted render
+    state=context.resume_state(outfilename,{"engine":"stereo","samplerate":samplerate,"nsamples":smp.shape[1],"nchannels":nchannels,"stretch":stretch,"windowsize_seconds":windowsize_seconds},smp)
+
+    #the output can go only to output_callback, without any file
+    outfile=None
+    if outfilename is not None:
+        outfile=context.open_output(outfilename,samplerate,nchannels,expected_frames=int(smp.shape[1]*stretch))
 
     #make sure that windowsize is even and larger than 16
     windowsize=int(windowsize_seconds*samplerate)
@@ -82,54 +89,81 @@ def paulstretch(samplerate,smp,stretch,windowsize_seconds,outfilename):
 #    window=0.5-cos(arange(windowsize,dtype='float')*2.0*pi/(windowsize-1))*0.5
     window=pow(1.0-pow(linspace(-1.0,1.0,windowsize),2.0),1.25)
 
+    #random generator for the phases, a given seed makes the render reproducible
+    rng=context.rng
+    silence_threshold=context.silence_threshold
+
     old_windowed_buf=zeros((2,windowsize))
 #    hinv_sqrt2=(1+sqrt(0.5))*0.5
 #    hinv_buf=2.0*(hinv_sqrt2-(1.0-hinv_sqrt2)*cos(arange(half_windowsize,dtype='float')*2.0*pi/half_windowsize))/hinv_sqrt2
 
-    while True:
-        #get the windowed buffer
-        istart_pos=int(floor(start_pos))
-        buf=smp[:,istart_pos:istart_pos+windowsize]
-        if buf.shape[1]<windowsize:
-            buf=append(buf,zeros((2,windowsize-buf.shape[1])),1)
-        buf=buf*window
-    
-        #get the amplitudes of the frequency components and discard the phases
-        freqs=abs(fft.rfft(buf))
-
-        #randomize the phases by multiplication with a random complex number with modulus=1
-        ph=random.uniform(0,2*pi,(nchannels,freqs.shape[1]))*1j
-        freqs=freqs*exp(ph)
-
-        #do the inverse FFT 
-        buf=fft.irfft(freqs)
-
-        #window again the output buffer
-        buf*=window
+    if state is not None:
+        start_pos=float(state["start_pos"])
+        old_windowed_buf=state["old_windowed_buf"]
 
-        #overlap-add the output
-        output=buf[:,0:half_windowsize]+old_windowed_buf[:,half_windowsize:windowsize]
-        old_windowed_buf=buf
-
-        #remove the resulted amplitude modulation
-        #update: there is no need to the new windowing function
-        #output*=hinv_buf
-        
-        #clamp the values to -1..1 
-        output[output>1.0]=1.0
-        output[output<-1.0]=-1.0
-
-        #write the output to wav file
-        outfile.writeframes(int16(output.ravel('F')*32767.0).tobytes())
-
-        start_pos+=displace_pos
-        if start_pos>=nsamples:
-            print ("100 %")
-            break
-        sys.stdout.write ("%d %% \r" % int(100.0*start_pos/nsamples))
-        sys.stdout.flush()
-
-    outfile.close()
+    #a cancelled or failed render still leaves a valid (partial) output file and no scratch file
+    try:
+        while True:
+            #get the windowed buffer
+            istart_pos=int(floor(start_pos))
+            buf=smp[:,istart_pos:istart_pos+windowsize]
+            if buf.shape[1]<windowsize:
+                buf=append(buf,zeros((2,windowsize-buf.shape[1])),1)
+
+            #skip the FFTs of the frames which are quieter than the threshold
+            #the overlap-add tail of the previous frame decays normally
+            if silence_threshold>0.0 and sqrt(vdot(buf,buf)/buf.size)<silence_threshold:
+                buf=zeros((nchannels,windowsize))
+                #keep the random sequence aligned with a render without skipping
+                rng.bit_generator.advance(nchannels*(half_windowsize+1))
+            else:
+                buf=buf*window
+    
+                #get the amplitudes of the frequency components and discard the phases
+                freqs=abs(fft.rfft(buf))
+                context.report_spectrum(freqs)
+
+                #randomize the phases by multiplication with a random complex number with modulus=1
+                ph=rng.uniform(0,2*pi,(nchannels,freqs.shape[1]))*1j
+                freqs=freqs*exp(ph)
+
+                #do the inverse FFT 
+                buf=fft.irfft(freqs)
+
+                #window again the output buffer
+                buf*=window
+
+            #overlap-add the output
+            output=buf[:,0:half_windowsize]+old_windowed_buf[:,half_windowsize:windowsize]
+            old_windowed_buf=buf
+
+            #remove the resulted amplitude modulation
+            #update: there is no need to the new windowing function
+            #output*=hinv_buf
+
+            #write the output to wav file (the encoder clamps the values to -1..1 for the integer formats)
+            if outfile is not None:
+                outfile.write(output)
+            context.write_output(output)
+
+            start_pos+=displace_pos
+            if start_pos>=nsamples:
+                context.report_progress(100)
+                break
+            context.report_progress(int(100.0*start_pos/nsamples))
+
+            #save the state now and then, to resume after a crash
+            if context.checkpoint_due():
+                context.save_checkpoint(outfile,start_pos=start_pos,old_windowed_buf=old_windowed_buf)
+    except BaseException:
+        if outfile is not None:
+            outfile.abort()
+        raise
+
+    if outfile is not None:
+        outfile.close()
+        context.remove_checkpoint()
+    context.render_complete()
 
 ########################################
 if __name__ == "__main__":
@@ -138,24 +172,71 @@ if __name__ == "__main__":
     parser = OptionParser(usage="usage: %prog [options] input_wav output_wav")
     parser.add_option("-s", "--stretch", dest="stretch",help="stretch amount (1.0 = no stretch)",type="float",default=8.0)
     parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-d", "--draft", dest="draft",help="draft quality: render at 1/DRAFT of the sample rate (1, 2, 4 or 8)",type="int",default=1)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases (makes the render reproducible)",type="int",default=None)
+    parser.add_option("-q", "--silence_threshold", dest="silence_threshold",help="skip the frames quieter than this RMS level (dB, e.g. -80)",type="float",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("--dither", dest="dither",help="add TPDF dither to the integer output formats",action="store_true",default=False)
+    parser.add_option("-n", "--normalize", dest="normalize",help="normalize the output to this peak level (dB, e.g. -1) instead of clipping",type="float",default=None)
+    parser.add_option("-c", "--checkpoint", dest="checkpoint",help="save the render state every CHECKPOINT seconds, to resume it after a crash",type="float",default=None)
+    parser.add_option("--resume", dest="resume",help="continue the render from the checkpoint of the output file",action="store_true",default=False)
+    parser.add_option("--manifest", dest="manifest",help="write a json manifest of the run (parameters, times, sizes) to this file",default=None)
+    parser.add_option("--metrics", dest="metrics",help="add the run to this Prometheus textfile collector file (default: $PAULSTRETCH_METRICS)",default=None)
+    parser.add_option("--dry-run", dest="dry_run",help="estimate the time, memory and disk space of the (full quality) render and exit",action="store_true",default=False)
     (options, args) = parser.parse_args()
 
 
-    if (len(args)<2) or (options.stretch<=0.0) or (options.window_size<=0.001):
+    if (len(args)<2) or (options.stretch<=0.0) or (options.window_size<=0.001) or (options.draft not in (1,2,4,8)) or (options.format not in FORMATS) or \
+       (options.normalize is not None and (options.checkpoint is not None or options.resume)):
         print ("Error in command line parameters. Run this program with --help for help.")
         sys.exit(1)
 
     print ("stretch amount = %g" % options.stretch)
     print ("window size = %g seconds" % options.window_size)
+    if options.seed is not None:
+        print ("random seed = %d" % options.seed)
+    if options.format!="pcm16" or options.dither:
+        print ("output format = %s%s" % (options.format," with dither" if options.dither else ""))
+    normalize=None
+    if options.normalize is not None:
+        print ("normalize to %g dB" % options.normalize)
+        normalize=pow(10.0,options.normalize/20.0)
+    silence_threshold=0.0
+    if options.silence_threshold is not None:
+        print ("silence threshold = %g dB" % options.silence_threshold)
+        silence_threshold=pow(10.0,options.silence_threshold/20.0)
+    context=RenderContext(seed=options.seed, silence_threshold=silence_threshold,
+                          output_format=options.format, dither=options.dither,
+                          checkpoint_interval=options.checkpoint, resume=options.resume, normalize=normalize,
+                          manifest=options.manifest, metrics=options.metrics, input_filename=args[0])
     
     # Only read and process input file when directly running the script
     input_filename = args[0]
     output_filename = args[1]
     
+    if options.dry_run:
+        import paulstretch_estimate
+        try:
+            cost=paulstretch_estimate.estimate(input_filename,"stereo",options.stretch,options.window_size,options.format,options.normalize is not None)
+        except Exception:
+            print ("Error loading wav: "+input_filename)
+            sys.exit(1)
+        print (paulstretch_estimate.report(cost))
+        problems=paulstretch_estimate.admission_problems(cost,output_filename)
+        for problem in problems:
+            print ("does not fit: %s" % problem)
+        sys.exit(1 if problems else 0)
+
     samplerate_and_samples = load_wav(input_filename)
     if samplerate_and_samples is not None:
         (samplerate, smp) = samplerate_and_samples
-        paulstretch(samplerate, smp, options.stretch, options.window_size, output_filename)
+        if options.draft>1:
+            import paulstretch_draft
+            report=paulstretch_draft.draft_paulstretch("stereo", samplerate, smp, options.stretch, options.window_size, output_filename,
+                                                       10.0, options.draft, context=context)
+            print (report)
+        else:
+            paulstretch(samplerate, smp, options.stretch, options.window_size, output_filename, context)
     else:
         print("Error: Could not process input file")
 
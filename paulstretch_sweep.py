@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Parameter sweeps of the new method sharing one analysis pass.
+
+In paulstretch_newmethod the analysis frames are always half a window apart
+in the input, whatever the stretch amount and the onset sensitivity: those
+only decide how many output hops each frame lasts. So a sweep over stretch
+amounts and onset levels (with the same window size) reads and transforms
+every input frame and computes its onset value once, and drives all the
+variants from it in lockstep, each frame being synthesized by the variants
+in parallel threads (numpy releases the GIL in the FFTs and the random
+generator). Every output is identical to a render of paulstretch_newmethod
+with the same parameters and seed.
+
+    python paulstretch_sweep.py -s 4,8,16 -t 0.1,0.3,10 input.wav out
+    # -> out_s4_t0.1.wav, out_s4_t0.3.wav, ... out_s16_t10.wav
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+import numpy as np
+
+import paulstretch_newmethod
+from paulstretch_context import RenderContext
+from paulstretch_wavwriter import FORMATS
+
+
+def analysis_frames(samplerate, smp, windowsize, silence_threshold=0.0):
+    """Generator of the analysis frames of the new method: (freqs, m, silent)
+
+    smp is modified in place (the end fade of the engine).
+    """
+    nchannels, nsamples = smp.shape
+    half_windowsize = windowsize // 2
+    end_size = int(samplerate * 0.05)
+    if end_size < 16:
+        end_size = 16
+    smp[:, nsamples - end_size:nsamples] *= np.linspace(1, 0, end_size)
+    window = 0.5 - np.cos(np.arange(windowsize, dtype='float') * 2.0 * np.pi / (windowsize - 1)) * 0.5
+
+    start_pos = 0.0
+    displace_pos = windowsize * 0.5
+    freqs_scaled = np.zeros(paulstretch_newmethod.NUM_BINS_SCALED_FREQ)
+    while True:
+        old_freqs_scaled = freqs_scaled
+        istart_pos = int(np.floor(start_pos))
+        buf = smp[:, istart_pos:istart_pos + windowsize]
+        if buf.shape[1] < windowsize:
+            buf = np.append(buf, np.zeros((2, windowsize - buf.shape[1])), 1)
+        silent = silence_threshold > 0.0 and np.sqrt(np.vdot(buf, buf) / buf.size) < silence_threshold
+        if silent:
+            freqs = np.zeros((nchannels, half_windowsize + 1))
+        else:
+            freqs = abs(np.fft.rfft(buf * window))
+
+        m, freqs_scaled = paulstretch_newmethod.onset_measure(freqs, old_freqs_scaled)
+
+        start_pos += displace_pos
+        yield freqs, m, silent
+        if start_pos >= nsamples:
+            return
+
+
+class SweepVariant:
+    """The synthesis side of one paulstretch_newmethod render, fed one analysis frame at a time"""
+    def __init__(self, samplerate, nchannels, windowsize, stretch, onset_level, outfilename, context):
+        self.context = context
+        self.rng = context.rng
+        self.nchannels = nchannels
+        self.windowsize = windowsize
+        self.half_windowsize = windowsize // 2
+        self.window = 0.5 - np.cos(np.arange(windowsize, dtype='float') * 2.0 * np.pi / (windowsize - 1)) * 0.5
+        hinv_sqrt2 = (1 + np.sqrt(0.5)) * 0.5
+        self.hinv_buf = 2.0 * (hinv_sqrt2 - (1.0 - hinv_sqrt2) * np.cos(np.arange(self.half_windowsize, dtype='float') * 2.0 * np.pi / self.half_windowsize)) / hinv_sqrt2
+        self.old_windowed_buf = np.zeros((2, windowsize))
+        self.freqs = np.zeros((2, self.half_windowsize + 1))
+        self.silent = True
+        self.schedule = paulstretch_newmethod.OnsetSchedule(stretch, onset_level)
+        # the hops run in the threads of the pool, their CPU time is added up for the run record
+        self.cpu_seconds = 0.0
+        self.outfile = None
+        if outfilename is not None:
+            self.outfile = context.open_output(outfilename, samplerate, nchannels)
+
+    def consume(self, frame, last):
+        """Synthesize the output hops of one analysis frame (last: the engine stops after its first hop)"""
+        started = time.thread_time()
+        try:
+            self._consume(frame, last)
+        finally:
+            self.cpu_seconds += time.thread_time() - started
+
+    def _consume(self, frame, last):
+        old_freqs, old_silent = self.freqs, self.silent
+        self.freqs, m, self.silent = frame
+        self.schedule.new_frame(m)
+        while True:
+            if self.silent and old_silent:
+                buf = np.zeros((self.nchannels, self.windowsize))
+                self.rng.bit_generator.advance(self.nchannels * (self.half_windowsize + 1))
+            else:
+                tick = self.schedule.displace_tick
+                cfreqs = (self.freqs * tick) + (old_freqs * (1.0 - tick))
+                self.context.report_spectrum(cfreqs)
+                ph = self.rng.uniform(0, 2 * np.pi, (self.nchannels, cfreqs.shape[1])) * 1j
+                buf = np.fft.irfft(cfreqs * np.exp(ph)) * self.window
+            output = buf[:, 0:self.half_windowsize] + self.old_windowed_buf[:, self.half_windowsize:self.windowsize]
+            self.old_windowed_buf = buf
+            output *= self.hinv_buf
+            if self.outfile is not None:
+                self.outfile.write(output)
+            self.context.write_output(output)
+            if last:
+                self.close()
+                return
+            self.schedule.next_hop()
+            if self.schedule.get_next_buf:
+                return
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+    def abort(self):
+        if self.outfile is not None:
+            self.outfile.abort()
+            self.outfile = None
+
+
+def sweep(samplerate, smp, windowsize_seconds, variants, workers=None, context=None, **options):
+    """Render several variants of the new method from one analysis pass
+
+    variants is a list of dicts with "stretch", "onset" and "output" (and
+    optionally "seed" and "manifest"). Extra options (seed, silence_threshold,
+    output_format, dither, metrics) are used for the context of every
+    variant; the given context only receives the overall progress. Each
+    variant is a run of its own in the manifest and the metrics.
+    """
+    if context is None:
+        context = RenderContext()
+    windowsize = int(windowsize_seconds * samplerate)
+    if windowsize < 16:
+        windowsize = 16
+    windowsize = paulstretch_newmethod.optimize_windowsize(windowsize)
+    windowsize = int(windowsize / 2) * 2
+    nchannels, nsamples = smp.shape
+    nframes = int(np.ceil(nsamples / (windowsize * 0.5)))
+
+    renders = []
+    for variant in variants:
+        variant_options = dict(options, progress=lambda percentage: None)
+        if "seed" in variant:
+            variant_options["seed"] = variant["seed"]
+        # one manifest per variant, they would overwrite each other
+        variant_options["manifest"] = variant.get("manifest")
+        variant_context = RenderContext(**variant_options)
+        onset_level = float(variant.get("onset", 10.0))
+        variant_context.start_run({"engine": "newmethod", "samplerate": samplerate, "nsamples": nsamples,
+                                   "stretch": variant["stretch"], "windowsize_seconds": windowsize_seconds,
+                                   "onset_level": onset_level})
+        renders.append(SweepVariant(samplerate, nchannels, windowsize, variant["stretch"], onset_level,
+                                    variant["output"], variant_context))
+
+    silence_threshold = options.get("silence_threshold", 0.0)
+    try:
+        with ThreadPoolExecutor(workers or min(len(renders), os.cpu_count() or 1)) as pool:
+            for k, frame in enumerate(analysis_frames(samplerate, smp, windowsize, silence_threshold)):
+                last = (k + 1) * windowsize * 0.5 >= nsamples
+                # wait for all the variants before the next frame; list() raises their exceptions here
+                list(pool.map(lambda render: render.consume(frame, last), renders))
+                if last:
+                    context.report_progress(100)
+                else:
+                    context.report_progress(int(100.0 * (k + 1) / nframes))
+    except BaseException:
+        for render in renders:
+            render.abort()
+        raise
+    for render in renders:
+        render.context.render_complete(render.cpu_seconds)
+    return renders
+
+
+def _number_list(text):
+    return [float(x) for x in text.split(",") if x.strip()]
+
+
+########################################
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] input_wav output_prefix")
+    parser.add_option("-s", "--stretch", dest="stretch",help="comma separated stretch amounts",default="8")
+    parser.add_option("-t", "--onset", dest="onset",help="comma separated onset sensitivities",default="10")
+    parser.add_option("-w", "--window_size", dest="window_size",help="window size (seconds)",type="float",default=0.25)
+    parser.add_option("-r", "--seed", dest="seed",help="random seed for the phases (the same for every variant)",type="int",default=None)
+    parser.add_option("-q", "--silence_threshold", dest="silence_threshold",help="skip the frames quieter than this RMS level (dB, e.g. -80)",type="float",default=None)
+    parser.add_option("-f", "--format", dest="format",help="output format: pcm16, pcm24, pcm32 or float32",default="pcm16")
+    parser.add_option("-j", "--jobs", dest="jobs",help="number of threads (default: one per CPU)",type="int",default=None)
+    parser.add_option("--manifest", dest="manifest",help="write a json manifest of each run to <output>.manifest.json",action="store_true",default=False)
+    parser.add_option("--metrics", dest="metrics",help="add the runs to this Prometheus textfile collector file (default: $PAULSTRETCH_METRICS)",default=None)
+    (options, args) = parser.parse_args()
+
+    try:
+        stretches = _number_list(options.stretch)
+        onsets = _number_list(options.onset)
+    except ValueError:
+        stretches = onsets = []
+    if (len(args)<2) or not stretches or not onsets or min(stretches)<=0.0 or (options.window_size<=0.001) or (options.format not in FORMATS):
+        print ("Error in command line parameters. Run this program with --help for help.")
+        sys.exit(1)
+
+    variants = [{"stretch": s, "onset": t, "output": "%s_s%g_t%g.wav" % (args[1], s, t)} for s in stretches for t in onsets]
+    if options.manifest:
+        for variant in variants:
+            variant["manifest"] = variant["output"] + ".manifest.json"
+    silence_threshold = 0.0
+    if options.silence_threshold is not None:
+        silence_threshold = pow(10.0, options.silence_threshold / 20.0)
+
+    loaded = paulstretch_newmethod.load_wav(args[0])
+    if loaded is None:
+        sys.exit(1)
+    samplerate, smp = loaded
+    print ("%d variants" % len(variants))
+    sweep(samplerate, smp, options.window_size, variants, options.jobs, seed=options.seed,
+          silence_threshold=silence_threshold, output_format=options.format, metrics=options.metrics,
+          input_filename=args[0])
+    for variant in variants:
+        print (variant["output"])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Minimal wav reader, a drop-in for scipy.io.wavfile.read.
+
+Importing scipy.io.wavfile takes longer than a short render (it pulls in a
+large part of scipy), while reading a wav file only needs numpy. This reads
+PCM (8, 16, 24, 32 bit), float (32, 64 bit), WAVE_FORMAT_EXTENSIBLE and RF64
+files into the same arrays as scipy: samples x channels (1D for mono) with
+the file's sample type, 24 bit samples in the high bytes of int32.
+"""
+import os
+import struct
+import numpy as np
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+_DTYPES = {
+    (WAVE_FORMAT_PCM, 8): np.uint8,
+    (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 24): np.dtype('<i4'),
+    (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+    (WAVE_FORMAT_PCM, 64): np.dtype('<i8'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8'),
+}
+
+
+# data sizes of a wav streamed to a pipe, written before the length was known
+_STREAMING_SIZES = (0, 0xFFFFFFFF)
+
+
+def _read_into(f, nbytes):
+    """Read up to nbytes into a new writable uint8 array"""
+    data = np.empty(nbytes, dtype=np.uint8)
+    n = f.readinto(memoryview(data))
+    return data[:n]
+
+
+def _read_to_end(f, block_size=1024 * 1024):
+    """Read the rest of f in blocks into a new writable uint8 array"""
+    data = bytearray()
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        data += block
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def read(filename):
+    """Return (samplerate, data) of a wav file (a file name or a binary file object)"""
+    if hasattr(filename, "read"):
+        return _read(filename)
+    with open(filename, "rb") as f:
+        return _read(f)
+
+
+def read_info(filename):
+    """Return the header of a wav file without reading its samples
+
+    A dict with samplerate, nchannels, bits, float (True for the IEEE float
+    formats), nframes and data_bytes.
+    """
+    with open(filename, "rb") as f:
+        format_tag, nchannels, samplerate, block_align, bits, size = _read_header(f)
+        # the frames the file really has, like read() for a truncated or a streamed file
+        available = max(0, os.fstat(f.fileno()).st_size - f.tell())
+        size = available if size in _STREAMING_SIZES else min(size, available)
+    nframes = size // block_align
+    return {
+        "samplerate": samplerate,
+        "nchannels": nchannels,
+        "bits": bits,
+        "float": format_tag == WAVE_FORMAT_IEEE_FLOAT,
+        "nframes": nframes,
+        "data_bytes": nframes * block_align,
+    }
+
+
+def _read_header(f):
+    """Parse the chunks up to the data chunk, return (format tag, channels, samplerate, block align, bits, data size)"""
+    riff_id, riff_size, wave_id = struct.unpack("<4sI4s", f.read(12))
+    if riff_id not in (b"RIFF", b"RF64") or wave_id != b"WAVE":
+        raise ValueError("Not a wav file")
+    fmt = None
+    ds64_data_size = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("No data chunk")
+        chunk_id, size = struct.unpack("<4sI", header)
+        if chunk_id == b"fmt ":
+            chunk = f.read(size)
+            format_tag, nchannels, samplerate, byte_rate, block_align, bits = struct.unpack("<HHIIHH", chunk[:16])
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(chunk) >= 26:
+                format_tag = struct.unpack("<H", chunk[24:26])[0]
+            fmt = (format_tag, nchannels, samplerate, block_align, bits)
+        elif chunk_id == b"ds64":
+            chunk = f.read(size)
+            ds64_data_size = struct.unpack("<Q", chunk[8:16])[0]
+        elif chunk_id == b"data":
+            break
+        else:
+            f.seek(size, 1)
+        if size & 1:
+            f.seek(1, 1)
+    if fmt is None:
+        raise ValueError("No fmt chunk before the data chunk")
+    format_tag, nchannels, samplerate, block_align, bits = fmt
+    if (format_tag, bits) not in _DTYPES:
+        raise ValueError("Unsupported wav format %d with %d bits" % (format_tag, bits))
+    if riff_id == b"RF64" and size == 0xFFFFFFFF and ds64_data_size is not None:
+        size = ds64_data_size
+    return format_tag, nchannels, samplerate, block_align, bits, size
+
+
+def _read(f):
+    format_tag, nchannels, samplerate, block_align, bits, size = _read_header(f)
+
+    # a truncated file gives the complete frames it has; a streamed one has a
+    # placeholder size, it is read to the end rather than allocated from the header
+    if size in _STREAMING_SIZES:
+        raw = _read_to_end(f)
+    else:
+        raw = _read_into(f, size)
+    raw = raw[:len(raw) - len(raw) % block_align]
+    if bits == 24:
+        padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = raw.reshape(-1, 3)
+        data = padded.view('<i4').ravel()
+    else:
+        data = raw.view(_DTYPES[(format_tag, bits)])
+    if nchannels > 1:
+        data = data.reshape(-1, nchannels)
+    return samplerate, data
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Streaming wav writer for the Paulstretch outputs.
+
+The stdlib wave module stops at the 4 GB limit of the RIFF sizes, which an
+hour of input stretched 30x goes well past. This writer reserves room for an
+RF64 "ds64" chunk after the RIFF header (as a JUNK chunk, which every reader
+skips) and decides at close: outputs under the limit stay plain RIFF/WAVE
+files, larger ones become RF64 (EBU Tech 3306) by replacing the JUNK chunk
+in place, so nothing has to be moved after hours of rendering. When the
+expected length is known to be over the limit the header is written as RF64
+from the start.
+
+The float blocks of the engines are encoded in bulk, without per sample
+Python work, to one of the FORMATS: 16, 24 or 32 bit PCM (clamped, with
+optional TPDF dither) or 32 bit float (neither clamped nor quantized).
+
+    outfile = open_output("output.wav", samplerate, nchannels, "pcm24", dither=True, expected_frames=n)
+    outfile.write(output)   # floats, channels x samples (1D for mono)
+    outfile.close()
+"""
+import os
+import struct
+import tempfile
+import numpy as np
+
+# largest size which fits in the 32 bit RIFF size fields
+RIFF_LIMIT = 0xFFFFFFFF
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+# output format -> (bytes per sample, wav format tag)
+FORMATS = {
+    "pcm16": (2, WAVE_FORMAT_PCM),
+    "pcm24": (3, WAVE_FORMAT_PCM),
+    "pcm32": (4, WAVE_FORMAT_PCM),
+    "float32": (4, WAVE_FORMAT_IEEE_FLOAT),
+}
+
+
+class Encoder:
+    """
+    Converts float blocks (channels x samples, or 1D) to interleaved little
+    endian bytes. Without dither the integer formats truncate like the
+    original int16(output*32767.0); with dither a triangular (TPDF) noise of
+    +-1 LSB is added and the samples are rounded.
+    """
+    def __init__(self, format="pcm16", dither=False, seed=None):
+        if format not in FORMATS:
+            raise ValueError("Unknown output format: %s (expected one of %s)" % (format, ", ".join(FORMATS)))
+        self.format = format
+        self.sampwidth, self.format_tag = FORMATS[format]
+        self.scale = float(2 ** (self.sampwidth * 8 - 1) - 1)
+        self.rng = np.random.default_rng(seed) if dither and format != "float32" else None
+
+    def encode(self, output):
+        interleaved = output.ravel('F')
+        if self.format == "float32":
+            return interleaved.astype('<f4').tobytes()
+        scaled = interleaved * self.scale
+        if self.rng is not None:
+            scaled += self.rng.random(scaled.size) - self.rng.random(scaled.size)
+            np.rint(scaled, out=scaled)
+        np.clip(scaled, -self.scale, self.scale, out=scaled)
+        if self.format == "pcm16":
+            return scaled.astype('<i2').tobytes()
+        samples = scaled.astype('<i4')
+        if self.format == "pcm32":
+            return samples.tobytes()
+        # pcm24: the 3 low bytes of each little endian int32
+        return samples.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+
+# RIFF header, JUNK/ds64 chunk, fmt chunk, data chunk header
+_DS64_SIZE = 28
+_HEADER_SIZE = 12 + (8 + _DS64_SIZE) + (8 + 16) + 8
+
+
+class WavWriter:
+    """
+    Writes float blocks through an Encoder (write) or already encoded frames
+    (writeframes, like the wave module) through a large write buffer and
+    patches the sizes at close.
+    """
+    def __init__(self, filename, samplerate, nchannels, format="pcm16", dither=False, dither_seed=None,
+                 expected_frames=None, buffer_size=1 << 20, resume_data_size=None):
+        self.filename = filename
+        self.samplerate = samplerate
+        self.nchannels = nchannels
+        self.encoder = Encoder(format, dither, dither_seed)
+        self.sampwidth = self.encoder.sampwidth
+        self.format_tag = self.encoder.format_tag
+        self.frame_size = nchannels * self.sampwidth
+        self.data_size = 0
+        self.rf64 = expected_frames is not None and _HEADER_SIZE - 8 + expected_frames * self.frame_size > RIFF_LIMIT
+        if resume_data_size is None:
+            self.file = open(filename, "wb", buffering=buffer_size)
+            self._write_header()
+        else:
+            # continue a file written by a previous WavWriter, dropping what came after resume_data_size
+            self.file = open(filename, "r+b", buffering=buffer_size)
+            if self.file.seek(0, 2) < _HEADER_SIZE + resume_data_size:
+                self.file.close()
+                raise ValueError("%s is shorter than its checkpoint" % filename)
+            self.data_size = resume_data_size
+            self.file.truncate(_HEADER_SIZE + resume_data_size)
+            self.file.seek(0, 2)
+
+    def _write_header(self):
+        data_size = self.data_size
+        riff_size = _HEADER_SIZE - 8 + data_size + (data_size & 1)
+        rf64 = self.rf64 or riff_size > RIFF_LIMIT
+        f = self.file
+        f.seek(0)
+        if rf64:
+            f.write(struct.pack("<4sI4s", b"RF64", RIFF_LIMIT, b"WAVE"))
+            f.write(struct.pack("<4sIQQQI", b"ds64", _DS64_SIZE, riff_size, data_size,
+                                data_size // self.frame_size, 0))
+        else:
+            f.write(struct.pack("<4sI4s", b"RIFF", riff_size, b"WAVE"))
+            f.write(struct.pack("<4sI", b"JUNK", _DS64_SIZE) + bytes(_DS64_SIZE))
+        f.write(struct.pack("<4sIHHIIHH", b"fmt ", 16, self.format_tag, self.nchannels, self.samplerate,
+                            self.samplerate * self.frame_size, self.frame_size, self.sampwidth * 8))
+        f.write(struct.pack("<4sI", b"data", RIFF_LIMIT if rf64 else data_size))
+
+    def write(self, output):
+        self.writeframes(self.encoder.encode(output))
+
+    def writeframes(self, data):
+        self.file.write(data)
+        self.data_size += len(data)
+
+    def flush(self):
+        """Make the file on disk a complete wav with the frames written so far"""
+        self._write_header()
+        self.file.seek(0, 2)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.data_size & 1:
+            self.file.write(b"\0")
+        self._write_header()
+        self.file.close()
+        self.file = None
+
+    def abort(self):
+        """Close a render which failed or was cancelled: the file keeps the frames written so far"""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class RawWriter:
+    """
+    Writes the encoded frames without any header to a binary stream (a pipe),
+    in blocks of about buffer_size bytes. The stream is flushed at close but
+    not closed.
+    """
+    def __init__(self, stream, format="pcm16", dither=False, dither_seed=None, buffer_size=1 << 20):
+        self.stream = stream
+        self.encoder = Encoder(format, dither, dither_seed)
+        self.buffer_size = buffer_size
+        self.blocks = []
+        self.buffered = 0
+        self.data_size = 0
+
+    def write(self, output):
+        self.writeframes(self.encoder.encode(output))
+
+    def writeframes(self, data):
+        self.blocks.append(data)
+        self.buffered += len(data)
+        self.data_size += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.blocks:
+            self.stream.write(b"".join(self.blocks))
+            self.blocks = []
+            self.buffered = 0
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+    def abort(self):
+        # the stream may be the broken pipe which stopped the render, what is buffered is dropped
+        self.blocks = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class NormalizingWriter:
+    """
+    Two pass peak normalization with constant memory: the blocks are kept
+    as float32 in a scratch file while the peak is tracked, and at close the
+    scratch file is memory mapped and streamed in large blocks, scaled to
+    the target peak, to the final writer (a WavWriter or RawWriter).
+    The scratch file is anonymous, it goes away even if the render dies.
+    """
+    def __init__(self, final, nchannels, target_peak=1.0, scratch_dir=None, block_frames=1 << 18):
+        self.final = final
+        self.nchannels = nchannels
+        self.target_peak = target_peak
+        self.block_frames = block_frames
+        self.scratch = tempfile.TemporaryFile(prefix="paulstretch_normalize_", dir=scratch_dir)
+        self.nvalues = 0
+        self.peak = 0.0
+
+    def write(self, output):
+        if output.size:
+            self.peak = max(self.peak, float(np.abs(output).max()))
+        self.scratch.write(output.ravel('F').astype('<f4').tobytes())
+        self.nvalues += output.size
+
+    def close(self):
+        if self.scratch is None:
+            return
+        gain = self.target_peak / self.peak if self.peak > 0.0 else 1.0
+        self.scratch.flush()
+        if self.nvalues:
+            scratch = np.memmap(self.scratch, dtype='<f4', mode='r', shape=(self.nvalues,))
+            block_size = self.block_frames * self.nchannels
+            for i in range(0, self.nvalues, block_size):
+                block = scratch[i:i + block_size] * gain
+                self.final.write(block if self.nchannels == 1 else block.reshape(-1, self.nchannels).T)
+            del scratch
+        self.scratch.close()
+        self.scratch = None
+        self.final.close()
+
+    def abort(self):
+        """Drop the scratch file without the normalization pass, the final output stays empty"""
+        if self.scratch is None:
+            return
+        self.scratch.close()
+        self.scratch = None
+        self.final.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_output(filename, samplerate, nchannels, format="pcm16", dither=False, dither_seed=None, expected_frames=None):
+    """Open a wav file for writing, it becomes RF64 if it grows over 4 GB"""
+    return WavWriter(filename, samplerate, nchannels, format, dither, dither_seed, expected_frames)
+
+
+def patch_sizes(f, data_offset, data_size, frame_size):
+    """Update the sizes of a wav file opened in r+b mode after its data changed length
+
+    The file must have been written by WavWriter, which left room for the
+    ds64 chunk, when the new size is over the RIFF limit.
+    """
+    f.seek(0)
+    riff_id = f.read(4)
+    f.seek(12)
+    chunk_id = f.read(4)
+    riff_size = data_offset - 8 + data_size
+    if riff_id == b"RF64" or riff_size > RIFF_LIMIT:
+        if chunk_id not in (b"JUNK", b"ds64"):
+            raise ValueError("No room for the RF64 header: the file is too large for RIFF")
+        f.seek(12)
+        f.write(struct.pack("<4sIQQQI", b"ds64", _DS64_SIZE, riff_size, data_size, data_size // frame_size, 0))
+        f.seek(0)
+        f.write(struct.pack("<4sI", b"RF64", RIFF_LIMIT))
+        f.seek(data_offset - 4)
+        f.write(struct.pack("<I", RIFF_LIMIT))
+    else:
+        f.seek(4)
+        f.write(struct.pack("<I", riff_size))
+        f.seek(data_offset - 4)
+        f.write(struct.pack("<I", data_size))
+    f.truncate(data_offset + data_size)